@@ -4,9 +4,2143 @@ import cv2
 import numpy as np
 from PIL import Image, ImageTk
 import os
-import glob
 import sys
-from io import StringIO
+import json
+import csv
+import time
+import queue
+import hashlib
+import asyncio
+import base64
+import struct
+import zlib
+import logging
+import logging.handlers
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from io import StringIO, BytesIO
+
+
+# 支持的图像格式（扩展名不区分大小写）
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff']
+
+# mask文件还可以是 .npz（压缩的numpy格式，二值mask按位存储）
+MASK_EXTENSIONS = IMAGE_EXTENSIONS + ['.npz']
+
+# 文件夹清单缓存目录，可通过环境变量 MEDMASK_CACHE_DIR 修改
+MANIFEST_DIR = os.path.join(os.environ.get("MEDMASK_CACHE_DIR") or
+                            os.path.join(os.path.expanduser("~"), ".cache", "medmaskeditor"),
+                            "manifests")
+
+# 日志文件（可选）：设置环境变量 MEDMASK_LOG_FILE 后，日志同时写入该文件（按大小轮转）
+LOG_FILE = os.environ.get("MEDMASK_LOG_FILE")
+
+logger = logging.getLogger("medmaskeditor")
+
+# 性能统计（可选）：MEDMASK_PROFILE=1 时启动即开启；值为 .json 路径时退出时还会写入该文件
+PROFILE_SETTING = os.environ.get("MEDMASK_PROFILE", "")
+
+
+def manifest_path(folder, extensions=IMAGE_EXTENSIONS):
+    """文件夹对应的清单缓存文件路径（扫描的扩展名不同时使用不同的缓存）"""
+    key = os.path.abspath(folder)
+    if extensions != IMAGE_EXTENSIONS:
+        key += "|" + ",".join(extensions)
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(MANIFEST_DIR, f"{digest}.json")
+
+
+def load_folder_manifest(folder, extensions=IMAGE_EXTENSIONS):
+    """读取文件夹的清单缓存；文件夹修改时间与缓存记录一致时返回文件名列表，否则返回None
+    
+    增加、删除或重命名文件都会更新文件夹的修改时间，使缓存失效。
+    """
+    try:
+        with open(manifest_path(folder, extensions), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if (manifest.get("folder") != os.path.abspath(folder) or
+                manifest.get("mtime_ns") != os.stat(folder).st_mtime_ns):
+            return None
+        return manifest["files"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_folder_manifest(folder, mtime_ns, names, extensions=IMAGE_EXTENSIONS):
+    """保存文件夹的清单缓存（缓存写入失败不影响正常使用）"""
+    path = manifest_path(folder, extensions)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"folder": os.path.abspath(folder), "mtime_ns": mtime_ns, "files": names},
+                      f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def iter_image_folder(folder, batch_size=512, use_manifest=True, extensions=IMAGE_EXTENSIONS):
+    """单次 os.scandir 遍历文件夹，分批产出支持格式的图像路径（目录顺序，未排序）
+    
+    清单缓存有效时直接产出缓存中的文件列表，不再遍历文件夹；
+    完整遍历结束后更新清单缓存。扫描mask文件夹时 extensions 为 MASK_EXTENSIONS。
+    """
+    names = load_folder_manifest(folder, extensions) if use_manifest else None
+    if names is not None:
+        for start in range(0, len(names), batch_size):
+            yield [os.path.join(folder, name) for name in names[start:start + batch_size]]
+        return
+    
+    # 在遍历前记录修改时间，遍历期间发生的变化会使下次打开时重新扫描
+    mtime_ns = os.stat(folder).st_mtime_ns
+    names = []
+    batch = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if os.path.splitext(entry.name)[1].lower() not in extensions:
+                continue
+            if not entry.is_file():
+                continue
+            names.append(entry.name)
+            batch.append(os.path.join(folder, entry.name))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+    if use_manifest:
+        save_folder_manifest(folder, mtime_ns, names, extensions)
+
+
+def scan_image_folder(folder, use_manifest=True, extensions=IMAGE_EXTENSIONS):
+    """扫描文件夹中支持格式的图像文件，返回排序后的路径列表"""
+    files = []
+    for batch in iter_image_folder(folder, use_manifest=use_manifest, extensions=extensions):
+        files.extend(batch)
+    return sorted(files)
+
+
+class FolderScan:
+    """在后台线程中扫描文件夹，界面线程通过 drain 分批取回结果"""
+    
+    def __init__(self, folder, extensions=IMAGE_EXTENSIONS):
+        self.folder = folder
+        self.extensions = extensions
+        self.files = []
+        self.error = None
+        self.batches = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="FolderScan", daemon=True)
+        self.thread.start()
+    
+    def run(self):
+        try:
+            for batch in iter_image_folder(self.folder, extensions=self.extensions):
+                if self.cancelled.is_set():
+                    return
+                self.batches.put(batch)
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.batches.put(None)  # 扫描结束标记
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    def drain(self):
+        """取回目前为止新找到的文件，返回 (新文件列表, 是否扫描完成)"""
+        new_files = []
+        finished = False
+        while True:
+            try:
+                batch = self.batches.get_nowait()
+            except queue.Empty:
+                break
+            if batch is None:
+                finished = True
+                break
+            new_files.extend(batch)
+        self.files.extend(new_files)
+        return new_files, finished
+
+
+def read_image_file(filepath, flags=cv2.IMREAD_COLOR):
+    """读取并解码图像文件，支持中文路径；读取失败时抛出异常"""
+    # np.fromfile 直接读入numpy数组交给 imdecode，不经过中间的bytes对象，支持中文路径
+    return cv2.imdecode(np.fromfile(filepath, dtype=np.uint8), flags)
+
+
+def mask_to_gray(mask):
+    """彩色/带透明通道的mask转为灰度，灰度mask原样返回"""
+    if mask is not None and mask.ndim == 3:
+        code = cv2.COLOR_BGRA2GRAY if mask.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        mask = cv2.cvtColor(mask, code)
+    return mask
+
+
+def read_mask_file(filepath):
+    """读取mask文件：保留16位标签图的原始取值，彩色/带透明通道的mask转为灰度"""
+    if os.path.splitext(filepath)[1].lower() == ".npz":
+        return load_npz_mask(filepath)
+    return mask_to_gray(read_image_file(filepath, cv2.IMREAD_UNCHANGED))
+
+
+def decode_mask_bytes(data, ext):
+    """从内存中的文件内容解码mask，结果与 read_mask_file 相同"""
+    if ext.lower() == ".npz":
+        return load_npz_mask(BytesIO(data))
+    return mask_to_gray(cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED))
+
+
+def load_npz_mask(source):
+    """读取 .npz 格式的mask（source 为路径或文件对象）
+    
+    二值mask保存为 packed（np.packbits 按位压缩）、shape 和前景值 value，其他mask直接保存为 mask。
+    """
+    with np.load(source, allow_pickle=False) as data:
+        if "mask" in data:
+            return data["mask"]
+        shape = tuple(int(v) for v in data["shape"])
+        value = data["value"]
+        bits = np.unpackbits(data["packed"], count=int(np.prod(shape))).reshape(shape)
+        return bits * value
+
+
+def encode_npz_mask(mask, compress=True):
+    """把mask编码为 .npz 文件内容；只有0和一个前景值的mask按位存储"""
+    buffer = BytesIO()
+    save = np.savez_compressed if compress else np.savez
+    flat = mask.ravel()
+    value = flat.max() if flat.size else mask.dtype.type(0)
+    if flat.size and np.count_nonzero(flat) == np.count_nonzero(flat == value):
+        save(buffer, packed=np.packbits(flat != 0), shape=np.array(mask.shape, dtype=np.int64),
+             value=np.array(value, dtype=mask.dtype))
+    else:
+        save(buffer, mask=mask)
+    return buffer.getvalue()
+
+
+class MaskCodec:
+    """mask的编码设置
+    
+    format 决定新建mask的扩展名：png（8/16位PNG）、png1（二值mask保存为1位PNG）、npz；
+    已有mask保持原来的扩展名。png_level 为PNG的zlib压缩级别（0-9，越小越快、文件越大），
+    png_rle 为True时使用zlib的RLE策略，对mask编码快得多而文件只稍大。
+    1位PNG读回时前景为255，因此只用于前景值为255的二值mask，其他mask仍保存为8位PNG。
+    """
+    
+    FORMATS = {"png": ".png", "png1": ".png", "npz": ".npz"}
+    
+    def __init__(self, format="png", png_level=6, png_rle=False):
+        if format not in self.FORMATS:
+            raise ValueError(f"未知的mask格式: {format}，可选: {', '.join(self.FORMATS)}")
+        if not 0 <= png_level <= 9:
+            raise ValueError("PNG压缩级别应为0-9")
+        self.format = format
+        self.png_level = png_level
+        self.png_rle = png_rle
+    
+    @classmethod
+    def from_env(cls):
+        """从环境变量 MEDMASK_MASK_FORMAT / MEDMASK_PNG_LEVEL / MEDMASK_PNG_RLE 读取设置"""
+        return cls(os.environ.get("MEDMASK_MASK_FORMAT", "png").lower(),
+                   int(os.environ.get("MEDMASK_PNG_LEVEL", "6")),
+                   os.environ.get("MEDMASK_PNG_RLE", "") not in ("", "0"))
+    
+    @property
+    def extension(self):
+        """新建mask使用的扩展名"""
+        return self.FORMATS[self.format]
+    
+    def encode(self, mask, ext):
+        """按目标扩展名把mask编码为文件内容"""
+        ext = ext.lower()
+        if ext == ".npz":
+            return encode_npz_mask(mask)
+        if ext == ".png":
+            params = [cv2.IMWRITE_PNG_COMPRESSION, self.png_level]
+            if self.png_rle:
+                params += [cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE]
+            if (self.format == "png1" and mask.dtype == np.uint8 and
+                    np.count_nonzero(mask) == np.count_nonzero(mask == 255)):
+                params += [cv2.IMWRITE_PNG_BILEVEL, 1]
+            ok, data = cv2.imencode(".png", mask, params)
+            if not ok:
+                raise ValueError("PNG编码失败")
+            return data.tobytes()
+        # 其他格式使用PIL
+        buffer = BytesIO()
+        Image.fromarray(mask).save(buffer, format=Image.registered_extensions().get(ext, "PNG"))
+        return buffer.getvalue()
+
+
+MASK_CODEC = MaskCodec.from_env()
+
+
+class CompactMask:
+    """紧凑存储的mask，可无损地与 cv2.circle/findContours 使用的稠密数组互相转换
+    
+    只有0和一个前景值的二值mask可按位压缩（np.packbits，1/8大小）；
+    其他情况使用游程编码（RLE），对任意取值都无损；两者都不划算时保留原数组副本。
+    构造时自动选择占用内存最小的方式。
+    """
+    
+    def __init__(self, method, shape, dtype, data, value=0):
+        self.method = method  # "packbits" / "rle" / "raw"
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.data = data
+        self.value = value    # packbits 方式下的前景值
+    
+    @classmethod
+    def from_array(cls, mask, method="auto"):
+        mask = np.ascontiguousarray(mask)
+        flat = mask.ravel()
+        if flat.size == 0:
+            return cls("raw", mask.shape, mask.dtype, mask.copy())
+        
+        # 判断是否为二值mask（只包含0和一个前景值）
+        value = flat.max()
+        foreground = np.count_nonzero(flat)
+        is_binary = foreground == 0 or foreground == np.count_nonzero(flat == value)
+        
+        if method in ("auto", "rle"):
+            # 游程边界：相邻像素取值发生变化的位置
+            starts = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+            rle_nbytes = (starts.size + 1) * (4 + flat.itemsize)
+        if method == "auto":
+            packed_nbytes = (flat.size + 7) // 8 if is_binary else None
+            candidates = [(mask.nbytes, "raw"), (rle_nbytes, "rle")]
+            if packed_nbytes is not None:
+                candidates.append((packed_nbytes, "packbits"))
+            method = min(candidates)[1]
+        
+        if method == "packbits":
+            if not is_binary:
+                raise ValueError("只有二值mask可以按位压缩")
+            return cls("packbits", mask.shape, mask.dtype, np.packbits(flat != 0), value)
+        if method == "rle":
+            starts = np.concatenate(([0], starts)).astype(np.uint32)
+            return cls("rle", mask.shape, mask.dtype, (starts, flat[starts]))
+        return cls("raw", mask.shape, mask.dtype, mask.copy())
+    
+    @property
+    def nbytes(self):
+        if self.method == "rle":
+            return self.data[0].nbytes + self.data[1].nbytes
+        return self.data.nbytes
+    
+    def to_array(self):
+        """解压为新的稠密数组（调用方可以直接修改）"""
+        size = int(np.prod(self.shape))
+        if self.method == "packbits":
+            out = np.unpackbits(self.data, count=size)
+            if self.dtype != np.uint8:
+                out = out.astype(self.dtype)
+            if self.value != 1:
+                out *= self.value
+            return out.reshape(self.shape)
+        if self.method == "rle":
+            starts, values = self.data
+            lengths = np.diff(np.append(starts.astype(np.int64), size))
+            return np.repeat(values, lengths).reshape(self.shape)
+        return self.data.copy()
+
+
+def brush_line_thickness(radius):
+    """与半径为 radius 的实心圆笔刷等宽的 cv2.line 线宽（OpenCV粗线端点为圆头）"""
+    return max(2, 2 * radius - 1)
+
+
+def stroke_bounds(points, radius):
+    """笔画经过的点以半径 radius 扩展后的外接矩形 (x0, y0, x1, y1)"""
+    pts = np.asarray(points)
+    x0, y0 = pts.min(axis=0) - radius
+    x1, y1 = pts.max(axis=0) + radius + 1
+    return (int(x0), int(y0), int(x1), int(y1))
+
+
+def draw_stroke(mask, points, radius, value):
+    """将一批笔画点一次性栅格化：单点画实心圆，多点画带圆头的粗折线
+    
+    相邻两次鼠标事件之间的线段被连续填充，快速移动鼠标时不会出现断点。
+    """
+    if len(points) == 1:
+        cv2.circle(mask, tuple(points[0]), radius, value, -1)
+        return
+    pts = np.asarray(points, dtype=np.int32).reshape(-1, 1, 2)
+    cv2.polylines(mask, [pts], False, value, thickness=brush_line_thickness(radius))
+
+
+def region_tool_roi(point, shape, radius):
+    """区域工具的ROI：以 point 为中心、半边长为 radius 的正方形（裁剪到图像范围内）"""
+    h, w = shape[:2]
+    x, y = point
+    return (max(0, x - radius), max(0, y - radius), min(w, x + radius + 1), min(h, y + radius + 1))
+
+
+def magic_wand(image, seed, tolerance):
+    """魔棒：在ROI图像上从 seed 开始泛洪填充，选中与种子颜色相差不超过 tolerance 的连通区域（bool）"""
+    h, w = image.shape[:2]
+    flood = np.zeros((h + 2, w + 2), dtype=np.uint8)
+    diff = (tolerance,) * 3
+    flags = 8 | cv2.FLOODFILL_FIXED_RANGE | cv2.FLOODFILL_MASK_ONLY | (1 << 8)
+    cv2.floodFill(np.ascontiguousarray(image), flood, tuple(seed), 0, diff, diff, flags)
+    return flood[1:-1, 1:-1] > 0
+
+
+def grabcut_refine(image, mask, band=8, iterations=3):
+    """以现有mask为初值在ROI上做GrabCut，返回细化后的前景（bool）
+    
+    mask边界两侧 band 像素内为待定区域，其余像素固定为前景/背景；
+    ROI内没有前景或没有背景时无法建模，返回None。
+    """
+    foreground = (mask > 0).astype(np.uint8)
+    if not foreground.any() or foreground.all():
+        return None
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * band + 1, 2 * band + 1))
+    labels = np.where(foreground > 0, cv2.GC_PR_FGD, cv2.GC_PR_BGD).astype(np.uint8)
+    labels[cv2.erode(foreground, kernel) > 0] = cv2.GC_FGD
+    labels[cv2.dilate(foreground, kernel) == 0] = cv2.GC_BGD
+    bgd_model = np.zeros((1, 65), dtype=np.float64)
+    fgd_model = np.zeros((1, 65), dtype=np.float64)
+    cv2.grabCut(np.ascontiguousarray(image), labels, None, bgd_model, fgd_model,
+                iterations, cv2.GC_INIT_WITH_MASK)
+    return (labels == cv2.GC_FGD) | (labels == cv2.GC_PR_FGD)
+
+
+class Profiler:
+    """各处理阶段的耗时统计与事件计数（线程安全），默认关闭
+    
+    用法：with PROFILER.stage("decode_image"): ...；关闭时 stage 返回空的上下文管理器，
+    几乎没有额外开销。count 记录事件次数，报告中换算为每秒次数。
+    整帧重绘的阶段名为 resize/contours/overlay/photo，笔刷局部刷新的同名阶段带 _region 后缀。
+    """
+    
+    NULL_STAGE = nullcontext()
+    
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self.lock:
+            self.stages = {}    # 阶段名 -> [次数, 总耗时, 最大耗时]（秒）
+            self.counters = {}  # 事件名 -> 次数
+            self.start = time.perf_counter()
+    
+    def stage(self, name):
+        if not self.enabled:
+            return self.NULL_STAGE
+        return ProfilerStage(self, name)
+    
+    def add(self, name, seconds):
+        with self.lock:
+            record = self.stages.get(name)
+            if record is None:
+                self.stages[name] = [1, seconds, seconds]
+            else:
+                record[0] += 1
+                record[1] += seconds
+                record[2] = max(record[2], seconds)
+    
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+    
+    def snapshot(self):
+        """当前统计结果，可直接写入JSON"""
+        with self.lock:
+            elapsed = max(time.perf_counter() - self.start, 1e-9)
+            stages = {name: {"count": count, "total_ms": round(total * 1000, 3),
+                             "mean_ms": round(total * 1000 / count, 3), "max_ms": round(peak * 1000, 3)}
+                      for name, (count, total, peak) in sorted(self.stages.items())}
+            counters = {name: {"count": count, "per_second": round(count / elapsed, 2)}
+                        for name, count in sorted(self.counters.items())}
+        return {"elapsed_s": round(elapsed, 3), "stages": stages, "counters": counters}
+    
+    def report_lines(self):
+        """适合输出到日志的统计文本"""
+        snapshot = self.snapshot()
+        lines = [f"性能统计 ({snapshot['elapsed_s']:.1f} 秒):"]
+        for name, stage in snapshot["stages"].items():
+            lines.append(f"  {name}: {stage['count']} 次, 平均 {stage['mean_ms']:.2f} ms, "
+                         f"最大 {stage['max_ms']:.2f} ms, 合计 {stage['total_ms']:.0f} ms")
+        for name, counter in snapshot["counters"].items():
+            lines.append(f"  {name}: {counter['count']} 次 ({counter['per_second']:.1f} 次/秒)")
+        return lines
+    
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+
+
+class ProfilerStage:
+    """Profiler.stage 返回的计时上下文"""
+    
+    __slots__ = ("profiler", "name", "begin")
+    
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+    
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.begin)
+        return False
+
+
+PROFILER = Profiler(enabled=bool(PROFILE_SETTING) and PROFILE_SETTING != "0")
+
+
+class RenderScheduler:
+    """按帧合并重绘请求
+    
+    调用方只标记需要更新的部分（如 "image"、"mask"、"overlay"，mask可附带原图坐标
+    下的局部区域），由一个 after 定时回调在每帧最多调用一次 render(parts, box)。
+    不带 box 的 "mask" 请求表示整个mask都要重绘，同一帧内的局部请求不会把它缩小为局部重绘。
+    统计信息：frames 实际绘制帧数，coalesced 被合并到已排队帧中的请求数，
+    dropped 因事件处理或绘制超时而错过的帧数。
+    """
+    
+    def __init__(self, after, render, fps=60):
+        self.after = after
+        self.render = render
+        self.fps = fps
+        self.parts = set()
+        self.box = None
+        self.full_mask = False
+        self.scheduled = False
+        self.target_time = 0.0
+        self.last_frame = 0.0
+        self.frames = 0
+        self.coalesced = 0
+        self.dropped = 0
+    
+    @property
+    def interval(self):
+        return 1.0 / self.fps
+    
+    def request(self, *parts, box=None):
+        """标记需要重绘的部分；同一帧内的多次请求会被合并"""
+        if self.scheduled:
+            self.coalesced += 1
+        self.parts.update(parts)
+        if "mask" in parts and box is None:
+            self.full_mask = True
+        elif box is not None:
+            if self.box is None:
+                self.box = box
+            else:
+                self.box = (min(self.box[0], box[0]), min(self.box[1], box[1]),
+                            max(self.box[2], box[2]), max(self.box[3], box[3]))
+        if self.scheduled:
+            return
+        
+        # 距上一帧不足一个帧间隔时推迟到下一帧
+        now = time.perf_counter()
+        delay = max(0.0, self.last_frame + self.interval - now)
+        self.target_time = now + delay
+        self.scheduled = True
+        self.after(int(delay * 1000), self.tick)
+    
+    def tick(self):
+        self.scheduled = False
+        if not self.parts:
+            return
+        parts, box = self.parts, None if self.full_mask else self.box
+        self.parts, self.box, self.full_mask = set(), None, False
+        
+        start = time.perf_counter()
+        self.render(parts, box)
+        end = time.perf_counter()
+        self.last_frame = start
+        self.frames += 1
+        # 从预定时间到绘制完成超出一帧的部分，即为错过的帧
+        self.dropped += max(0, int((end - self.target_time) / self.interval))
+    
+    def flush(self):
+        """立即绘制所有待处理的请求"""
+        if self.parts:
+            self.target_time = time.perf_counter()
+            self.tick()
+    
+    def stats(self):
+        return {"fps": self.fps, "frames": self.frames,
+                "coalesced": self.coalesced, "dropped": self.dropped}
+
+
+class UndoHistory:
+    """笔画级的撤销/重做记录
+    
+    不保存整张mask的快照：每一步只记录被修改的图块（tile）在修改前后的内容，
+    并以 CompactMask 压缩保存。总占用超过 max_bytes 时丢弃最早的记录。
+    撤销/重做只需写回该步涉及的图块，耗时与历史长度无关。
+    """
+    
+    def __init__(self, max_bytes=128 * 1024 * 1024, tile_size=256):
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self.undo_steps = deque()  # [(图块列表, 字节数), ...]
+        self.redo_steps = []
+        self.total_bytes = 0
+        self.pending = {}  # 当前笔画中已记录的图块：(tx, ty) -> 修改前的内容
+    
+    def tile_slices(self, tx, ty):
+        ts = self.tile_size
+        return slice(ty * ts, (ty + 1) * ts), slice(tx * ts, (tx + 1) * ts)
+    
+    def begin(self):
+        """开始记录一个新的笔画"""
+        self.pending = {}
+    
+    def record(self, mask, box):
+        """在修改 box=(x0, y0, x1, y1) 区域之前调用，保存尚未记录的图块的原始内容"""
+        h, w = mask.shape[:2]
+        x0, y0 = max(0, box[0]), max(0, box[1])
+        x1, y1 = min(w, box[2]), min(h, box[3])
+        if x0 >= x1 or y0 >= y1:
+            return
+        ts = self.tile_size
+        for ty in range(y0 // ts, (y1 - 1) // ts + 1):
+            for tx in range(x0 // ts, (x1 - 1) // ts + 1):
+                if (tx, ty) not in self.pending:
+                    self.pending[(tx, ty)] = mask[self.tile_slices(tx, ty)].copy()
+    
+    def commit(self, mask):
+        """结束当前笔画，只保存内容确实发生变化的图块；返回是否产生了新的记录"""
+        tiles = []
+        for (tx, ty), before in self.pending.items():
+            after = mask[self.tile_slices(tx, ty)]
+            if np.array_equal(before, after):
+                continue
+            tiles.append(((tx, ty), CompactMask.from_array(before), CompactMask.from_array(after)))
+        self.pending = {}
+        if not tiles:
+            return False
+        
+        # 新的修改使重做记录失效
+        for _, nbytes in self.redo_steps:
+            self.total_bytes -= nbytes
+        self.redo_steps = []
+        
+        nbytes = sum(before.nbytes + after.nbytes for _, before, after in tiles)
+        self.undo_steps.append((tiles, nbytes))
+        self.total_bytes += nbytes
+        
+        # 超出内存预算时丢弃最早的记录（至少保留最近一步）
+        while self.total_bytes > self.max_bytes and len(self.undo_steps) > 1:
+            self.total_bytes -= self.undo_steps.popleft()[1]
+        return True
+    
+    def apply(self, mask, tiles, use_before):
+        """将图块写回mask，返回受影响区域 (x0, y0, x1, y1)"""
+        ts = self.tile_size
+        xs, ys = [], []
+        for (tx, ty), before, after in tiles:
+            patch = (before if use_before else after).to_array()
+            mask[self.tile_slices(tx, ty)] = patch
+            xs += [tx * ts, tx * ts + patch.shape[1]]
+            ys += [ty * ts, ty * ts + patch.shape[0]]
+        return (min(xs), min(ys), max(xs), max(ys))
+    
+    def undo(self, mask):
+        """撤销最近一步，返回受影响区域；没有可撤销的记录时返回None"""
+        if not self.undo_steps:
+            return None
+        step = self.undo_steps.pop()
+        self.redo_steps.append(step)
+        return self.apply(mask, step[0], use_before=True)
+    
+    def redo(self, mask):
+        """重做最近撤销的一步，返回受影响区域；没有可重做的记录时返回None"""
+        if not self.redo_steps:
+            return None
+        step = self.redo_steps.pop()
+        self.undo_steps.append(step)
+        return self.apply(mask, step[0], use_before=False)
+    
+    def clear(self):
+        self.undo_steps.clear()
+        self.redo_steps = []
+        self.total_bytes = 0
+        self.pending = {}
+
+
+class IntensityWindow:
+    """16位灰度图像的窗宽/窗位映射
+    
+    灰度图以 uint16 索引保存，索引 i 对应的原始值为 i * scale + offset（如CT的HU值）。
+    映射通过 65536 项查找表完成，查找表只在窗口或索引映射变化时重建；
+    只对缓存的视口图像查表，不处理整张原图。
+    """
+    
+    def __init__(self):
+        self.center = None
+        self.width = None
+        self.lut = None
+        self.lut_key = None
+        self.lut_builds = 0
+    
+    def is_set(self):
+        return self.center is not None
+    
+    def set(self, center, width):
+        self.center = float(center)
+        self.width = max(float(width), 1e-6)
+    
+    def auto(self, raw, intensity):
+        """按视口内灰度的 0.5%~99.5% 分位数设置窗口"""
+        scale, offset = intensity
+        lo, hi = np.percentile(raw[::2, ::2], [0.5, 99.5]) if raw.size else (0.0, 1.0)
+        lo, hi = lo * scale + offset, hi * scale + offset
+        self.set((lo + hi) / 2, max(hi - lo, abs(scale)))
+    
+    def lut_for(self, intensity):
+        key = (self.center, self.width, intensity)
+        if self.lut_key != key:
+            scale, offset = intensity
+            values = np.arange(65536, dtype=np.float64) * scale + offset
+            low = self.center - self.width / 2
+            self.lut = np.clip(np.rint((values - low) * (255.0 / self.width)), 0, 255).astype(np.uint8)
+            self.lut_key = key
+            self.lut_builds += 1
+        return self.lut
+    
+    def apply(self, raw, intensity):
+        """把 uint16 灰度映射为用于显示的 RGB uint8"""
+        return cv2.cvtColor(self.lut_for(intensity)[raw], cv2.COLOR_GRAY2RGB)
+
+
+def to_intensity_image(data, lo=None, hi=None, scale=1.0, offset=0.0):
+    """把单通道数值数组转换为 (uint16 索引图, (scale, offset))，索引 i 对应原始值 i * scale + offset
+    
+    16位整型直接使用（int16 平移 32768）；其他类型按 [lo, hi] 线性量化到 0~65535。
+    """
+    if data.dtype == np.uint16:
+        return np.array(data), (scale, offset)
+    if data.dtype == np.int16:
+        return (data.astype(np.int32) + 32768).astype(np.uint16), (scale, offset - 32768 * scale)
+    data = np.asarray(data, dtype=np.float32)
+    if lo is None:
+        lo, hi = float(data.min()), float(data.max())
+    step = (hi - lo) / 65535.0 if hi > lo else 1.0
+    index = np.clip(np.rint((data - lo) / step), 0, 65535).astype(np.uint16)
+    return index, (step * scale, lo * scale + offset)
+
+
+VOLUME_EXTENSIONS = ['.nii', '.npy', '.tif', '.tiff']
+
+# NIfTI-1 数据类型代码
+NIFTI_DTYPES = {2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32, 64: np.float64,
+                256: np.int8, 512: np.uint16, 768: np.uint32}
+
+# 未压缩TIFF页的原始格式
+TIFF_RAWMODES = {"L": "u1", "I;16": "<u2", "I;16B": ">u2", "I;16S": "<i2", "I;16BS": ">i2",
+                 "I;32S": "<i4", "F;32F": "<f4", "F;32BF": ">f4"}
+
+
+def volume_slice_ref(path, index):
+    """体数据中第 index 层切片的路径表示，与普通图像路径一样作为缓存和保存的键"""
+    return f"{path}#{index:05d}"
+
+
+def parse_volume_slice(ref):
+    """解析切片路径，返回 (体数据路径, 层号)；普通文件路径返回None"""
+    if not ref:
+        return None
+    path, sep, index = ref.rpartition("#")
+    if not sep or not index.isdigit() or os.path.splitext(path)[1].lower() not in VOLUME_EXTENSIONS:
+        return None
+    return path, int(index)
+
+
+def open_nifti_memmap(path, mode="r"):
+    """以内存映射方式打开未压缩的 NIfTI-1 文件，返回 (数组(X, Y, Z), 斜率, 截距)"""
+    with open(path, "rb") as f:
+        header = f.read(352)
+    if len(header) < 348:
+        raise ValueError("NIfTI文件头不完整")
+    for endian in ("<", ">"):
+        if np.frombuffer(header, dtype=f"{endian}i4", count=1)[0] == 348:
+            break
+    else:
+        raise ValueError("不是有效的NIfTI-1文件（压缩的 .nii.gz 需先解压）")
+    dim = np.frombuffer(header, dtype=f"{endian}i2", count=8, offset=40)
+    datatype = int(np.frombuffer(header, dtype=f"{endian}i2", count=1, offset=70)[0])
+    vox_offset = int(np.frombuffer(header, dtype=f"{endian}f4", count=1, offset=108)[0])
+    slope, inter = np.frombuffer(header, dtype=f"{endian}f4", count=2, offset=112)
+    if datatype not in NIFTI_DTYPES:
+        raise ValueError(f"不支持的NIfTI数据类型: {datatype}")
+    # dim[0] 为维数，超出维数的 dim 项可能是任意值；第4维及以上只接受长度为1（如单个时间点）
+    ndim = int(dim[0])
+    if not 1 <= ndim <= 7:
+        raise ValueError(f"NIfTI维数无效: {ndim}")
+    if any(int(d) != 1 for d in dim[4:1 + ndim]):
+        raise ValueError(f"不支持{ndim}维的NIfTI数据（如多个时间点），只能打开3维体数据")
+    shape = tuple(int(d) for d in dim[1:1 + min(ndim, 3)]) + (1,) * max(0, 3 - ndim)
+    dtype = np.dtype(NIFTI_DTYPES[datatype]).newbyteorder(endian)
+    data = np.memmap(path, dtype=dtype, mode=mode, offset=vox_offset, shape=shape[:3], order="F")
+    return data, float(slope), float(inter)
+
+
+class TiffPages:
+    """多页TIFF：未压缩的页直接内存映射，压缩的页按需解码"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.image = Image.open(path)
+        self.pages = []  # 每页为 (偏移, dtype) 或 None（需要解码）
+        for index in range(getattr(self.image, "n_frames", 1)):
+            self.image.seek(index)
+            self.pages.append(self.raw_layout(self.image))
+        self.image.seek(0)
+        self.shape = (self.image.size[1], self.image.size[0])
+    
+    @staticmethod
+    def raw_layout(image):
+        """页面数据在文件中连续且未压缩时返回 (偏移, dtype)"""
+        tiles = sorted(image.tile, key=lambda tile: tile[1][1])
+        if not tiles or tiles[0][0] != "raw" or tiles[0][3][0] not in TIFF_RAWMODES:
+            return None
+        rawmode = tiles[0][3][0]
+        dtype = np.dtype(TIFF_RAWMODES[rawmode])
+        w = image.size[0]
+        offset = tiles[0][2]
+        for tile in tiles:
+            x0, y0, x1, y1 = tile[1]
+            if tile[0] != "raw" or tile[3][0] != rawmode or x0 != 0 or x1 != w or tile[2] != offset:
+                return None
+            offset += (y1 - y0) * w * dtype.itemsize
+        return tiles[0][2], dtype
+    
+    def __len__(self):
+        return len(self.pages)
+    
+    def __getitem__(self, index):
+        layout = self.pages[index]
+        if layout is not None:
+            offset, dtype = layout
+            return np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=self.shape)
+        # PIL 的 Image 对象不是线程安全的
+        with self.lock:
+            self.image.seek(index)
+            return np.array(self.image)
+
+
+class VolumeSource:
+    """只读的体数据（多页TIFF / 未压缩NIfTI / .npy），通过内存映射按需读取单层切片
+    
+    .npy 的第一维为层，NIfTI 按 (X, Y, Z) 存储并按 Z 取层。打开的体数据按路径缓存，
+    后台解码线程可以直接通过切片路径取得同一个实例。
+    """
+    
+    registry = {}
+    registry_lock = threading.Lock()
+    
+    @classmethod
+    def open(cls, path):
+        with cls.registry_lock:
+            source = cls.registry.get(path)
+            if source is None:
+                source = cls.registry[path] = cls(path)
+            return source
+    
+    def __init__(self, path):
+        self.path = path
+        self.slope, self.inter = 1.0, 0.0
+        ext = os.path.splitext(path)[1].lower()
+        self.nifti = ext == ".nii"
+        if ext == ".npy":
+            self.data = np.load(path, mmap_mode="r")
+            if self.data.ndim == 2:
+                self.data = self.data[None]
+            self.depth = self.data.shape[0]
+            self.shape = self.data.shape[1:3]
+        elif ext == ".nii":
+            self.data, slope, inter = open_nifti_memmap(path)
+            if slope not in (0.0, 1.0) or inter != 0.0:
+                self.slope, self.inter = slope or 1.0, inter
+            self.depth = self.data.shape[2]
+            self.shape = (self.data.shape[1], self.data.shape[0])
+        elif ext in (".tif", ".tiff"):
+            self.data = TiffPages(path)
+            self.depth = len(self.data)
+            self.shape = self.data.shape
+        else:
+            raise ValueError(f"不支持的体数据格式: {ext}")
+        self.range = None
+    
+    def read_slice(self, index):
+        """第 index 层的原始数据（内存映射的视图，不复制）"""
+        if self.nifti:
+            return self.data[:, :, index].T
+        return self.data[index]
+    
+    def intensity_range(self):
+        """估计整个体数据的取值范围（存储值）：只抽取少量层并隔点采样，不读取整个文件"""
+        if self.range is None:
+            indices = np.unique(np.linspace(0, self.depth - 1, min(self.depth, 16)).astype(int))
+            samples = [np.asarray(self.read_slice(i))[::4, ::4].astype(np.float32).ravel() for i in indices]
+            values = np.concatenate(samples)
+            lo, hi = (float(values.min()), float(values.max())) if values.size else (0.0, 1.0)
+            self.range = (lo, hi if hi > lo else lo + 1.0)
+        return self.range
+    
+    def slice_image(self, index):
+        """第 index 层用于显示的图像：RGB uint8，或 (uint16 灰度索引图, (scale, offset))"""
+        data = np.asarray(self.read_slice(index))
+        if data.ndim == 3 and data.dtype == np.uint8:
+            return np.ascontiguousarray(data[..., :3]), None
+        if data.dtype == np.uint8 and self.slope == 1.0 and self.inter == 0.0:
+            return cv2.cvtColor(data, cv2.COLOR_GRAY2RGB), None
+        lo, hi = self.intensity_range()
+        return to_intensity_image(data, lo, hi, self.slope, self.inter)
+
+
+class MaskVolume:
+    """可写的mask体数据（内存映射），编辑后的切片直接写回文件，不把整个体数据读入内存
+    
+    支持 .npy 和未压缩的 NIfTI；文件不存在时在第一次写入时创建 .npy。
+    """
+    
+    registry = {}
+    registry_lock = threading.Lock()
+    
+    @classmethod
+    def open(cls, path, depth, shape):
+        with cls.registry_lock:
+            volume = cls.registry.get(path)
+            if volume is None:
+                volume = cls.registry[path] = cls(path, depth, shape)
+            return volume
+    
+    @classmethod
+    def get(cls, path):
+        with cls.registry_lock:
+            volume = cls.registry.get(path)
+        if volume is None:
+            raise ValueError(f"mask体数据未打开: {path}")
+        return volume
+    
+    def __init__(self, path, depth, shape):
+        self.path = path
+        self.depth = depth
+        self.shape = tuple(shape)
+        self.lock = threading.Lock()
+        self.data = None
+        self.nifti = os.path.splitext(path)[1].lower() == ".nii"
+        if os.path.exists(path):
+            self.map(create=False, dtype=None)
+    
+    def map(self, create, dtype):
+        if self.nifti:
+            self.data = open_nifti_memmap(self.path, mode="r+")[0]
+            found = (self.data.shape[2], self.data.shape[1], self.data.shape[0])
+        elif create:
+            save_dir = os.path.dirname(self.path)
+            if save_dir:
+                os.makedirs(save_dir, exist_ok=True)
+            self.data = np.lib.format.open_memmap(self.path, mode="w+", dtype=dtype,
+                                                  shape=(self.depth,) + self.shape)
+            found = self.data.shape
+        else:
+            self.data = np.load(self.path, mmap_mode="r+")
+            found = self.data.shape
+        if found != (self.depth,) + self.shape:
+            self.data = None
+            raise ValueError(f"mask体数据尺寸 {found} 与图像体数据 {(self.depth,) + self.shape} 不一致")
+    
+    def widen(self):
+        """把体数据转换为16位：逐层复制到同目录下的临时文件，再重命名覆盖原文件"""
+        old = self.data
+        dtype = np.dtype(np.uint16)
+        tmp_path = os.path.join(os.path.dirname(self.path), f".{os.path.basename(self.path)}.{os.getpid()}.tmp")
+        try:
+            if self.nifti:
+                # 保留原文件头（含扩展），只修改数据类型和位数
+                with open(self.path, "rb") as f:
+                    header = bytearray(f.read(old.offset))
+                endian = "<" if struct.unpack_from("<i", header)[0] == 348 else ">"
+                struct.pack_into(f"{endian}hh", header, 70, 512, 16)
+                with open(tmp_path, "wb") as f:
+                    f.write(header)
+                    f.truncate(old.offset + old.size * dtype.itemsize)
+                new = np.memmap(tmp_path, dtype=dtype.newbyteorder(endian), mode="r+",
+                                offset=old.offset, shape=old.shape, order="F")
+                for i in range(old.shape[2]):
+                    new[:, :, i] = old[:, :, i]
+            else:
+                new = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=old.shape)
+                for i in range(old.shape[0]):
+                    new[i] = old[i]
+            new.flush()
+            # 先释放两个内存映射再替换文件（Windows 下不能替换仍被映射的文件）
+            del new
+            self.data = old = None
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if self.data is None:
+                self.map(create=False, dtype=None)
+            raise
+        self.map(create=False, dtype=None)
+    
+    def exists(self):
+        return self.data is not None
+    
+    def read_slice(self, index):
+        """第 index 层mask的副本；文件尚未创建时返回None"""
+        # 加锁：转换为16位的过程中 data 会短暂为None
+        with self.lock:
+            if self.data is None:
+                return None
+            mask = self.data[:, :, index].T if self.nifti else self.data[index]
+            mask = np.array(mask)
+        if mask.dtype not in (np.uint8, np.uint16):
+            mask = mask.astype(np.uint16 if mask.max() > 255 else np.uint8)
+        return mask
+    
+    def write_slice(self, index, mask):
+        """把第 index 层写回文件（只刷新这一层所在的页）
+        
+        标签值超出8位体数据的范围时，先把整个文件转换为16位，其他层的数据不变。
+        """
+        with self.lock:
+            if self.data is None:
+                self.map(create=True, dtype=mask.dtype)
+            info = np.iinfo(self.data.dtype) if self.data.dtype.kind in "ui" else None
+            if info is not None and mask.size and int(mask.max()) > info.max:
+                self.widen()
+            if self.nifti:
+                self.data[:, :, index] = mask.T
+            else:
+                self.data[index] = mask
+            self.data.flush()
+
+
+def mask_volume_path(volume_path, mask_folder):
+    """体数据对应的mask体数据路径：优先使用mask文件夹中同名的 .npy/.nii，否则为 <名称>_mask.npy"""
+    folder = mask_folder or os.path.dirname(volume_path)
+    stem = file_stem(volume_path)
+    for ext in (".npy", ".nii"):
+        candidate = os.path.join(folder, stem + ext)
+        if mask_folder and os.path.exists(candidate) and candidate != volume_path:
+            return candidate
+    return os.path.join(folder, f"{stem}_mask.npy")
+
+
+def read_slice_image(image_path):
+    """读取图像，返回 (图像, 灰度映射)；体数据切片路径从内存映射中读取
+    
+    8位图像转换为RGB，灰度映射为None；16位（及浮点）灰度图保留原始精度，
+    返回 uint16 索引图和 (scale, offset)，显示时再经窗宽/窗位映射。
+    """
+    volume = parse_volume_slice(image_path)
+    if volume is not None:
+        return VolumeSource.open(volume[0]).slice_image(volume[1])
+    # ANYDEPTH 保留16位数据；与 IMREAD_UNCHANGED 不同，仍按EXIF方向旋转
+    image = read_image_file(image_path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
+    if image is None:
+        return None, None
+    if image.ndim == 2:
+        if image.dtype == np.uint8:
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB), None
+        return to_intensity_image(image)
+    if image.dtype != np.uint8:
+        image = (image.astype(np.float32) * (255.0 / np.iinfo(image.dtype).max
+                                             if image.dtype.kind in "ui" else 255.0)).clip(0, 255).astype(np.uint8)
+    code = cv2.COLOR_BGRA2RGB if image.shape[2] == 4 else cv2.COLOR_BGR2RGB
+    return cv2.cvtColor(image, code), None
+
+
+def mask_exists(mask_path):
+    volume = parse_volume_slice(mask_path)
+    if volume is not None:
+        return MaskVolume.get(volume[0]).exists()
+    return os.path.exists(mask_path)
+
+
+def read_mask(mask_path):
+    """读取mask；体数据切片路径从mask体数据中读取"""
+    volume = parse_volume_slice(mask_path)
+    if volume is not None:
+        return MaskVolume.get(volume[0]).read_slice(volume[1])
+    return read_mask_file(mask_path)
+
+
+def write_mask(path, mask):
+    """写入mask；体数据切片写回mask体数据，普通文件原子写入"""
+    volume = parse_volume_slice(path)
+    with PROFILER.stage("save"):
+        if volume is not None:
+            MaskVolume.get(volume[0]).write_slice(volume[1], mask)
+        else:
+            write_mask_atomic(path, mask)
+
+
+def load_slice(image_path, mask_path, mask_writer=None):
+    """解码一组图像/mask（含BGR到RGB的转换），可在后台线程中调用
+    
+    16位灰度图保留为 uint16 索引图，intensity 为其灰度映射 (scale, offset)，8位图像为None。
+    不直接输出日志，错误信息放在返回结果中，由界面线程统一打印。
+    如果 mask_writer 中还有该mask尚未写入磁盘的版本，则直接使用该版本。
+    mask以 CompactMask 形式返回，缓存多张切片时只占很少内存；从磁盘读取的mask
+    同时返回内容哈希 mask_digest，用于判断之后的修改是否需要写回。
+    """
+    entry = {"image": None, "intensity": None, "mask": None, "mask_path": mask_path,
+             "mask_state": "missing", "mask_digest": None, "error": None, "nbytes": 0}
+    try:
+        with PROFILER.stage("decode_image"):
+            image, intensity = read_slice_image(image_path)
+    except Exception as e:
+        entry["error"] = str(e)
+        return entry
+    if image is None:
+        return entry
+    entry["image"] = image
+    entry["intensity"] = intensity
+    entry["nbytes"] = entry["image"].nbytes
+    
+    unsaved = mask_writer.latest(mask_path) if mask_writer and mask_path else None
+    if unsaved is not None:
+        entry["mask"] = CompactMask.from_array(unsaved)
+        entry["mask_state"] = "ok"
+        entry["nbytes"] += entry["mask"].nbytes
+        return entry
+    # mask体数据未能打开时 mask_exists 也会出错，与读取失败一样按损坏处理
+    try:
+        if not (mask_path and mask_exists(mask_path)):
+            return entry
+        with PROFILER.stage("decode_mask"):
+            mask = read_mask(mask_path)
+    except Exception as e:
+        entry["error"] = str(e)
+        mask = None
+    if mask is None:
+        entry["mask_state"] = "corrupt"
+    else:
+        entry["mask"] = CompactMask.from_array(mask)
+        entry["mask_state"] = "ok"
+        entry["mask_digest"] = mask_digest(mask)
+        entry["nbytes"] += entry["mask"].nbytes
+    return entry
+
+
+def write_mask_atomic(path, mask, codec=None):
+    """原子写入mask：先写到同目录下的临时文件，再重命名覆盖目标文件
+    
+    写入中途崩溃时只会留下临时文件，已有的mask不会被损坏。codec 默认为 MASK_CODEC。
+    """
+    save_dir = os.path.dirname(path)
+    if save_dir and not os.path.exists(save_dir):
+        os.makedirs(save_dir, exist_ok=True)
+    
+    # 按目标扩展名确定保存格式（临时文件扩展名为.tmp，不会被文件夹扫描到）
+    data = (codec or MASK_CODEC).encode(mask, os.path.splitext(path)[1])
+    tmp_path = os.path.join(save_dir, f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            # 自己写文件，支持中文路径
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def mask_digest(mask):
+    """mask内容的哈希（包含尺寸和数据类型），用于判断mask是否真正被修改"""
+    mask = np.ascontiguousarray(mask)
+    h = hashlib.blake2b(f"{mask.shape}{mask.dtype.str}".encode("ascii"), digest_size=16)
+    h.update(mask.data)
+    return h.hexdigest()
+
+
+class MaskChanges:
+    """mask变更跟踪（线程安全）
+    
+    saved 记录每个mask在磁盘上的内容哈希（文件不存在为None，未知的路径视为总是需要写入）；
+    edited 保存尚未写入磁盘的修改版本（CompactMask），切换图像后修改仍保留在内存中。
+    内容与磁盘上相同的mask不算修改，保存时会被跳过，文件不会被重写。
+    """
+    
+    UNKNOWN = object()
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.saved = {}   # 路径 -> 磁盘上内容的哈希
+        self.edited = {}  # 路径 -> (CompactMask, 哈希)
+    
+    def remember(self, path, digest):
+        """记录从磁盘读到的内容哈希；已有记录时不覆盖（读取结果可能比最近一次写入旧）"""
+        with self.lock:
+            self.saved.setdefault(path, digest)
+    
+    def set_saved(self, path, digest):
+        """mask已写入磁盘：更新哈希，内存中相同内容的修改版本不再需要保存"""
+        with self.lock:
+            self.saved[path] = digest
+            edited = self.edited.get(path)
+            if edited is not None and edited[1] == digest:
+                del self.edited[path]
+    
+    def is_changed(self, path, digest):
+        """内容与磁盘上的版本不同（或磁盘上的版本未知）时返回True"""
+        with self.lock:
+            return self.saved.get(path, self.UNKNOWN) != digest
+    
+    def keep(self, path, mask):
+        """在内存中保留修改后的mask；内容与磁盘上相同时（例如全部撤销）丢弃"""
+        digest = mask_digest(mask)
+        with self.lock:
+            if self.saved.get(path, self.UNKNOWN) == digest:
+                self.edited.pop(path, None)
+                return False
+            self.edited[path] = (CompactMask.from_array(mask), digest)
+            return True
+    
+    def get(self, path):
+        """返回内存中未保存的修改版本（稠密数组），没有则返回None"""
+        with self.lock:
+            edited = self.edited.get(path)
+        return None if edited is None else edited[0].to_array()
+    
+    def discard(self, path):
+        with self.lock:
+            self.edited.pop(path, None)
+    
+    def dirty_paths(self):
+        with self.lock:
+            return list(self.edited)
+    
+    def __len__(self):
+        with self.lock:
+            return len(self.edited)
+
+
+class MaskWriter:
+    """后台mask写入线程
+    
+    同一路径的多次保存请求会被合并，只写入最后一次提交的内容；请求在 delay 秒内
+    没有更新时才写入，也可以通过 flush 立即写入。写入使用 write_mask（普通文件为原子写入）。
+    workers 个线程并行写入不同路径，同一路径同一时刻只有一个线程在写。
+    指定 changes 时，内容与磁盘上相同的mask不会被重写，写入成功后更新其中的哈希。
+    写入线程不输出日志，错误记录在 errors 中由界面线程读取。
+    """
+    
+    def __init__(self, delay=0.5, workers=1, changes=None):
+        self.delay = delay
+        self.changes = changes
+        self.pending = {}   # 路径 -> (mask, 最早写入时间)
+        self.writing = {}   # 路径 -> 正在写入的mask
+        self.versions = {}  # 路径 -> 提交次数，用于判断读到的文件是否已过期
+        self.results = {}   # 路径 -> 最近一次写入的错误信息（成功为None）
+        self.errors = deque()
+        self.written = 0    # 实际写入的次数
+        self.skipped = 0    # 内容未变化而跳过的次数
+        self.cond = threading.Condition()
+        self.closed = False
+        self.threads = [threading.Thread(target=self.run, name=f"MaskWriter-{i}", daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+    
+    def submit(self, path, mask, delay=None):
+        """提交保存请求，mask 由调用方保证之后不再修改"""
+        with self.cond:
+            delay = self.delay if delay is None else delay
+            self.pending[path] = (mask, time.monotonic() + delay)
+            self.versions[path] = self.versions.get(path, 0) + 1
+            self.cond.notify_all()
+    
+    def version(self, path):
+        with self.cond:
+            return self.versions.get(path, 0)
+    
+    def latest(self, path):
+        """返回尚未写入磁盘（排队或正在写入）的最新mask，没有则返回None"""
+        with self.cond:
+            if path in self.pending:
+                return self.pending[path][0]
+            return self.writing.get(path)
+    
+    def is_busy(self, path=None):
+        if path is None:
+            return bool(self.pending or self.writing)
+        return path in self.pending or path in self.writing
+    
+    def flush(self, path=None, wait=True):
+        """立即写入指定路径（默认全部）的待保存mask，wait为True时等待写入完成
+        
+        返回最近一次写入的错误信息，成功时为None。
+        """
+        with self.cond:
+            for key, (mask, _) in list(self.pending.items()):
+                if path is None or key == path:
+                    self.pending[key] = (mask, 0)
+            self.cond.notify_all()
+            if wait:
+                while self.is_busy(path):
+                    self.cond.wait()
+            return self.results.get(path) if path is not None else None
+    
+    def close(self):
+        """写入全部待保存的mask并结束写入线程"""
+        with self.cond:
+            self.closed = True
+        self.flush()
+        with self.cond:
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+    
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    # 正在被其他线程写入的路径要等那次写入结束
+                    waiting = [(p, deadline) for p, (_, deadline) in self.pending.items()
+                               if p not in self.writing]
+                    due = [p for p, deadline in waiting if deadline <= now or self.closed]
+                    if due:
+                        break
+                    if self.closed and not self.pending:
+                        return
+                    timeout = None
+                    if waiting:
+                        timeout = min(deadline for _, deadline in waiting) - now
+                    self.cond.wait(timeout)
+                path = due[0]
+                mask, _ = self.pending.pop(path)
+                self.writing[path] = mask
+            
+            error = None
+            written = False
+            try:
+                digest = mask_digest(mask) if self.changes is not None else None
+                if digest is None or self.changes.is_changed(path, digest):
+                    write_mask(path, mask)
+                    written = True
+                if digest is not None:
+                    self.changes.set_saved(path, digest)
+            except Exception as e:
+                error = str(e)
+            
+            with self.cond:
+                del self.writing[path]
+                self.results[path] = error
+                if error is not None:
+                    self.errors.append((path, error))
+                elif written:
+                    self.written += 1
+                else:
+                    self.skipped += 1
+                self.cond.notify_all()
+
+
+def file_stem(path):
+    """文件名去掉目录和扩展名"""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class MaskIndex:
+    """mask文件名索引，用于图像与mask的配对
+    
+    文件名（不含扩展名）完全相同时通过字典O(1)匹配；否则保留原有的子串模糊匹配：
+    mask名包含于图像名时只查找图像名中长度可能匹配的子串，图像名包含于mask名时
+    在拼接好的文件名文本上做一次C层面的查找。模糊匹配返回排序后最靠前的mask。
+    """
+    
+    SEPARATOR = "\0"  # 文件名中不可能出现的字符
+    
+    def __init__(self, mask_files):
+        self.paths = sorted(mask_files)
+        self.stems = [file_stem(p) for p in self.paths]
+        
+        # 文件名 -> 第一个同名mask的下标
+        self.by_stem = {}
+        for i, stem in enumerate(self.stems):
+            self.by_stem.setdefault(stem, i)
+        self.stem_lengths = sorted({len(stem) for stem in self.stems})
+        
+        # 所有文件名按顺序拼接，记录每个文件名的起始偏移
+        self.starts = []
+        parts = []
+        offset = 1
+        for stem in self.stems:
+            self.starts.append(offset)
+            parts.append(stem)
+            offset += len(stem) + 1
+        self.text = self.SEPARATOR + self.SEPARATOR.join(parts) + self.SEPARATOR
+    
+    def __len__(self):
+        return len(self.paths)
+    
+    def find(self, image_path):
+        """返回与图像对应的mask路径，找不到时返回None"""
+        if not self.paths:
+            return None
+        image_name = file_stem(image_path)
+        
+        # 文件名完全一致
+        index = self.by_stem.get(image_name)
+        if index is not None:
+            return self.paths[index]
+        
+        best = None
+        # 图像名包含在mask名中
+        pos = self.text.find(image_name) if image_name else -1
+        if pos >= 0:
+            best = bisect_right(self.starts, pos) - 1
+        
+        # mask名包含在图像名中：只检查已有mask名长度对应的子串
+        n = len(image_name)
+        for length in self.stem_lengths:
+            if length > n:
+                break
+            for start in range(n - length + 1):
+                index = self.by_stem.get(image_name[start:start + length])
+                if index is not None and (best is None or index < best):
+                    best = index
+        
+        return None if best is None else self.paths[best]
+
+
+def pair_images_with_masks(image_files, mask_index):
+    """为每个图像查找对应的mask，返回 [(图像路径, mask路径或None), ...]"""
+    return [(image_path, mask_index.find(image_path)) for image_path in image_files]
+
+
+class ByteLRUCache:
+    """按占用字节数限制容量的LRU缓存（线程安全）"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            self.entries.move_to_end(key)
+            return item[0]
+    
+    def put(self, key, value, nbytes):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self.entries[key] = (value, nbytes)
+            self.total_bytes += nbytes
+            # 超出容量时淘汰最久未使用的条目
+            while self.total_bytes > self.max_bytes:
+                _, (_, old_nbytes) = self.entries.popitem(last=False)
+                self.total_bytes -= old_nbytes
+    
+    def discard(self, key):
+        with self.lock:
+            item = self.entries.pop(key, None)
+            if item is not None:
+                self.total_bytes -= item[1]
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+    
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+    
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+def sample_view(src, origin, scale, box, interpolation=cv2.INTER_LINEAR):
+    """按视口变换对 src 重采样，只计算显示坐标下 box=(x0, y0, x1, y1) 区域的像素
+    
+    显示像素 (x, y) 的中心对应源图像坐标 (origin_x + (x + 0.5) / scale_x - 0.5, ...)，
+    与 cv2.resize 线性插值的像素中心对齐方式相同。只读取 box 覆盖的源区域，
+    耗时只与 box 大小有关，与源图像大小无关。标签图需使用 INTER_NEAREST，避免插值出不存在的标签。
+    """
+    src_h, src_w = src.shape[:2]
+    origin_x, origin_y = origin
+    inv_x, inv_y = 1.0 / scale[0], 1.0 / scale[1]
+    x0, y0, x1, y1 = box
+    
+    # box 对应的源图像范围（向外多取一个像素供插值使用）
+    fx0 = origin_x + (x0 + 0.5) * inv_x - 0.5
+    fy0 = origin_y + (y0 + 0.5) * inv_y - 0.5
+    fx1 = origin_x + (x1 - 0.5) * inv_x - 0.5
+    fy1 = origin_y + (y1 - 0.5) * inv_y - 0.5
+    sx0 = min(max(0, int(np.floor(fx0)) - 1), src_w - 1)
+    sy0 = min(max(0, int(np.floor(fy0)) - 1), src_h - 1)
+    sx1 = max(min(src_w, int(np.ceil(fx1)) + 2), sx0 + 1)
+    sy1 = max(min(src_h, int(np.ceil(fy1)) + 2), sy0 + 1)
+    crop = src[sy0:sy1, sx0:sx1]
+    
+    # 目标像素 (x, y) -> 裁剪后源坐标
+    matrix = np.array([[inv_x, 0, fx0 - sx0],
+                       [0, inv_y, fy0 - sy0]], dtype=np.float64)
+    return cv2.warpAffine(crop, matrix, (x1 - x0, y1 - y0),
+                          flags=interpolation | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+
+def image_box_to_view(box, view):
+    """将原图坐标下的矩形区域换算为视口中受影响的显示区域（向外取整并裁剪到显示范围）"""
+    origin_x, origin_y = view["origin"]
+    scale_x, scale_y = view["scale"]
+    width, height = view["size"]
+    x0, y0, x1, y1 = box
+    return (max(0, int(np.floor((x0 - 1 - origin_x) * scale_x)) - 1),
+            max(0, int(np.floor((y0 - 1 - origin_y) * scale_y)) - 1),
+            min(width, int(np.ceil((x1 + 1 - origin_x) * scale_x)) + 1),
+            min(height, int(np.ceil((y1 + 1 - origin_y) * scale_y)) + 1))
+
+
+class ImagePyramid:
+    """按需逐级构建的图像金字塔（每级长宽减半）
+    
+    第 k 级的像素 j 恰好覆盖原图的 [j * 2^k, (j + 1) * 2^k) 范围，缩小显示时
+    从分辨率最接近且不低于显示分辨率的一级重采样，既快又能减少混叠。
+    """
+    
+    def __init__(self, image):
+        self.image = image
+        self.levels = [image]
+    
+    def level_for_scale(self, scale):
+        """返回 (层级图像, 该层相对原图的缩小倍数)"""
+        level = 0
+        while scale * 2 ** (level + 1) <= 1.0 + 1e-9:
+            if level + 1 >= len(self.levels) and not self.build_next():
+                break
+            level += 1
+        return self.levels[level], 2 ** level
+    
+    def build_next(self):
+        """构建下一级，图像已经很小时返回False"""
+        prev = self.levels[-1]
+        h, w = prev.shape[:2]
+        if min(h, w) < 2:
+            return False
+        # 奇数边长先复制边缘补齐，保证每级严格缩小一半
+        if h % 2 or w % 2:
+            prev = cv2.copyMakeBorder(prev, 0, h % 2, 0, w % 2, cv2.BORDER_REPLICATE)
+        self.levels.append(cv2.resize(prev, ((w + 1) // 2, (h + 1) // 2), interpolation=cv2.INTER_AREA))
+        return True
+
+
+def contour_boxes(contours):
+    """轮廓外接矩形数组，每行为 (x0, y0, x1, y1)（右下角不含）"""
+    boxes = np.zeros((len(contours), 4), dtype=np.int64)
+    for i, contour in enumerate(contours):
+        x, y, w, h = cv2.boundingRect(contour)
+        boxes[i] = (x, y, x + w, y + h)
+    return boxes
+
+
+class ContourCache:
+    """叠加画面的轮廓缓存（显示分辨率）
+    
+    保存每个连通域的外轮廓及其外接矩形，并维护已绘制好的轮廓图层。mask局部修改后，
+    只重新提取与修改区域相连的连通域的轮廓，其余轮廓和图层内容直接复用，
+    耗时与修改涉及的连通域大小成正比，而不是与整张mask成正比。
+    结果与对整张mask调用 findContours(RETR_EXTERNAL) 后绘制完全一致。
+    """
+    
+    def __init__(self, mask, thickness=2):
+        self.source = mask  # 与缓存同步的mask数组
+        self.thickness = thickness
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        self.contours = list(contours)
+        self.boxes = contour_boxes(self.contours)
+        self.layer = np.zeros(mask.shape[:2], dtype=np.uint8)
+        cv2.drawContours(self.layer, self.contours, -1, 255, thickness)
+    
+    def update(self, box):
+        """source 在 box=(x0, y0, x1, y1) 内被修改后调用，返回轮廓图层发生变化的区域"""
+        mask = self.source
+        H, W = mask.shape[:2]
+        # 8连通下修改区域外一圈的像素也可能与修改区域相连
+        x0, y0 = max(0, box[0] - 1), max(0, box[1] - 1)
+        x1, y1 = min(W, box[2] + 1), min(H, box[3] + 1)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        
+        # 与修改区域相交的连通域，其新的形状只可能在 U = 修改区域 ∪ 这些连通域的外接矩形 内
+        boxes = self.boxes
+        hit = ((boxes[:, 0] < x1) & (boxes[:, 2] > x0) &
+               (boxes[:, 1] < y1) & (boxes[:, 3] > y0))
+        ux0 = min([x0] + boxes[hit, 0].tolist())
+        uy0 = min([y0] + boxes[hit, 1].tolist())
+        ux1 = max([x1] + boxes[hit, 2].tolist())
+        uy1 = max([y1] + boxes[hit, 3].tolist())
+        
+        # 完全位于 U 内的旧连通域全部重新计算，其余连通域保持不变
+        inside = ((boxes[:, 0] >= ux0) & (boxes[:, 1] >= uy0) &
+                  (boxes[:, 2] <= ux1) & (boxes[:, 3] <= uy1))
+        removed = [c for c, flag in zip(self.contours, inside) if flag]
+        kept = [c for c, flag in zip(self.contours, inside) if not flag]
+        kept_boxes = boxes[~inside]
+        
+        # 在向外扩展一个像素的裁剪区域上提取轮廓；碰到裁剪边界的连通域延伸到了 U 之外，
+        # 属于未修改的连通域，已在 kept 中
+        cx0, cy0 = max(0, ux0 - 1), max(0, uy0 - 1)
+        cx1, cy1 = min(W, ux1 + 1), min(H, uy1 + 1)
+        crop = np.ascontiguousarray(mask[cy0:cy1, cx0:cx1])
+        found, _ = cv2.findContours(crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(cx0, cy0))
+        found_boxes = contour_boxes(found)
+        added = []
+        for contour, (bx0, by0, bx1, by1) in zip(found, found_boxes):
+            if ((bx0 == cx0 and cx0 > 0) or (by0 == cy0 and cy0 > 0) or
+                    (bx1 == cx1 and cx1 < W) or (by1 == cy1 and cy1 < H)):
+                continue
+            # 位于未修改连通域的孔洞内时，不属于外轮廓
+            point = (float(contour[0, 0, 0]), float(contour[0, 0, 1]))
+            enclosed = False
+            for other, (ox0, oy0, ox1, oy1) in zip(kept, kept_boxes):
+                if (ox0 <= bx0 and oy0 <= by0 and ox1 >= bx1 and oy1 >= by1 and
+                        cv2.pointPolygonTest(other, point, False) > 0):
+                    enclosed = True
+                    break
+            if not enclosed:
+                added.append(contour)
+        
+        if not removed and not added:
+            return None
+        self.contours = kept + added
+        self.boxes = np.concatenate([kept_boxes, contour_boxes(added)])
+        
+        # 重绘轮廓图层中受影响的区域（线宽会使轮廓向外扩展）
+        changed = np.concatenate([boxes[inside], contour_boxes(added)])
+        t = self.thickness
+        gx0, gy0 = max(0, int(changed[:, 0].min()) - t), max(0, int(changed[:, 1].min()) - t)
+        gx1, gy1 = min(W, int(changed[:, 2].max()) + t), min(H, int(changed[:, 3].max()) + t)
+        near = ((self.boxes[:, 0] - t < gx1) & (self.boxes[:, 2] + t > gx0) &
+                (self.boxes[:, 1] - t < gy1) & (self.boxes[:, 3] + t > gy0))
+        # 粗线被画布边界裁剪时光栅化结果会变化，因此在能完整容纳这些轮廓的画布上绘制后再拷回
+        px0, py0 = gx0, gy0
+        px1, py1 = gx1, gy1
+        if near.any():
+            px0 = min(px0, max(0, int(self.boxes[near, 0].min()) - t))
+            py0 = min(py0, max(0, int(self.boxes[near, 1].min()) - t))
+            px1 = max(px1, min(W, int(self.boxes[near, 2].max()) + t))
+            py1 = max(py1, min(H, int(self.boxes[near, 3].max()) + t))
+        patch = np.zeros((py1 - py0, px1 - px0), dtype=np.uint8)
+        cv2.drawContours(patch, [c for c, flag in zip(self.contours, near) if flag], -1, 255, t,
+                         offset=(-px0, -py0))
+        self.layer[gy0:gy1, gx0:gx1] = patch[gy0 - py0:gy1 - py0, gx0 - px0:gx1 - px0]
+        return (gx0, gy0, gx1, gy1)
+
+
+def default_overlay_palette():
+    """默认叠加调色板：mask值 v 对应红色 (v, 0, 0)，插值产生的边缘灰度会得到较淡的红色"""
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[:, 0] = np.arange(256)
+    return palette
+
+
+def label_palette():
+    """多标签调色板：标签0不着色，其余标签按黄金角取色相，相邻标签颜色差异明显"""
+    hues = (np.arange(256) * 0.618033988749895 % 1.0 * 180).astype(np.uint8)
+    hsv = np.stack([hues, np.full(256, 220, np.uint8), np.full(256, 255, np.uint8)], axis=1)
+    palette = cv2.cvtColor(hsv[None], cv2.COLOR_HSV2RGB)[0]
+    palette[0] = 0
+    return palette
+
+
+LABEL_PALETTE = label_palette()
+
+
+def label_display_index(labels):
+    """把标签图转换为调色板索引（uint8）：8位标签直接使用，16位标签按 (标签-1) % 255 + 1 循环取色"""
+    if labels.dtype == np.uint8:
+        return labels
+    index = (labels.astype(np.int64) - 1) % 255 + 1
+    index[labels == 0] = 0
+    return index.astype(np.uint8)
+
+
+def label_areas(mask, chunk_pixels=1 << 22):
+    """统计每个标签的像素面积，返回 {标签: 像素数}（不含背景0）
+    
+    对整张标签图做一次 bincount（分块进行以限制临时内存），耗时与标签数量无关。
+    """
+    flat = mask.reshape(-1)
+    if flat.size == 0:
+        return {}
+    counts = np.zeros(int(flat.max()) + 1, dtype=np.int64)
+    for start in range(0, flat.size, chunk_pixels):
+        counts += np.bincount(flat[start:start + chunk_pixels], minlength=counts.size)
+    labels = np.flatnonzero(counts[1:]) + 1
+    return dict(zip(labels.tolist(), counts[labels].tolist()))
+
+
+class OverlayCompositor:
+    """预分配缓冲区的叠加画面合成器
+    
+    先把图像复制到输出缓冲区，再只在mask非零像素的外接矩形内按调色板着色、
+    与图像按 alpha 混合，并以mask为掩码写回输出，最后以轮廓图层为掩码写入绿色轮廓。
+    调色板为 256 x 3 的查找表（mask值 -> 颜色），多标签mask无需逐标签处理。
+    所有中间结果都写入预分配的缓冲区（OpenCV 的 dst 参数），缓冲区只在显示尺寸变化时重新分配；
+    stats() 返回的计数可用于衡量每帧的分配次数。
+    """
+    
+    CONTOUR_COLOR = (0, 255, 0)  # 绿色轮廓
+    
+    def __init__(self, palette=None):
+        self.set_palette(default_overlay_palette() if palette is None else palette)
+        self.shape = None
+        self.frames = 0
+        self.allocations = 0
+    
+    def set_palette(self, palette):
+        """更换调色板（256 x 3，mask值 -> RGB颜色）"""
+        palette = np.asarray(palette, dtype=np.uint8)
+        self.channel_luts = [np.ascontiguousarray(palette[:, c]) for c in range(3)]
+    
+    def allocate(self, h, w):
+        self.out = np.empty((h, w, 3), dtype=np.uint8)
+        self.colored = np.empty((h, w, 3), dtype=np.uint8)
+        self.blended = np.empty((h, w, 3), dtype=np.uint8)
+        self.channels = [np.empty((h, w), dtype=np.uint8) for _ in range(3)]
+        self.contour_fill = np.empty((h, w, 3), dtype=np.uint8)
+        self.contour_fill[:] = self.CONTOUR_COLOR
+        self.shape = (h, w)
+        self.allocations += 7
+    
+    def compose(self, image, mask, contour_layer, alpha, box=None):
+        """合成叠加画面，box=(x0, y0, x1, y1) 时只合成该区域；返回输出缓冲区中对应区域的视图
+        
+        image、mask、contour_layer 均为完整的显示尺寸数组。输出缓冲区在帧之间复用，
+        调用方需要保留结果时应自行复制。
+        """
+        h, w = mask.shape[:2]
+        if self.shape != (h, w):
+            self.allocate(h, w)
+        
+        x0, y0, x1, y1 = (0, 0, w, h) if box is None else box
+        out = self.out[y0:y1, x0:x1]
+        np.copyto(out, image[y0:y1, x0:x1])
+        
+        # 只在mask非零像素的外接矩形内着色和混合
+        bx, by, bw, bh = cv2.boundingRect(mask[y0:y1, x0:x1])
+        if bw > 0 and bh > 0:
+            region = (slice(y0 + by, y0 + by + bh), slice(x0 + bx, x0 + bx + bw))
+            labels = mask[region]
+            channels = [channel[region] for channel in self.channels]
+            for lut, channel in zip(self.channel_luts, channels):
+                cv2.LUT(labels, lut, dst=channel)
+            colored = cv2.merge(channels, dst=self.colored[region])
+            blended = cv2.addWeighted(image[region], 1 - alpha, colored, alpha, 0, dst=self.blended[region])
+            cv2.copyTo(blended, labels, dst=self.out[region])
+        
+        # 绘制轮廓
+        cv2.copyTo(self.contour_fill[y0:y1, x0:x1], contour_layer[y0:y1, x0:x1], dst=out)
+        
+        self.frames += 1
+        return out
+    
+    def stats(self):
+        """合成帧数与缓冲区分配次数"""
+        return {"frames": self.frames, "allocations": self.allocations}
+
+
+def photo_put_region(interp, photo, patch, x, y):
+    """将 numpy 数组原地写入 PhotoImage 的 (x, y) 位置，不重建整张图片
+
+    Pillow 的 ImageTk.PhotoImage.paste 已不支持 box 参数，这里直接调用
+    Tk photo 的 put -to 命令，数据以二进制 PPM/PGM 格式传入。
+    """
+    interp.call(str(photo), "put", ppm_data(patch), "-format", "ppm", "-to", x, y)
+
+
+def ppm_data(patch):
+    """uint8 灰度/RGB 数组编码为二进制 PGM/PPM 数据"""
+    patch = np.ascontiguousarray(patch)
+    h, w = patch.shape[:2]
+    magic = b"P6" if patch.ndim == 3 else b"P5"
+    return b"%s %d %d 255\n" % (magic, w, h) + patch.tobytes()
+
+
+class MaskSession:
+    """与界面无关的编辑引擎：持有一张切片的图像、mask和撤销记录，负责笔画和叠加画面的渲染
+    
+    图形界面和网页编辑服务都通过它编辑mask。坐标分为原图坐标和显示坐标：调用方用 set_view
+    设置视口（origin/scale/size，与 sample_view 相同）和视口内的显示图像，之后的修改都先
+    返回原图坐标下的区域，由 render 重新采样该区域、更新轮廓并局部合成叠加画面 frame。
+    不依赖Tk、不输出日志；同一会话的方法由调用方保证串行调用。
+    """
+    
+    def __init__(self, entry, mask=None, compositor=None, undo_bytes=128 * 1024 * 1024):
+        self.image = entry["image"]
+        self.intensity = entry.get("intensity")
+        self.mask_path = entry.get("mask_path")
+        self.mask_state = entry["mask_state"]
+        self.mask_digest = entry.get("mask_digest")
+        h, w = self.image.shape[:2]
+        if mask is None:
+            mask = entry["mask"].to_array() if entry["mask_state"] == "ok" else np.zeros((h, w), np.uint8)
+        self.mask = mask
+        self.source = entry["mask_state"]  # ok/corrupt/missing，使用内存中的修改时为 edited
+        self.modified = False  # 自加载或保存以来是否被修改过
+        self.undo_history = UndoHistory(max_bytes=undo_bytes)
+        self.stroke_open = False
+        self.pyramid = None
+        
+        # 显示状态：视口、视口内的显示图像和mask、轮廓缓存与叠加画面（frame 为None表示未合成）
+        self.compositor = compositor or OverlayCompositor()
+        self.set_label_mode(mask.dtype != np.uint8)
+        self.alpha = 0.5
+        self.view = None
+        self.display_image = None
+        self.display_mask = None
+        self.contours = None
+        self.frame = None
+        # 供增量传输使用：sent 为客户端已持有的画面，dirty_box 为之后重新合成过的显示区域
+        self.tile_size = 64
+        self.sent = None
+        self.dirty_box = None
+    
+    @classmethod
+    def from_entry(cls, entry, changes=None, compositor=None):
+        """按 load_slice 的结果创建会话，优先使用 changes 中保留的未保存修改
+        
+        同时在 changes 中记录磁盘上mask的内容哈希；取出的修改由会话持有，不再重复保留在 changes 中。
+        """
+        mask_path = entry.get("mask_path")
+        edited = None
+        if changes is not None and mask_path:
+            if entry["mask_state"] == "ok" and entry.get("mask_digest") is not None:
+                changes.remember(mask_path, entry["mask_digest"])
+            elif entry["mask_state"] == "missing":
+                changes.remember(mask_path, None)
+            edited = changes.get(mask_path)
+        session = cls(entry, mask=edited, compositor=compositor)
+        if edited is not None:
+            changes.discard(mask_path)
+            session.source = "edited"
+            session.modified = True
+        return session
+    
+    def set_label_mode(self, label_mode):
+        """切换二值/多标签显示：更换叠加调色板，之后需要整体重新采样mask"""
+        self.label_mode = label_mode
+        self.compositor.set_palette(LABEL_PALETTE if label_mode else default_overlay_palette())
+    
+    def widen_for_label(self, label):
+        """8位mask放不下 label 时转换为16位标签图，发生转换时返回True"""
+        if label <= np.iinfo(self.mask.dtype).max:
+            return False
+        self.mask = self.mask.astype(np.uint16)
+        return True
+    
+    # ---- 视口与渲染 ----
+    
+    def sample_image(self, view):
+        """从图像金字塔中选择合适的层级，只重采样视口内的图像（16位灰度图为原始灰度）"""
+        with PROFILER.stage("resize"):
+            if self.pyramid is None:
+                self.pyramid = ImagePyramid(self.image)
+            level, factor = self.pyramid.level_for_scale(min(view["scale"]))
+            origin, scale = view["origin"], view["scale"]
+            return sample_view(level, (origin[0] / factor, origin[1] / factor),
+                               (scale[0] * factor, scale[1] * factor), (0, 0) + tuple(view["size"]))
+    
+    def sample_mask(self, box):
+        """重采样mask的显示区域；多标签模式下用最近邻插值并转换为调色板索引"""
+        if self.label_mode:
+            labels = sample_view(self.mask, self.view["origin"], self.view["scale"], box, cv2.INTER_NEAREST)
+            return label_display_index(labels)
+        return sample_view(self.mask, self.view["origin"], self.view["scale"], box)
+    
+    def set_view(self, view, display_image):
+        """设置视口和视口内的显示图像（RGB），整体重新采样mask；叠加画面需重新合成"""
+        self.view = {"origin": view["origin"], "scale": view["scale"], "size": tuple(view["size"])}
+        self.display_image = display_image
+        with PROFILER.stage("resize"):
+            self.display_mask = self.sample_mask((0, 0) + self.view["size"])
+        self.contours = None
+        self.frame = None
+    
+    def fit_display(self, view_size):
+        """整张图按比例缩放到 view_size 以内显示（16位灰度图按自动窗宽/窗位），并合成叠加画面"""
+        view = fit_view(self.image.shape, view_size)
+        display = self.sample_image(view)
+        if self.intensity is not None:
+            window = IntensityWindow()
+            window.auto(display, self.intensity)
+            display = window.apply(display, self.intensity)
+        self.set_view(view, display)
+        self.compose()
+    
+    def compose(self):
+        """合成整个叠加画面；显示mask未变化（如只调整透明度）时复用轮廓缓存"""
+        if self.contours is None or self.contours.source is not self.display_mask:
+            with PROFILER.stage("contours"):
+                self.contours = ContourCache(self.display_mask)
+        with PROFILER.stage("overlay"):
+            self.frame = self.compositor.compose(self.display_image, self.display_mask,
+                                                 self.contours.layer, self.alpha)
+        return self.frame
+    
+    def clear_overlay(self):
+        """不显示叠加画面时丢弃轮廓缓存，之后的局部刷新不再更新轮廓"""
+        self.contours = None
+        self.frame = None
+    
+    def render(self, box):
+        """局部刷新：只重采样 box（原图坐标）影响到的显示区域，更新轮廓并重新合成叠加画面
+        
+        返回 (mask区域, 叠加区域)，均为显示坐标；叠加区域包含轮廓变化的范围，未合成叠加画面时为None。
+        box 不在视口内时返回None。
+        """
+        if self.view is None:
+            return None
+        x0, y0, x1, y1 = image_box_to_view(box, self.view)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        with PROFILER.stage("resize_region"):
+            self.display_mask[y0:y1, x0:x1] = self.sample_mask((x0, y0, x1, y1))
+        mask_box = (x0, y0, x1, y1)
+        if self.frame is None:
+            return mask_box, None
+        
+        # 只重新提取与修改区域相连的连通域的轮廓，重绘范围为mask修改区域与轮廓变化区域的并集
+        with PROFILER.stage("contours_region"):
+            changed = self.contours.update(mask_box)
+        if changed is not None:
+            x0, y0 = min(x0, changed[0]), min(y0, changed[1])
+            x1, y1 = max(x1, changed[2]), max(y1, changed[3])
+        with PROFILER.stage("overlay_region"):
+            self.compositor.compose(self.display_image, self.display_mask, self.contours.layer,
+                                    self.alpha, (x0, y0, x1, y1))
+        if self.dirty_box is not None:
+            dx0, dy0, dx1, dy1 = self.dirty_box
+            self.dirty_box = (min(x0, dx0), min(y0, dy0), max(x1, dx1), max(y1, dy1))
+        else:
+            self.dirty_box = (x0, y0, x1, y1)
+        return mask_box, (x0, y0, x1, y1)
+    
+    def to_image(self, x, y, view=None):
+        """显示坐标转换为原图坐标，超出图像范围时返回None；view 默认为当前视口"""
+        view = view or self.view
+        h, w = self.mask.shape[:2]
+        img_x = int(np.floor(view["origin"][0] + x / view["scale"][0]))
+        img_y = int(np.floor(view["origin"][1] + y / view["scale"][1]))
+        if 0 <= img_x < w and 0 <= img_y < h:
+            return (img_x, img_y)
+        return None
+    
+    # ---- 编辑 ----
+    
+    def begin_stroke(self):
+        self.undo_history.begin()
+        self.stroke_open = True
+    
+    def draw(self, points, radius, value, select=None):
+        """在mask上绘制一段笔画（原图坐标），返回受影响区域；笔画结束前的多段合为一步撤销
+        
+        select(box) 返回该区域内允许修改的像素（布尔数组）时只修改这些像素，如阈值笔刷。
+        """
+        if not self.stroke_open:
+            self.begin_stroke()
+        box = stroke_bounds(points, radius)
+        with PROFILER.stage("stroke"):
+            self.undo_history.record(self.mask, box)
+            if select is None:
+                draw_stroke(self.mask, points, radius, value)
+            else:
+                h, w = self.mask.shape[:2]
+                x0, y0 = max(0, box[0]), max(0, box[1])
+                x1, y1 = min(w, box[2]), min(h, box[3])
+                if x0 < x1 and y0 < y1:
+                    box = (x0, y0, x1, y1)
+                    stamp = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+                    draw_stroke(stamp, [(x - x0, y - y0) for x, y in points], radius, 255)
+                    roi = self.mask[y0:y1, x0:x1]
+                    roi[(stamp > 0) & select(box)] = value
+        self.modified = True
+        return box
+    
+    def end_stroke(self):
+        """结束当前笔画，作为一步撤销记录；返回笔画是否修改了mask"""
+        if not self.stroke_open:
+            return False
+        self.stroke_open = False
+        return self.undo_history.commit(self.mask)
+    
+    def stroke(self, points, radius, value, last_point=None):
+        """绘制一段显示坐标下的笔画并立即渲染，从 last_point（原图坐标）接着画
+        
+        返回这段笔画的最后一个点，供下一段衔接；移出图像范围时笔画断开。
+        """
+        segment = [] if last_point is None else [last_point]
+        for x, y in points:
+            point = self.to_image(x, y)
+            if point is None:
+                self.draw_segment(segment, radius, value)
+                segment = []
+            else:
+                segment.append(point)
+        self.draw_segment(segment, radius, value)
+        return segment[-1] if segment else None
+    
+    def draw_segment(self, points, radius, value):
+        if points:
+            self.render(self.draw(points, radius, value))
+    
+    def apply(self, box, update):
+        """对 box（原图坐标）内的mask调用 update(roi) 原地修改，作为一步撤销记录；返回mask是否改变"""
+        x0, y0, x1, y1 = box
+        self.undo_history.begin()
+        self.undo_history.record(self.mask, box)
+        update(self.mask[y0:y1, x0:x1])
+        if not self.undo_history.commit(self.mask):
+            return False
+        self.modified = True
+        return True
+    
+    def undo(self):
+        """撤销上一步，返回恢复的区域（原图坐标），没有可撤销的操作时返回None"""
+        box = self.undo_history.undo(self.mask)
+        if box is not None:
+            self.modified = True
+        return box
+    
+    def redo(self):
+        box = self.undo_history.redo(self.mask)
+        if box is not None:
+            self.modified = True
+        return box
+    
+    # ---- 增量传输 ----
+    
+    def delta_message(self, full=False):
+        """编码变化的图块，没有变化时返回None；full 为True时编码整个画面（供新加入的客户端使用）
+        
+        消息格式："MMT1" + 图块数(uint32)，每个图块为 x, y, w, h(uint16) + 数据长度(uint32) + 数据，
+        均为小端序。数据为 zlib 压缩的 RGB 像素与客户端已有内容的按位异或，未变化的像素异或为0，
+        压缩后几乎不占空间；full 时与全黑画面异或，即原始像素。
+        """
+        if self.sent is None:
+            self.sent = self.frame.copy()
+            self.dirty_box = None
+        w, h = self.view["size"]
+        if full:
+            region = (0, 0, w, h)
+        else:
+            region = self.dirty_box
+            self.dirty_box = None
+            if region is None:
+                return None
+        tile = self.tile_size
+        parts = []
+        for ty in range(region[1] // tile * tile, region[3], tile):
+            for tx in range(region[0] // tile * tile, region[2], tile):
+                current = self.frame[ty:ty + tile, tx:tx + tile]
+                if full:
+                    delta = current
+                else:
+                    previous = self.sent[ty:ty + tile, tx:tx + tile]
+                    delta = cv2.bitwise_xor(current, previous)
+                    if not delta.any():
+                        continue
+                    np.copyto(previous, current)
+                data = zlib.compress(np.ascontiguousarray(delta).tobytes(), 1)
+                parts.append(struct.pack("<HHHHI", tx, ty, current.shape[1], current.shape[0], len(data)) + data)
+        if not parts and not full:
+            return None
+        return b"MMT1" + struct.pack("<I", len(parts)) + b"".join(parts)
+
+
+def log_level_for(message):
+    """根据消息前缀推断日志级别，界面中的 print 消息沿用 "错误:"/"警告:" 等前缀"""
+    if message.startswith("错误") or "失败" in message:
+        return logging.ERROR
+    if message.startswith("警告"):
+        return logging.WARNING
+    return logging.INFO
+
+
+class LoggerWriter:
+    """替代 sys.stdout 的文件对象：把 print 的输出按行转发给 logger
+    
+    每个线程各自缓存未结束的行，工作线程中的 print 不会与界面线程的输出交错。
+    """
+    
+    def __init__(self, target):
+        self.target = target
+        self.local = threading.local()
+    
+    def write(self, message):
+        buffer = getattr(self.local, "buffer", "") + message
+        *lines, self.local.buffer = buffer.split("\n")
+        for line in lines:
+            if line.strip():  # 只记录非空消息
+                self.target.log(log_level_for(line), line)
+        return len(message)
+    
+    def flush(self):
+        pass
+
+
+class QueueLogSink(logging.Handler):
+    """把日志消息放入队列的 logging 处理器
+    
+    emit 可在任意线程中调用，只做一次入队；界面线程定期调用 drain 批量取出后写入日志框。
+    """
+    
+    def __init__(self, level=logging.INFO):
+        super().__init__(level)
+        self.records = queue.SimpleQueue()
+        self.setFormatter(logging.Formatter("%(message)s"))
+    
+    def emit(self, record):
+        try:
+            self.records.put(self.format(record))
+        except Exception:
+            self.handleError(record)
+    
+    def drain(self, limit):
+        """取出排队中的全部消息，只保留最后 limit 条；返回 (消息列表, 丢弃条数)"""
+        lines = deque(maxlen=limit)
+        total = 0
+        while True:
+            try:
+                lines.append(self.records.get_nowait())
+            except queue.Empty:
+                break
+            total += 1
+        return list(lines), total - len(lines)
+
 
 class MaskCorrectionGUI:
     def __init__(self, root):
@@ -17,15 +2151,40 @@ class MaskCorrectionGUI:
         # 变量初始化
         self.image_folder = ""
         self.mask_folder = ""
+        self.volume_path = None  # 当前打开的体数据（切片按需从内存映射中读取）
+        self.mask_volume_path = None
         self.image_files = []
         self.mask_files = []
+        self.mask_index = MaskIndex([])
         self.current_index = 0
         
-        self.original_image = None
-        self.mask_image = None
+        # 当前切片的编辑会话：图像、mask、撤销记录以及视口内的显示mask和叠加画面
+        self.session = None
         self.display_image = None
         self.display_mask = None
-        self.current_mask_path = None  # 当前mask文件路径
+        
+        # 当前切片的显示缓存（视口内的图像、缩放比例、偏移和背景PhotoImage）
+        self.view_cache = None
+        
+        # 视口：zoom 为相对“适应窗口”的放大倍数，view_center 为视口中心的原图坐标
+        self.zoom = 1.0
+        self.view_center = None
+        self.max_pixel_scale = 16.0  # 最大放大到1个原图像素占16个屏幕像素
+        self.pan_start = None
+        
+        # 显示缓冲区缓存（笔刷局部刷新时复用）
+        self.photo_image = None
+        self.displayed_view = None  # 显示缓冲区对应的视口
+        # 区域工具（魔棒/GrabCut）在后台线程中处理光标周围的ROI
+        self.region_executor = ThreadPoolExecutor(max_workers=1)
+        self.region_job = None
+        self.region_roi_radius = 150  # ROI半边长（屏幕像素）
+        self.threshold_reference = None  # 阈值笔刷的参考灰度
+        self.intensity_window = IntensityWindow()
+        self.window_drag = None
+        self.overlay_compositor = OverlayCompositor()  # 各切片的会话共用，复用合成缓冲区
+        self.photo_overlay = None
+        self.overlay_photo_builds = 0  # 叠加面板 PhotoImage 的重建次数
         
         self.canvas_width = 550  # 增大canvas尺寸
         self.canvas_height = 500
@@ -39,41 +2198,110 @@ class MaskCorrectionGUI:
         self.overlay_alpha = 0.5
         self.show_overlay = True
         
+        # 后台预取相关变量
+        self.prefetch_radius = 2  # 预取当前图像前后各N张
+        self.slice_cache = ByteLRUCache(512 * 1024 * 1024)  # 解码结果缓存上限512MB
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=2)
+        self.prefetch_futures = {}
+        self.pending_slice = None  # 等待后台解码完成后显示的切片
+        self.current_slice_key = None
+        self.polling_prefetch = False
+        
+        # 后台文件夹扫描："image"/"mask" -> FolderScan
+        self.folder_scans = {}
+        
+        # 质量报告：后台运行的 QARun 和结果表格
+        self.qa_run = None
+        self.qa_window = None
+        self.qa_tree = None
+        self.qa_sort = (None, False)  # (排序列, 是否降序)
+        
+        # 后台保存：同一mask的多次保存会被合并，在笔画结束或切换图像时写入
+        # 内容与磁盘上相同的mask不会被重写；修改过但未保存的mask切换图像后保留在内存中
+        self.mask_changes = MaskChanges()
+        self.mask_writer = MaskWriter(delay=0.5, workers=min(4, os.cpu_count() or 1),
+                                      changes=self.mask_changes)
+        self.stroke_modified = False
+        
+        # 笔画：收集鼠标移动点，每帧交给会话批量栅格化一次
+        self.stroke_points = []        # 尚未绘制的点（原图坐标）
+        self.stroke_last_point = None  # 上一批的最后一个点，用于衔接下一批
+        
+        # 重绘调度：所有重绘请求按帧合并，目标帧率可调
+        self.render_scheduler = RenderScheduler(self.root.after, self.render_frame, fps=60)
+        
+        # 日志框最多保留的行数
+        self.log_max_lines = 2000
+        
         self.setup_ui()
         self.redirect_stdout()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(200, self.poll_mask_writer)
+    
+    @property
+    def original_image(self):
+        """当前切片的图像（由 session 持有）"""
+        return None if self.session is None else self.session.image
+    
+    @property
+    def mask_image(self):
+        """当前编辑的mask（由 session 持有）"""
+        return None if self.session is None else self.session.mask
+    
+    @property
+    def current_mask_path(self):
+        """当前mask文件路径"""
+        return None if self.session is None else self.session.mask_path
+    
+    @property
+    def intensity(self):
+        """当前16位灰度图的灰度映射，8位图像为None"""
+        return None if self.session is None else self.session.intensity
     
     def redirect_stdout(self):
-        """重定向标准输出到GUI日志框"""
-        class StdoutRedirector:
-            def __init__(self, text_widget):
-                self.text_widget = text_widget
-            
-            def write(self, message):
-                if message.strip():  # 只显示非空消息
-                    self.text_widget.insert(tk.END, message)
-                    self.text_widget.see(tk.END)
-                    self.text_widget.update()
-            
-            def flush(self):
-                pass
+        """把标准输出转发到 logging，由 flush_log 定期批量写入GUI日志框
+        
+        设置了 MEDMASK_LOG_FILE 时日志同时写入该文件（5MB轮转，保留3个备份）。
+        """
+        self.log_sink = QueueLogSink()
+        self.log_handlers = [self.log_sink]
+        if LOG_FILE:
+            try:
+                file_handler = logging.handlers.RotatingFileHandler(
+                    LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8")
+                file_handler.setFormatter(logging.Formatter(
+                    "%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+                self.log_handlers.append(file_handler)
+            except OSError as e:
+                self.log_sink.records.put(f"警告: 无法打开日志文件 {LOG_FILE}, 错误: {e}")
+        for handler in self.log_handlers:
+            logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
         
         # 保存原始stdout
         self.original_stdout = sys.stdout
-        sys.stdout = StdoutRedirector(self.log_text)
+        sys.stdout = LoggerWriter(logger)
+        self.root.after(100, self.flush_log)
+    
+    def flush_log(self):
+        """把排队的日志一次性写入日志框，日志框最多保留 log_max_lines 行"""
+        lines, dropped = self.log_sink.drain(self.log_max_lines)
+        if lines:
+            if dropped:
+                lines.insert(0, f"...（省略 {dropped} 行日志）")
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            # 超出上限时删除最早的行
+            excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - self.log_max_lines
+            if excess > 0:
+                self.log_text.delete("1.0", f"{excess + 1}.0")
+            self.log_text.see(tk.END)
+        self.root.after(100, self.flush_log)
     
     def safe_imread(self, filepath, flags=cv2.IMREAD_COLOR):
         """安全读取图像，支持中文路径"""
         try:
-            # 使用numpy读取，支持中文路径
-            with open(filepath, 'rb') as f:
-                image_data = f.read()
-            
-            # 将字节数据转换为numpy数组
-            nparr = np.frombuffer(image_data, np.uint8)
-            
-            # 解码图像
-            image = cv2.imdecode(nparr, flags)
-            return image
+            return read_image_file(filepath, flags)
         except Exception as e:
             print(f"读取图像失败: {filepath}, 错误: {e}")
             return None
@@ -92,6 +2320,10 @@ class MaskCorrectionGUI:
                   command=self.select_image_folder).pack(side=tk.LEFT, padx=(0, 5))
         ttk.Button(control_frame, text="选择Mask文件夹", 
                   command=self.select_mask_folder).pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Button(control_frame, text="打开体数据", 
+                  command=self.select_volume).pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Button(control_frame, text="质量报告", 
+                  command=self.run_qa_report).pack(side=tk.LEFT, padx=(0, 5))
         
         # 图像导航
         nav_frame = ttk.Frame(control_frame)
@@ -153,6 +2385,18 @@ class MaskCorrectionGUI:
         self.mask_canvas.bind("<B1-Motion>", self.draw)
         self.mask_canvas.bind("<ButtonRelease-1>", self.stop_draw)
         
+        # 三个画布共用同一视口：滚轮缩放，右键/中键拖动平移
+        for canvas in (self.image_canvas, self.mask_canvas, self.overlay_canvas):
+            canvas.bind("<MouseWheel>", self.zoom_view)
+            canvas.bind("<Button-4>", self.zoom_view)
+            canvas.bind("<Button-5>", self.zoom_view)
+            for button in (2, 3):
+                canvas.bind(f"<Button-{button}>", self.start_pan)
+                canvas.bind(f"<B{button}-Motion>", self.pan_view)
+            # Ctrl+右键拖动调整16位灰度图的窗宽/窗位
+            canvas.bind("<Control-Button-3>", self.start_window)
+            canvas.bind("<Control-B3-Motion>", self.drag_window)
+        
         # 日志显示区域
         log_frame = ttk.LabelFrame(content_frame, text="系统日志")
         log_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=(10, 0))
@@ -185,6 +2429,30 @@ class MaskCorrectionGUI:
         ttk.Radiobutton(tool_row1, text="擦除", variable=self.mode_var, 
                        value="remove").pack(side=tk.LEFT, padx=5)
         
+        # 区域工具
+        self.tool_var = tk.StringVar(value="brush")
+        ttk.Label(tool_row1, text="工具:").pack(side=tk.LEFT, padx=(15, 0))
+        for text, value in (("笔刷", "brush"), ("魔棒", "wand"),
+                            ("阈值笔刷", "threshold"), ("GrabCut", "grabcut")):
+            ttk.Radiobutton(tool_row1, text=text, variable=self.tool_var,
+                           value=value).pack(side=tk.LEFT, padx=2)
+        ttk.Label(tool_row1, text="容差:").pack(side=tk.LEFT, padx=(10, 0))
+        self.tolerance_scale = tk.Scale(tool_row1, from_=1, to=100, orient=tk.HORIZONTAL,
+                                        variable=tk.IntVar(value=20))
+        self.tolerance_scale.pack(side=tk.LEFT, padx=5)
+        
+        # 多标签模式：笔刷写入所选标签值，按调色板显示
+        self.label_mode_var = tk.BooleanVar(value=False)
+        self.label_mode_auto = False  # 多标签模式是否因加载16位mask而自动开启
+        ttk.Checkbutton(tool_row1, text="多标签", variable=self.label_mode_var,
+                       command=self.toggle_label_mode).pack(side=tk.LEFT, padx=(15, 5))
+        ttk.Label(tool_row1, text="标签:").pack(side=tk.LEFT)
+        self.brush_label_var = tk.IntVar(value=1)
+        ttk.Spinbox(tool_row1, from_=1, to=65535, width=6,
+                    textvariable=self.brush_label_var).pack(side=tk.LEFT, padx=5)
+        self.label_area_label = ttk.Label(tool_row1, text="")
+        self.label_area_label.pack(side=tk.LEFT, padx=5)
+        
         # 第二行工具 - 叠加控制
         tool_row2 = ttk.Frame(tool_frame)
         tool_row2.pack(fill=tk.X)
@@ -201,14 +2469,37 @@ class MaskCorrectionGUI:
         ttk.Checkbutton(tool_row2, text="显示叠加", variable=self.overlay_var,
                        command=self.toggle_overlay).pack(side=tk.LEFT, padx=10)
         
+        # 视口缩放
+        ttk.Button(tool_row2, text="适应窗口", command=self.reset_view).pack(side=tk.LEFT, padx=5)
+        self.zoom_label = ttk.Label(tool_row2, text="缩放: 适应窗口")
+        self.zoom_label.pack(side=tk.LEFT, padx=5)
+        
+        # 窗宽/窗位（16位灰度图）
+        ttk.Button(tool_row2, text="自动窗宽", command=self.auto_window).pack(side=tk.LEFT, padx=5)
+        self.window_label = ttk.Label(tool_row2, text="")
+        self.window_label.pack(side=tk.LEFT, padx=5)
+        
         # 操作按钮
         ttk.Button(tool_row2, text="重置Mask", command=self.reset_mask).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(tool_row2, text="重做", command=self.redo).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(tool_row2, text="撤销", command=self.undo).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(tool_row2, text="保存全部", command=self.save_all_masks).pack(side=tk.RIGHT, padx=5)
         ttk.Button(tool_row2, text="保存修改", command=self.save_mask).pack(side=tk.RIGHT, padx=5)
         ttk.Button(tool_row2, text="自动保存", command=self.toggle_auto_save).pack(side=tk.RIGHT, padx=5)
         
         # 自动保存状态
         self.auto_save = False
         
+        # 输出重绘统计
+        self.root.bind("<F9>", self.print_render_stats)
+        self.root.bind("<F10>", self.toggle_profiling)
+        
+        # 撤销/重做快捷键
+        self.root.bind("<Control-z>", self.undo)
+        self.root.bind("<Control-y>", self.redo)
+        self.root.bind("<Control-Z>", self.redo)
+        self.root.bind("<Control-S>", self.save_all_masks)
+        
     def clear_log(self):
         """清除日志内容"""
         self.log_text.delete(1.0, tk.END)
@@ -226,46 +2517,126 @@ class MaskCorrectionGUI:
             self.mask_folder = folder
             self.load_mask_files()
             
+    def select_volume(self):
+        path = filedialog.askopenfilename(
+            title="选择体数据",
+            filetypes=[("体数据", "*.nii *.npy *.tif *.tiff"), ("所有文件", "*.*")])
+        if path:
+            self.open_volume(path)
+    
+    def open_volume(self, path):
+        """打开体数据：每一层作为一张切片，图像和mask都通过内存映射按需读写"""
+        try:
+            source = VolumeSource.open(path)
+        except Exception as e:
+            print(f"打开体数据失败: {os.path.basename(path)}, 错误: {e}")
+            return
+        # 正在进行的图像文件夹扫描作废，避免扫描结果混入切片列表
+        scan = self.folder_scans.pop("image", None)
+        if scan is not None:
+            scan.cancel()
+        self.volume_path = path
+        self.image_folder = ""
+        self.image_files = [volume_slice_ref(path, index) for index in range(source.depth)]
+        self.current_index = 0
+        self.open_mask_volume()
+        print(f"体数据: {os.path.basename(path)}, {source.depth} 层, 尺寸 {source.shape[1]}x{source.shape[0]}")
+        self.update_display()
+    
+    def open_mask_volume(self):
+        """打开（或准备在第一次保存时创建）当前体数据对应的mask体数据"""
+        source = VolumeSource.open(self.volume_path)
+        self.mask_volume_path = mask_volume_path(self.volume_path, self.mask_folder)
+        try:
+            MaskVolume.open(self.mask_volume_path, source.depth, source.shape)
+        except Exception as e:
+            print(f"打开mask体数据失败: {e}")
+        self.clear_slice_cache()
+        print(f"mask体数据: {self.mask_volume_path}")
+    
+    def slice_display_name(self, path):
+        """日志中显示的切片名称"""
+        volume = parse_volume_slice(path)
+        if volume is not None:
+            return f"{os.path.basename(volume[0])} 第{volume[1] + 1}层"
+        return os.path.basename(path)
+    
     def load_image_files(self):
         if not self.image_folder:
             return
-            
-        # 支持常见图像格式
-        extensions = ['*.jpg', '*.jpeg', '*.png', '*.bmp', '*.tiff']
-        self.image_files = []
         
-        for ext in extensions:
-            # 只搜索小写扩展名，glob会自动匹配大小写不敏感的文件系统
-            files = glob.glob(os.path.join(self.image_folder, ext))
-            self.image_files.extend(files)
-            
-        # 去重并排序
-        self.image_files = list(set(self.image_files))
-        self.image_files.sort()
+        # 后台扫描，找到第一张图像后立即显示，其余文件陆续加入列表
+        self.volume_path = None
+        self.image_files = []
         self.current_index = 0
-        
-        print(f"图像文件夹: 找到 {len(self.image_files)} 个文件")
-        
-        if self.image_files:
-            self.update_display()
-        else:
-            print("警告: 未找到支持的图像文件")
+        self.clear_slice_cache()
+        self.image_label.config(text="0/0")
+        self.start_folder_scan("image", self.image_folder)
         
     def load_mask_files(self):
         if not self.mask_folder:
             return
-            
-        extensions = ['*.jpg', '*.jpeg', '*.png', '*.bmp', '*.tiff']
-        self.mask_files = []
         
-        for ext in extensions:
-            # 只搜索小写扩展名，glob会自动匹配大小写不敏感的文件系统
-            files = glob.glob(os.path.join(self.mask_folder, ext))
-            self.mask_files.extend(files)
-            
-        # 去重并排序
-        self.mask_files = list(set(self.mask_files))
-        self.mask_files.sort()
+        # mask扫描完成后再建立配对索引
+        self.start_folder_scan("mask", self.mask_folder)
+    
+    def start_folder_scan(self, kind, folder):
+        """启动后台文件夹扫描，取消同类型尚未完成的扫描"""
+        previous = self.folder_scans.get(kind)
+        if previous is not None:
+            previous.cancel()
+        was_idle = not self.folder_scans
+        self.folder_scans[kind] = FolderScan(folder, MASK_EXTENSIONS if kind == "mask" else IMAGE_EXTENSIONS)
+        if was_idle:
+            self.root.after(20, self.poll_folder_scans)
+    
+    def poll_folder_scans(self):
+        """在界面线程中取回后台扫描结果"""
+        for kind, scan in list(self.folder_scans.items()):
+            new_files, finished = scan.drain()
+            if scan.error:
+                print(f"扫描文件夹失败: {scan.folder}, 错误: {scan.error}")
+            if kind == "image":
+                self.receive_image_files(new_files, finished)
+            elif finished:
+                self.receive_mask_files(scan.files)
+            if finished:
+                del self.folder_scans[kind]
+        
+        if self.folder_scans:
+            self.root.after(50, self.poll_folder_scans)
+    
+    def receive_image_files(self, new_files, finished):
+        """追加扫描到的图像文件；扫描完成时排序并保持当前显示的图像不变"""
+        was_empty = not self.image_files
+        self.image_files.extend(new_files)
+        
+        if finished:
+            current_path = self.image_files[self.current_index] if not was_empty else None
+            self.image_files.sort()
+            if current_path is not None:
+                self.current_index = bisect_left(self.image_files, current_path)
+            print(f"图像文件夹: 找到 {len(self.image_files)} 个文件")
+            if not self.image_files:
+                print("警告: 未找到支持的图像文件")
+                return
+        
+        if not self.image_files:
+            return
+        if was_empty:
+            self.update_display()
+        else:
+            self.image_label.config(text=f"{self.current_index + 1}/{len(self.image_files)}")
+            if finished:
+                self.prefetch_neighbours()
+    
+    def receive_mask_files(self, mask_files):
+        """mask文件夹扫描完成，重建配对索引并刷新显示"""
+        self.mask_files = sorted(mask_files)
+        self.mask_index = MaskIndex(self.mask_files)
+        self.clear_slice_cache()
+        if self.volume_path:
+            self.open_mask_volume()
         
         print(f"Mask文件夹: 找到 {len(self.mask_files)} 个文件")
         
@@ -274,210 +2645,828 @@ class MaskCorrectionGUI:
 
     def get_corresponding_mask(self, image_path):
         """根据图像文件名找到对应的mask文件"""
-        if not self.mask_files:
-            return None
-            
-        image_name = os.path.splitext(os.path.basename(image_path))[0]
-        
-        for mask_path in self.mask_files:
-            mask_name = os.path.splitext(os.path.basename(mask_path))[0]
-            if image_name == mask_name or image_name in mask_name or mask_name in image_name:
-                return mask_path
-        return None
+        return self.mask_index.find(image_path)
         
     def update_display(self):
         if not self.image_files:
             return
             
+        # 切换图像前，立即写入排队中的自动保存（不等待写入完成）
+        self.mask_writer.flush(wait=False)
+        
         # 确保索引在有效范围内
         if self.current_index < 0:
             self.current_index = 0
         elif self.current_index >= len(self.image_files):
             self.current_index = len(self.image_files) - 1
             
+        PROFILER.count("navigations")
+        
         # 更新图像计数标签
         self.image_label.config(text=f"{self.current_index + 1}/{len(self.image_files)}")
         
         # 加载当前图像
         image_path = self.image_files[self.current_index]
-        print(f"[{self.current_index + 1}/{len(self.image_files)}] {os.path.basename(image_path)}")
+        print(f"[{self.current_index + 1}/{len(self.image_files)}] {self.slice_display_name(image_path)}")
         
-        # 使用安全读取方法
-        self.original_image = self.safe_imread(image_path)
+        # 优先从预取缓存中读取，未命中时交给后台线程解码，不阻塞界面
+        key = self.slice_key(self.current_index)
+        entry = self.slice_cache.get(key)
+        if entry is not None and entry["mask_version"] != self.mask_writer.version(key[1]):
+            # 缓存之后mask又被保存过，缓存中的版本已过期
+            self.slice_cache.discard(key)
+            entry = None
+        if entry is None:
+            self.pending_slice = key
+            self.submit_prefetch(key)
+        else:
+            self.pending_slice = None
+            self.show_slice(key, entry)
         
-        if self.original_image is None:
+        # 预取前后相邻的图像
+        self.prefetch_neighbours()
+    
+    def slice_key(self, index):
+        """切片缓存的键：(图像路径, 对应mask路径)
+        
+        没有对应mask时使用新建mask的保存路径，这样保存过的新mask再次打开时也能读到。
+        """
+        image_path = self.image_files[index]
+        volume = parse_volume_slice(image_path)
+        if volume is not None:
+            return (image_path, volume_slice_ref(self.mask_volume_path, volume[1]))
+        mask_path = self.get_corresponding_mask(image_path)
+        if mask_path is None and self.mask_folder:
+            image_name = os.path.splitext(os.path.basename(image_path))[0]
+            mask_path = os.path.join(self.mask_folder, f"{image_name}{MASK_CODEC.extension}")
+        return (image_path, mask_path)
+    
+    def submit_prefetch(self, key):
+        """提交后台解码任务（已缓存或已在解码中的切片会被跳过）"""
+        if key in self.prefetch_futures or key in self.slice_cache:
+            return
+        # 记录提交时mask的保存版本，解码期间mask又被保存过时结果作废
+        version = self.mask_writer.version(key[1])
+        future = self.prefetch_executor.submit(load_slice, key[0], key[1], self.mask_writer)
+        self.prefetch_futures[key] = (future, version)
+        if not self.polling_prefetch:
+            self.polling_prefetch = True
+            self.root.after(10, self.poll_prefetch)
+    
+    def prefetch_neighbours(self):
+        """按距离由近到远预取当前图像前后各 prefetch_radius 张"""
+        for offset in range(1, self.prefetch_radius + 1):
+            for index in (self.current_index + offset, self.current_index - offset):
+                if 0 <= index < len(self.image_files):
+                    self.submit_prefetch(self.slice_key(index))
+    
+    def poll_prefetch(self):
+        """在界面线程中收集已完成的后台解码结果"""
+        for key, (future, version) in list(self.prefetch_futures.items()):
+            if not future.done():
+                continue
+            del self.prefetch_futures[key]
+            if future.cancelled():
+                continue
+            try:
+                entry = future.result()
+            except Exception as e:
+                # 单张切片解码失败不能中断轮询，否则之后的切片都无法显示
+                print(f"读取切片失败: {os.path.basename(key[0])}, 错误: {e}")
+                if key == self.pending_slice:
+                    self.pending_slice = None
+                continue
+            if version != self.mask_writer.version(key[1]):
+                # 解码期间mask被重新保存过，重新读取
+                if key == self.pending_slice:
+                    self.submit_prefetch(key)
+                continue
+            if entry["image"] is not None:
+                entry["mask_version"] = version
+                self.slice_cache.put(key, entry, entry["nbytes"])
+            if key == self.pending_slice:
+                self.pending_slice = None
+                self.show_slice(key, entry)
+        
+        if self.prefetch_futures:
+            self.root.after(10, self.poll_prefetch)
+        else:
+            self.polling_prefetch = False
+    
+    def clear_slice_cache(self):
+        """文件列表变化时清空预取缓存并取消未开始的解码任务"""
+        for future, _ in self.prefetch_futures.values():
+            future.cancel()
+        self.prefetch_futures.clear()
+        self.slice_cache.clear()
+        self.pending_slice = None
+    
+    def show_slice(self, key, entry):
+        """显示已解码完成的切片"""
+        image_path, mask_path = key
+        if entry["image"] is None:
+            if entry["error"]:
+                print(f"读取图像失败: {image_path}, 错误: {entry['error']}")
             print(f"错误: 无法读取图像")
             return
-            
-        self.original_image = cv2.cvtColor(self.original_image, cv2.COLOR_BGR2RGB)
         
-        # 加载对应的mask
-        mask_path = self.get_corresponding_mask(image_path)
-        if mask_path and os.path.exists(mask_path):
-            self.current_mask_path = mask_path
-            self.mask_image = self.safe_imread(mask_path, cv2.IMREAD_GRAYSCALE)
-            if self.mask_image is None:
-                # 如果读取失败，创建空mask
-                h, w = self.original_image.shape[:2]
-                self.mask_image = np.zeros((h, w), dtype=np.uint8)
-                print("警告: mask文件损坏，已创建空mask")
-            else:
-                print(f"加载mask: {os.path.basename(mask_path)}")
+        self.stash_current_mask()
+        self.current_slice_key = key
+        previous_shape = None if self.original_image is None else self.original_image.shape[:2]
+        # 加载对应的mask：优先使用内存中未保存的修改；缓存中为压缩形式，只解压当前编辑的这一张
+        self.session = MaskSession.from_entry(entry, self.mask_changes, self.overlay_compositor)
+        h, w = self.original_image.shape[:2]
+        
+        # 相同尺寸的图像之间切换时保持缩放和位置，方便逐张对比同一区域
+        if previous_shape != (h, w):
+            self.zoom = 1.0
+            self.view_center = None
+            self.zoom_label.config(text="缩放: 适应窗口")
+        
+        source = self.session.source
+        if source == "edited":
+            print(f"加载mask（未保存的修改）: {self.slice_display_name(mask_path)}")
+        elif source == "ok":
+            print(f"加载mask: {self.slice_display_name(mask_path)}")
+        elif source == "corrupt":
+            # 如果读取失败，使用空mask
+            if entry["error"]:
+                print(f"读取mask失败: {self.slice_display_name(mask_path)}, 错误: {entry['error']}")
+            print("警告: mask文件损坏，已创建空mask")
+        elif mask_path:
+            # 如果没有对应的mask，使用空mask，保存到对应路径
+            print("创建新mask")
         else:
-            # 如果没有对应的mask，创建一个空的mask并设置保存路径
-            h, w = self.original_image.shape[:2]
-            self.mask_image = np.zeros((h, w), dtype=np.uint8)
-            if self.mask_folder:
-                image_name = os.path.splitext(os.path.basename(image_path))[0]
-                self.current_mask_path = os.path.join(self.mask_folder, f"{image_name}.png")
-                print("创建新mask")
-            else:
-                self.current_mask_path = None
-                print("警告: 未设置mask文件夹")
-            
-        self.display_images()
+            print("警告: 未设置mask文件夹")
+        
+        self.select_label_mode()
+        self.session.set_label_mode(self.label_mode_var.get())
+        self.update_label_areas()
+        
+        # 切换了切片，旧的显示缓存失效
+        self.view_cache = None
+        self.render_scheduler.request("image")
+
+    def stash_current_mask(self):
+        """切换图像前，把当前mask未保存的修改保留在内存中"""
+        if self.session is not None and self.session.modified and self.current_mask_path:
+            self.mask_changes.keep(self.current_mask_path, self.mask_image)
 
+    def compute_view(self, h, w):
+        """根据缩放倍数和视口中心计算显示几何参数
+        
+        返回 (缩放比例, 原点, 显示尺寸, 画布偏移)，均为 (x, y) 形式；原点为显示区域
+        左上角对应的原图坐标。某一方向上整张图都能放下时，该方向居中显示整张图。
+        """
+        fit = min(self.canvas_width/w, self.canvas_height/h)
+        s = fit * self.zoom
+        center = self.view_center or (w / 2, h / 2)
+        
+        def axis(length, canvas, c):
+            size = int(length * s)
+            if size <= canvas:
+                return size / length, 0.0, size, (canvas - size) // 2
+            origin = min(max(c - canvas / (2 * s), 0.0), length - canvas / s)
+            return s, origin, canvas, 0
+        
+        sx, ox, dw, offset_x = axis(w, self.canvas_width, center[0])
+        sy, oy, dh, offset_y = axis(h, self.canvas_height, center[1])
+        return (sx, sy), (ox, oy), (dw, dh), (offset_x, offset_y)
+    
+    def get_view_cache(self):
+        """获取当前视口的显示缓存，仅在切片、canvas尺寸、缩放或平移变化时重新计算
+        
+        视口内的图像从图像金字塔中最接近的一级裁剪并重采样，耗时只与canvas大小有关。
+        返回值为 (缓存, 是否新建)。
+        """
+        key = (self.current_index, self.canvas_width, self.canvas_height, self.zoom, self.view_center)
+        if self.view_cache is not None and self.view_cache["key"] == key:
+            return self.view_cache, False
+        
+        h, w = self.original_image.shape[:2]
+        scale, origin, size, offset = self.compute_view(h, w)
+        
+        # 从图像金字塔中选择合适的层级，只重采样可见区域
+        resized_image = self.session.sample_image({"origin": origin, "scale": scale, "size": size})
+        
+        # 16位灰度图保留重采样后的原始灰度，窗宽/窗位变化时只需重新查表
+        resized_raw = None
+        if self.intensity is not None:
+            resized_raw = resized_image
+            if not self.intensity_window.is_set():
+                self.intensity_window.auto(resized_raw, self.intensity)
+                self.update_window_label()
+            resized_image = self.intensity_window.apply(resized_raw, self.intensity)
+        
+        with PROFILER.stage("photo"):
+            photo_image = ImageTk.PhotoImage(Image.fromarray(resized_image))
+        self.view_cache = {
+            "key": key,
+            "scale": scale,
+            "origin": origin,
+            "size": size,
+            "offset": offset,
+            "resized_raw": resized_raw,
+            "resized_image": resized_image,
+            "photo_image": photo_image,
+        }
+        return self.view_cache, True
+        
     def display_images(self):
         if self.original_image is None:
             return
             
-        # 调整图像大小以适应canvas
-        h, w = self.original_image.shape[:2]
-        scale = min(self.canvas_width/w, self.canvas_height/h)
-        new_w, new_h = int(w*scale), int(h*scale)
+        cache, _ = self.get_view_cache()
+        offset_x, offset_y = cache["offset"]
+        resized_image = cache["resized_image"]
         
-        # 显示原始图像
-        resized_image = cv2.resize(self.original_image, (new_w, new_h))
-        self.display_image = Image.fromarray(resized_image)
-        self.photo_image = ImageTk.PhotoImage(self.display_image)
+        # 显示原始图像（视口未变化时无需重绘）
+        if self.photo_image is not cache["photo_image"]:
+            self.photo_image = cache["photo_image"]
+            self.image_canvas.delete("all")
+            self.image_canvas.create_image(offset_x, offset_y, anchor=tk.NW,
+                                          image=self.photo_image)
         
-        self.image_canvas.delete("all")
-        self.image_canvas.create_image(self.canvas_width//2, self.canvas_height//2, 
-                                      image=self.photo_image)
-        
-        # 显示mask
-        resized_mask = cv2.resize(self.mask_image, (new_w, new_h))
-        self.display_mask = Image.fromarray(resized_mask)
-        self.photo_mask = ImageTk.PhotoImage(self.display_mask)
+        # 显示mask（只重采样视口内的区域）
+        self.session.set_view(cache, resized_image)
+        resized_mask = self.session.display_mask
+        with PROFILER.stage("photo"):
+            self.display_mask = Image.fromarray(self.mask_panel_pixels(resized_mask))
+            self.photo_mask = ImageTk.PhotoImage(self.display_mask)
         
         self.mask_canvas.delete("all")
-        self.mask_canvas.create_image(self.canvas_width//2, self.canvas_height//2, 
+        self.mask_canvas.create_image(offset_x, offset_y, anchor=tk.NW,
                                      image=self.photo_mask)
         
+        # 会话中保留缩放后的图像和mask，笔刷绘制时只局部刷新
+        self.displayed_view = cache["key"]
+        
         # 显示叠加图像
-        self.update_overlay_display(resized_image, resized_mask)
+        self.update_overlay_display()
         
         # 保存缩放比例用于绘制
-        self.scale_factor = scale
+        self.scale_factor = cache["scale"][0]
+        
+    def mask_panel_pixels(self, resized_mask):
+        """mask面板的显示内容：二值模式为灰度，多标签模式按调色板着色"""
+        if self.label_mode_var.get():
+            return LABEL_PALETTE[resized_mask]
+        return resized_mask
+    
+    def show_overlay_photo(self, array):
+        """显示叠加面板；尺寸未变时原地写入已有的 PhotoImage，不重建 Tk 图片"""
+        h, w = array.shape[:2]
+        photo = self.photo_overlay
+        if photo is not None and photo.width() == w and photo.height() == h:
+            photo_put_region(self.root.tk, photo, array, 0, 0)
+        else:
+            self.photo_overlay = ImageTk.PhotoImage(Image.fromarray(array))
+            self.overlay_photo_builds += 1
         
-    def update_overlay_display(self, resized_image, resized_mask):
-        """更新叠加显示"""
+    def update_overlay_display(self):
+        """更新叠加显示：mask以红色（多标签模式按调色板）叠加到图像上，并绘制绿色轮廓"""
+        session = self.session
         if not self.overlay_var.get():
-            # 如果不显示叠加，只显示原始图像
-            self.photo_overlay = ImageTk.PhotoImage(Image.fromarray(resized_image))
+            # 如果不显示叠加，只显示原始图像；轮廓缓存不再随mask更新，直接丢弃
+            session.clear_overlay()
+            with PROFILER.stage("photo"):
+                self.show_overlay_photo(session.display_image)
         else:
-            # 创建彩色mask
-            colored_mask = np.zeros_like(resized_image)
-            colored_mask[:,:,0] = resized_mask  # 红色通道显示mask
-            
-            # 混合图像和mask
-            alpha = self.alpha_scale.get()
-            overlay_image = cv2.addWeighted(resized_image, 1-alpha, colored_mask, alpha, 0)
-            
-            # 在mask区域添加轮廓
-            contours, _ = cv2.findContours(resized_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            cv2.drawContours(overlay_image, contours, -1, (0, 255, 0), 2)  # 绿色轮廓
-            
-            self.photo_overlay = ImageTk.PhotoImage(Image.fromarray(overlay_image))
+            # mask未变化（如只调整透明度）时会话复用轮廓缓存
+            session.alpha = self.alpha_scale.get()
+            frame = session.compose()
+            with PROFILER.stage("photo"):
+                self.show_overlay_photo(frame)
         
+        offset_x, offset_y = self.view_cache["offset"]
         self.overlay_canvas.delete("all")
-        self.overlay_canvas.create_image(self.canvas_width//2, self.canvas_height//2, 
+        self.overlay_canvas.create_image(offset_x, offset_y, anchor=tk.NW,
                                         image=self.photo_overlay)
     
+    def refresh_mask_region(self, box):
+        """局部刷新：只重采样 box（原图坐标）影响到的显示区域，并原地更新mask和叠加画面
+        
+        原始图像面板不受笔刷影响，保持不变。
+        """
+        # 显示缓冲区不属于当前视口（如刚缩放过）时整体重绘
+        cache = self.view_cache
+        if self.session.display_mask is None or cache is None or self.displayed_view != cache["key"]:
+            self.display_images()
+            return
+        
+        # 由会话重采样受影响的mask区域、更新轮廓并局部合成叠加画面，这里只更新对应的 PhotoImage
+        self.session.alpha = self.alpha_scale.get()
+        regions = self.session.render(box)
+        if regions is None:
+            return
+        (x0, y0, x1, y1), overlay_box = regions
+        with PROFILER.stage("photo_region"):
+            mask_patch = self.session.display_mask[y0:y1, x0:x1]
+            photo_put_region(self.root.tk, self.photo_mask, self.mask_panel_pixels(mask_patch), x0, y0)
+            if overlay_box is not None:
+                ox0, oy0, ox1, oy1 = overlay_box
+                photo_put_region(self.root.tk, self.photo_overlay,
+                                 self.session.frame[oy0:oy1, ox0:ox1], ox0, oy0)
+    
     def update_overlay(self, value=None):
         """更新叠加透明度"""
         if self.original_image is not None and self.mask_image is not None:
-            self.display_images()
+            self.render_scheduler.request("overlay")
     
     def toggle_overlay(self):
         """切换叠加显示"""
         if self.original_image is not None and self.mask_image is not None:
+            self.render_scheduler.request("overlay")
+    
+    def render_frame(self, parts, box):
+        """重绘调度器的每帧回调：按标记的部分选择最小的重绘范围"""
+        if self.original_image is None or self.mask_image is None:
+            return
+        with PROFILER.stage("frame"):
+            self.render_parts(parts, box)
+    
+    def render_parts(self, parts, box):
+        """重绘一帧中标记的各部分"""
+        # 先把这一帧收集到的笔画点画到mask上
+        # 整个mask重绘的请求（"mask" 且不带 box）不会被笔画区域缩小
+        if "stroke" in parts:
+            stroke_box = self.rasterize_stroke()
+            if stroke_box is not None and not ("mask" in parts and box is None):
+                parts = parts | {"mask"}
+                box = stroke_box if box is None else (
+                    min(box[0], stroke_box[0]), min(box[1], stroke_box[1]),
+                    max(box[2], stroke_box[2]), max(box[3], stroke_box[3]))
+        
+        if "window" in parts:
+            self.refresh_window()
+        if "image" in parts or ("mask" in parts and box is None):
+            self.display_images()
+            return
+        if "mask" in parts:
+            self.refresh_mask_region(box)
+        if "overlay" in parts:
+            self.refresh_overlay()
+    
+    def print_render_stats(self, event=None):
+        """输出重绘调度与叠加合成统计"""
+        stats = self.render_scheduler.stats()
+        print(f"重绘统计: 目标 {stats['fps']} 帧/秒, 已绘制 {stats['frames']} 帧, "
+              f"合并请求 {stats['coalesced']} 次, 掉帧 {stats['dropped']} 帧")
+        overlay = self.overlay_compositor.stats()
+        frames = max(1, overlay['frames'])
+        print(f"叠加合成: {overlay['frames']} 帧, 缓冲区分配 {overlay['allocations']} 次 "
+              f"(平均每帧 {overlay['allocations'] / frames:.3f} 次), "
+              f"PhotoImage 重建 {self.overlay_photo_builds} 次")
+        print(f"窗宽/窗位查找表重建 {self.intensity_window.lut_builds} 次")
+        if PROFILER.enabled:
+            for line in PROFILER.report_lines():
+                print(line)
+    
+    def toggle_profiling(self, event=None):
+        """开启/关闭性能统计；关闭时输出统计结果"""
+        if PROFILER.enabled:
+            PROFILER.enabled = False
+            for line in PROFILER.report_lines():
+                print(line)
+            print("性能统计: 关闭")
+        else:
+            PROFILER.reset()
+            PROFILER.enabled = True
+            print("性能统计: 开启（F9 查看，F10 关闭）")
+    
+    def refresh_overlay(self):
+        """只重新混合叠加画面，复用会话中已缩放的图像和mask"""
+        if self.session.display_mask is None:
             self.display_images()
+            return
+        self.update_overlay_display()
+        
+    def set_view(self, zoom, center):
+        """设置缩放倍数和视口中心（自动限制在图像范围内），并在下一帧重绘"""
+        h, w = self.original_image.shape[:2]
+        fit = min(self.canvas_width/w, self.canvas_height/h)
+        zoom = min(max(zoom, 1.0), max(1.0, self.max_pixel_scale / fit))
+        if zoom == 1.0:
+            center = None
+        else:
+            s = fit * zoom
+            half_w, half_h = self.canvas_width / (2 * s), self.canvas_height / (2 * s)
+            cx = min(max(center[0], half_w), w - half_w) if w * s > self.canvas_width else w / 2
+            cy = min(max(center[1], half_h), h - half_h) if h * s > self.canvas_height else h / 2
+            center = (cx, cy)
+        if zoom == self.zoom and center == self.view_center:
+            return
+        self.zoom = zoom
+        self.view_center = center
+        self.zoom_label.config(text=f"缩放: {fit * zoom * 100:.0f}%")
+        self.render_scheduler.request("image")
+    
+    def zoom_view(self, event):
+        """滚轮缩放，保持光标下的图像位置不动"""
+        if self.original_image is None or self.drawing:
+            return
+        # Linux 下滚轮为 Button-4/5，Windows/macOS 为 MouseWheel 事件
+        up = event.delta > 0 if event.delta else event.num == 4
+        cache, _ = self.get_view_cache()
+        offset_x, offset_y = cache["offset"]
+        origin_x, origin_y = cache["origin"]
+        scale_x, scale_y = cache["scale"]
+        
+        # 光标处的原图坐标
+        px = origin_x + (event.x - offset_x) / scale_x
+        py = origin_y + (event.y - offset_y) / scale_y
+        
+        h, w = self.original_image.shape[:2]
+        fit = min(self.canvas_width/w, self.canvas_height/h)
+        zoom = self.zoom * (1.25 if up else 0.8)
+        s = fit * min(max(zoom, 1.0), max(1.0, self.max_pixel_scale / fit))
+        self.set_view(zoom, (px + (self.canvas_width / 2 - event.x) / s,
+                             py + (self.canvas_height / 2 - event.y) / s))
+    
+    def start_pan(self, event):
+        if self.original_image is None:
+            return
+        h, w = self.original_image.shape[:2]
+        self.pan_start = (event.x, event.y, self.view_center or (w / 2, h / 2))
+    
+    def pan_view(self, event):
+        """拖动平移视口"""
+        if self.pan_start is None or self.zoom == 1.0:
+            return
+        x0, y0, (cx, cy) = self.pan_start
+        h, w = self.original_image.shape[:2]
+        s = min(self.canvas_width/w, self.canvas_height/h) * self.zoom
+        self.set_view(self.zoom, (cx - (event.x - x0) / s, cy - (event.y - y0) / s))
+    
+    def reset_view(self):
+        """恢复为适应窗口显示整张图像"""
+        if self.original_image is None:
+            return
+        self.set_view(1.0, None)
+    
+    def start_window(self, event):
+        """Ctrl+右键拖动调整窗宽/窗位（仅16位灰度图）"""
+        if self.intensity is None or not self.intensity_window.is_set():
+            self.window_drag = None
+            return
+        window = self.intensity_window
+        self.window_drag = (event.x, event.y, window.center, window.width)
+    
+    def drag_window(self, event):
+        """水平拖动改变窗宽，垂直拖动改变窗位"""
+        if self.window_drag is None:
+            return
+        x0, y0, center, width = self.window_drag
+        width = width * np.exp((event.x - x0) * 0.01)
+        center = center + (event.y - y0) * width * 0.005
+        self.intensity_window.set(center, width)
+        self.update_window_label()
+        self.render_scheduler.request("window")
+    
+    def auto_window(self):
+        """按当前视口的灰度分布重新设置窗口"""
+        cache = self.view_cache
+        if self.intensity is None or cache is None or cache["resized_raw"] is None:
+            print("提示: 窗宽/窗位只适用于16位灰度图像")
+            return
+        self.intensity_window.auto(cache["resized_raw"], self.intensity)
+        self.update_window_label()
+        self.render_scheduler.request("window")
+    
+    def update_window_label(self):
+        window = self.intensity_window
+        if window.is_set():
+            self.window_label.config(text=f"窗位/窗宽: {window.center:.0f}/{window.width:.0f}")
+    
+    def refresh_window(self):
+        """窗口变化后只对缓存的视口灰度重新查表，并原地更新图像和叠加面板"""
+        cache = self.view_cache
+        if cache is None or cache["resized_raw"] is None:
+            return
+        cache["resized_image"] = self.intensity_window.apply(cache["resized_raw"], self.intensity)
+        photo_put_region(self.root.tk, cache["photo_image"], cache["resized_image"], 0, 0)
+        if self.displayed_view == cache["key"]:
+            self.session.display_image = cache["resized_image"]
+            self.refresh_overlay()
+    
+    def brush_value(self):
+        """添加模式下笔刷写入的值：二值模式为255，多标签模式为所选标签"""
+        if not self.label_mode_var.get():
+            return 255
+        try:
+            label = int(self.brush_label_var.get())
+        except (tk.TclError, ValueError):
+            label = 1
+        label = min(max(label, 1), 65535)
+        # 8位mask放不下所选标签时转换为16位标签图
+        if self.session.widen_for_label(label):
+            print(f"mask已转换为16位标签图以写入标签 {label}")
+        return label
+    
+    def select_label_mode(self):
+        """按新切片的mask选择二值/多标签模式
+        
+        16位mask只能按标签图显示和编辑，自动切换到多标签模式；之后加载8位mask时恢复为二值模式。
+        """
+        if self.mask_image.dtype != np.uint8:
+            if not self.label_mode_var.get():
+                self.label_mode_var.set(True)
+                self.label_mode_auto = True
+                print("检测到16位标签图，已切换到多标签模式")
+        elif self.label_mode_auto:
+            self.label_mode_var.set(False)
+            self.label_mode_auto = False
+            print("当前mask为8位，已恢复二值模式")
+    
+    def toggle_label_mode(self):
+        """切换二值/多标签模式：更换叠加调色板并重新采样mask"""
+        label_mode = self.label_mode_var.get()
+        if not label_mode and self.mask_image is not None and self.mask_image.dtype != np.uint8:
+            self.label_mode_var.set(True)
+            print("提示: 16位标签图只能在多标签模式下编辑")
+            return
+        # 用户手动选择的模式不再自动恢复
+        self.label_mode_auto = False
+        self.update_label_areas()
+        if self.session is not None:
+            self.session.set_label_mode(label_mode)
+            self.render_scheduler.request("mask")
+    
+    def update_label_areas(self):
+        """多标签模式下显示当前切片各标签的面积（像素数）"""
+        if not self.label_mode_var.get() or self.mask_image is None:
+            self.label_area_label.config(text="")
+            return
+        areas = label_areas(self.mask_image)
+        if not areas:
+            self.label_area_label.config(text="面积: 无标签")
+            return
+        shown = [f"{label}:{area}" for label, area in list(areas.items())[:6]]
+        more = f" 等{len(areas)}个标签" if len(areas) > 6 else ""
+        self.label_area_label.config(text="面积: " + " ".join(shown) + more)
+    
+    def mask_scan_pending(self):
+        """mask文件夹尚未扫描完成时，当前图像对应的mask还不确定，不能编辑和保存
         
+        此时显示的是空白mask，保存路径是新建mask的默认路径；扫描完成后可能找到已有的mask，
+        提前做的修改会被写到错误的文件。
+        """
+        if "mask" not in self.folder_scans:
+            return False
+        print("提示: 正在扫描mask文件夹，扫描完成后才能编辑和保存")
+        return True
+    
     def start_draw(self, event):
+        if self.session is None or self.mask_scan_pending():
+            return
+        tool = self.tool_var.get()
+        if tool in ("wand", "grabcut"):
+            self.run_region_tool(tool, event)
+            return
+        if tool == "threshold":
+            # 阈值笔刷以按下位置的灰度为参考
+            point = self.canvas_to_image(event.x, event.y) if self.mask_image is not None else None
+            if point is None:
+                return
+            x, y = point
+            self.threshold_reference = int(self.tool_gray((x, y, x + 1, y + 1))[0, 0])
         self.drawing = True
+        self.session.begin_stroke()
+        self.stroke_points = []
+        self.stroke_last_point = None
         self.draw(event)
+    
+    def canvas_to_image(self, canvas_x, canvas_y):
+        """将mask画布坐标转换为原图坐标，超出图像范围时返回None"""
+        # 图像在canvas中的位置取自显示缓存（切换图像后尚未重绘时也使用新图像的视口）
+        cache, _ = self.get_view_cache()
+        offset_x, offset_y = cache["offset"]
+        return self.session.to_image(canvas_x - offset_x, canvas_y - offset_y, cache)
         
     def draw(self, event):
+        """收集笔画点，由重绘调度器每帧批量绘制"""
         if not self.drawing or self.mask_image is None:
             return
-            
+        
+        point = self.canvas_to_image(event.x, event.y)
+        if point is None:
+            # 移出图像范围时先画完已收集的点，并断开笔画，避免穿过图像外部连线
+            self.flush_stroke()
+            self.stroke_last_point = None
+            return
+        
+        self.stroke_points.append(point)
+        PROFILER.count("draw_events")
+        self.render_scheduler.request("stroke")
+    
+    def flush_stroke(self):
+        """立即把收集到的笔画点画到mask上，显示在下一帧刷新"""
+        box = self.rasterize_stroke()
+        if box is not None:
+            self.render_scheduler.request("mask", box=box)
+    
+    def rasterize_stroke(self):
+        """把收集到的笔画点一次性绘制到mask上，返回受影响区域（原图坐标）"""
+        if not self.stroke_points or self.mask_image is None:
+            return None
+        
         # 获取绘制参数
         brush_size = self.brush_scale.get()
         mode = self.mode_var.get()
+        color = self.brush_value() if mode == "add" else 0
         
-        # 转换画布坐标到图像坐标
-        canvas_x = event.x
-        canvas_y = event.y
-        
-        # 计算图像在canvas中的位置
-        h, w = self.mask_image.shape
-        scaled_w = int(w * self.scale_factor)
-        scaled_h = int(h * self.scale_factor)
+        # 从上一批的最后一个点接着画，保证笔画连续
+        points = self.stroke_points
+        if self.stroke_last_point is not None:
+            points = [self.stroke_last_point] + points
+        self.stroke_last_point = self.stroke_points[-1]
+        self.stroke_points = []
         
-        offset_x = (self.canvas_width - scaled_w) // 2
-        offset_y = (self.canvas_height - scaled_h) // 2
+        # 由会话在原始mask上绘制
+        select = self.threshold_selection if self.tool_var.get() == "threshold" else None
+        box = self.session.draw(points, brush_size, color, select)
+        self.stroke_modified = True
+        return box
+    
+    def threshold_selection(self, box):
+        """阈值笔刷：笔画范围内只修改灰度与参考值相差不超过容差的像素"""
+        tolerance = self.tolerance_scale.get()
+        reference = self.threshold_reference
+        gray = self.tool_gray(box)
+        return cv2.inRange(gray, max(0, reference - tolerance), min(255, reference + tolerance)) > 0
+    
+    def tool_image(self, box):
+        """区域工具使用的ROI图像（RGB uint8）；16位灰度图按当前窗宽/窗位映射，与屏幕所见一致"""
+        x0, y0, x1, y1 = box
+        roi = self.original_image[y0:y1, x0:x1]
+        if self.intensity is not None:
+            return self.intensity_window.apply(roi, self.intensity)
+        return roi.copy()
+    
+    def tool_gray(self, box):
+        return cv2.cvtColor(self.tool_image(box), cv2.COLOR_RGB2GRAY)
+    
+    def run_region_tool(self, tool, event):
+        """在光标周围的ROI上启动魔棒或GrabCut，计算在后台线程中进行"""
+        if self.mask_image is None or self.original_image is None:
+            return
+        if self.region_job is not None:
+            print("提示: 区域工具正在运行")
+            return
+        point = self.canvas_to_image(event.x, event.y)
+        if point is None:
+            return
         
-        # 转换到缩放后图像坐标
-        img_x = int((canvas_x - offset_x) / self.scale_factor)
-        img_y = int((canvas_y - offset_y) / self.scale_factor)
+        # ROI 对应屏幕上固定大小的范围，与缩放倍数无关
+        scale = self.view_cache["scale"][0] if self.view_cache else 1.0
+        radius = int(min(max(self.region_roi_radius / scale, 32), 768))
+        box = region_tool_roi(point, self.mask_image.shape, radius)
+        x0, y0, x1, y1 = box
+        image = self.tool_image(box)
+        value = self.brush_value() if self.mode_var.get() == "add" or tool == "grabcut" else 0
+        if tool == "wand":
+            future = self.region_executor.submit(magic_wand, image, (point[0] - x0, point[1] - y0),
+                                                 self.tolerance_scale.get())
+        else:
+            # 待定带宽度随ROI大小变化
+            future = self.region_executor.submit(grabcut_refine, image,
+                                                 self.mask_image[y0:y1, x0:x1].copy(),
+                                                 max(4, radius // 8))
+        self.region_job = (future, self.current_slice_key, tool, box, value)
+        self.root.after(20, self.poll_region_tool)
+    
+    def poll_region_tool(self):
+        """在界面线程中取回区域工具的结果并写入mask（可撤销）"""
+        future, key, tool, box, value = self.region_job
+        if not future.done():
+            self.root.after(20, self.poll_region_tool)
+            return
+        self.region_job = None
+        name = "魔棒" if tool == "wand" else "GrabCut"
+        try:
+            selected = future.result()
+        except Exception as e:
+            print(f"{name}失败: {e}")
+            return
+        if key != self.current_slice_key or self.mask_image is None:
+            return  # 计算期间切换了图像
+        if selected is None:
+            print(f"提示: {name}需要光标周围同时有前景和背景")
+            return
         
-        # 检查坐标是否在图像范围内
-        if 0 <= img_x < w and 0 <= img_y < h:
-            # 在原始mask上绘制
-            color = 255 if mode == "add" else 0
-            cv2.circle(self.mask_image, (img_x, img_y), brush_size, color, -1)
-            
-            # 更新显示
-            self.display_images()
-            
-            # 自动保存
-            if self.auto_save:
-                self.save_mask(show_message=False)
+        def update(roi):
+            if tool == "wand":
+                roi[selected] = value
+            else:
+                # 细化：保留原有前景的标签，新增前景写入当前标签
+                roi[~selected] = 0
+                roi[selected & (roi == 0)] = value
+        if not self.session.apply(box, update):
+            return
+        print(f"{name}: {int(selected.sum())} 像素")
+        self.update_label_areas()
+        self.render_scheduler.request("mask", box=box)
+        if self.auto_save:
+            self.queue_auto_save()
     
     def stop_draw(self, event):
+        if not self.drawing:
+            return
+        self.flush_stroke()
         self.drawing = False
         mode_text = "添加" if self.mode_var.get() == "add" else "擦除"
-        # 只在有实际绘制时才输出日志
+        # 一笔作为一步撤销记录
+        if self.session is not None:
+            self.session.end_stroke()
+        
+        # 自动保存：一笔结束后交给后台线程写入
+        if self.stroke_modified:
+            self.update_label_areas()
+            if self.auto_save:
+                self.queue_auto_save()
+        self.stroke_modified = False
+    
+    def queue_auto_save(self):
+        """将当前mask提交给后台写入线程，不阻塞界面"""
+        if self.mask_image is None or not self.current_mask_path:
+            return
+        self.mask_writer.submit(self.current_mask_path, self.mask_image.copy())
+        if self.current_slice_key is not None:
+            self.slice_cache.discard(self.current_slice_key)
+    
+    def poll_mask_writer(self):
+        """定期输出后台保存的错误信息"""
+        while self.mask_writer.errors:
+            path, error = self.mask_writer.errors.popleft()
+            print(f"自动保存失败: {self.slice_display_name(path)}, 错误: {error}")
+        self.root.after(200, self.poll_mask_writer)
         
     def reset_mask(self):
-        if self.mask_image is not None:
-            self.mask_image.fill(0)
-            self.display_images()
+        if self.mask_image is not None and not self.mask_scan_pending():
+            # 重置也可以撤销
+            h, w = self.mask_image.shape[:2]
+            self.session.apply((0, 0, w, h), lambda roi: roi.fill(0))
+            self.update_label_areas()
+            self.render_scheduler.request("mask")
             print("mask已重置")
+            if self.auto_save:
+                self.queue_auto_save()
+    
+    def undo(self, event=None):
+        """撤销上一笔"""
+        if self.mask_image is None or self.drawing:
+            return
+        box = self.session.undo()
+        if box is None:
+            print("提示: 没有可撤销的操作")
+            return
+        self.update_label_areas()
+        self.render_scheduler.request("mask", box=box)
+        if self.auto_save:
+            self.queue_auto_save()
+    
+    def redo(self, event=None):
+        """重做上一次撤销的操作"""
+        if self.mask_image is None or self.drawing:
+            return
+        box = self.session.redo()
+        if box is None:
+            print("提示: 没有可重做的操作")
+            return
+        self.update_label_areas()
+        self.render_scheduler.request("mask", box=box)
+        if self.auto_save:
+            self.queue_auto_save()
 
     def save_mask(self, show_message=True):
         if self.mask_image is None or not self.current_mask_path:
             if show_message:
                 print("警告: 无法保存mask")
             return False
+        if self.mask_scan_pending():
+            return False
             
-        try:
-            # 确保保存目录存在
-            save_dir = os.path.dirname(self.current_mask_path)
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir)
-            
-            # 使用PIL保存，支持中文路径
-            mask_pil = Image.fromarray(self.mask_image)
-            mask_pil.save(self.current_mask_path)
-            
-            if show_message:
-                print(f"保存成功: {os.path.basename(self.current_mask_path)}")
-            return True
-        except Exception as e:
-            print(f"保存失败: {str(e)}")
+        # 经由后台写入线程保存，保证与排队中的自动保存顺序一致，并等待写入完成
+        # 内容与磁盘上相同时写入线程会跳过，文件不会被重写
+        written = self.mask_writer.written
+        self.mask_writer.submit(self.current_mask_path, self.mask_image.copy(), delay=0)
+        error = self.mask_writer.flush(self.current_mask_path)
+        
+        # 磁盘上的mask已更新，丢弃缓存中的旧版本
+        if self.current_slice_key is not None:
+            self.slice_cache.discard(self.current_slice_key)
+        
+        if error is not None:
+            print(f"保存失败: {error}")
             return False
+        self.session.modified = False
+        if show_message:
+            name = self.slice_display_name(self.current_mask_path)
+            if self.mask_writer.written == written:
+                print(f"未修改，无需保存: {name}")
+            else:
+                print(f"保存成功: {name}")
+        return True
 
     def toggle_auto_save(self):
         """切换自动保存模式"""
@@ -485,12 +3474,41 @@ class MaskCorrectionGUI:
         status = "开启" if self.auto_save else "关闭"
         print(f"自动保存: {status}")
 
-    def save_all_masks(self):
-        if not self.mask_folder:
-            print("警告: 请先选择mask文件夹")
+    def save_all_masks(self, event=None):
+        """保存所有修改过的mask（包括切换图像后保留在内存中的），由写入线程并行、原子地写入
+        
+        内容与磁盘上相同的mask会被跳过，不会重写文件。
+        """
+        if self.drawing:
+            return
+        paths = self.mask_changes.dirty_paths()
+        if self.session is not None and self.session.modified and self.current_mask_path:
+            self.mask_writer.submit(self.current_mask_path, self.mask_image.copy(), delay=0)
+            paths.append(self.current_mask_path)
+        if not paths:
+            print("没有需要保存的修改")
             return
-            
-        print("提示: 保存所有功能需要您逐张检查并保存")
+        
+        written, skipped = self.mask_writer.written, self.mask_writer.skipped
+        failed = []
+        # 分批提交，避免一次把所有修改都解压到内存中
+        batch = 16
+        for start in range(0, len(paths), batch):
+            chunk = paths[start:start + batch]
+            for path in chunk:
+                mask = self.mask_changes.get(path)
+                if mask is not None:
+                    self.mask_writer.submit(path, mask, delay=0)
+            self.mask_writer.flush()
+            failed.extend(path for path in chunk if self.mask_writer.results.get(path) is not None)
+        
+        if self.session is not None and self.current_mask_path not in failed:
+            self.session.modified = False
+        written = self.mask_writer.written - written
+        skipped = self.mask_writer.skipped - skipped
+        print(f"保存全部: 写入 {written} 个mask，{skipped} 个内容未变化已跳过")
+        for path in failed:
+            print(f"保存失败: {self.slice_display_name(path)}, 错误: {self.mask_writer.results[path]}")
         
     def prev_image(self):
         if not self.image_files:
@@ -536,18 +3554,1402 @@ class MaskCorrectionGUI:
         # 清空输入框
         self.jump_entry.delete(0, tk.END)
 
-    def __del__(self):
-        """恢复标准输出"""
+    def run_qa_report(self):
+        """对当前图像/mask文件夹生成质量报告，结果写入文件并在表格中显示"""
+        if self.volume_path or not self.image_files:
+            print("错误: 质量报告需要先选择图像文件夹和Mask文件夹")
+            return
+        if self.folder_scans:
+            print("提示: 文件夹仍在扫描中，请稍后再生成质量报告")
+            return
+        if self.qa_run is not None:
+            print("提示: 质量报告正在生成中")
+            return
+        reference_folder = filedialog.askdirectory(title="选择参考Mask文件夹（用于计算Dice，取消则不计算）")
+        output_path = filedialog.asksaveasfilename(
+            title="保存质量报告", defaultextension=".csv", initialfile="qa_report.csv",
+            filetypes=[("CSV", "*.csv"), ("Parquet", "*.parquet")])
+        if not output_path:
+            return
+        
+        # 先写入排队中的自动保存，报告统计的是磁盘上的mask
+        self.mask_writer.flush()
+        
+        self.qa_run = QARun(list(self.image_files), self.mask_index, output_path,
+                            os.cpu_count() or 1, reference_folder or None)
+        self.show_qa_window()
+        print(f"开始生成质量报告: {len(self.image_files)} 张图像")
+        self.root.after(100, self.poll_qa)
+    
+    def poll_qa(self):
+        """取回质量报告的新结果并加入表格"""
+        qa_run = self.qa_run
+        if qa_run is None:
+            return
+        new_rows, finished = qa_run.drain()
+        if self.qa_tree is not None:
+            for row in new_rows:
+                self.qa_tree.insert("", tk.END, iid=str(row["index"]), values=self.qa_values(row))
+        if not finished:
+            self.root.after(200, self.poll_qa)
+            return
+        self.qa_run = None
+        if qa_run.error:
+            print(f"质量报告失败: {qa_run.error}")
+            return
+        counts = {}
+        for row in qa_run.rows:
+            counts[row["state"]] = counts.get(row["state"], 0) + 1
+        print(f"质量报告完成: {len(qa_run.rows)}/{qa_run.total} 张，已写入 {qa_run.output_path}")
+        print("  " + ", ".join(f"{state}: {count}" for state, count in sorted(counts.items())))
+    
+    def show_qa_window(self):
+        """打开（或清空）质量报告表格窗口；点击列标题排序，双击一行跳转到该图像"""
+        if self.qa_window is None or not self.qa_window.winfo_exists():
+            self.qa_window = tk.Toplevel(self.root)
+            self.qa_window.title("质量报告")
+            self.qa_window.geometry("1000x500")
+            columns = [field for field in QA_FIELDS if field not in ("image", "mask")]
+            columns.insert(1, "name")
+            self.qa_tree = ttk.Treeview(self.qa_window, columns=columns, show="headings")
+            for column in columns:
+                self.qa_tree.heading(column, text=column,
+                                     command=lambda c=column: self.sort_qa_table(c))
+                self.qa_tree.column(column, width=200 if column == "name" else 70,
+                                    anchor=tk.W if column == "name" else tk.E)
+            scrollbar = ttk.Scrollbar(self.qa_window, orient=tk.VERTICAL, command=self.qa_tree.yview)
+            self.qa_tree.configure(yscrollcommand=scrollbar.set)
+            scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+            self.qa_tree.pack(fill=tk.BOTH, expand=True)
+            self.qa_tree.bind("<Double-1>", self.jump_to_qa_row)
+        else:
+            self.qa_tree.delete(*self.qa_tree.get_children())
+        self.qa_sort = (None, False)
+    
+    def qa_values(self, row):
+        """报告中的一行在表格中显示的值"""
+        values = []
+        for column in self.qa_tree["columns"]:
+            if column == "name":
+                value = os.path.basename(row["image"])
+            elif column == "index":
+                value = row["index"] + 1  # 与跳转输入框一致，从1开始
+            else:
+                value = row[column]
+            values.append("" if value is None else value)
+        return values
+    
+    def sort_qa_table(self, column):
+        """按列排序，再次点击同一列时反向；数值按大小排序，空值始终排在最后"""
+        previous, descending = self.qa_sort
+        descending = not descending if column == previous else False
+        self.qa_sort = (column, descending)
+        
+        def key(item):
+            value = self.qa_tree.set(item, column)
+            try:
+                return (0, float(value), "")
+            except ValueError:
+                return (0 if value else 1, 0.0, value)
+        
+        items = list(self.qa_tree.get_children())
+        filled = [item for item in items if self.qa_tree.set(item, column) != ""]
+        empty = [item for item in items if self.qa_tree.set(item, column) == ""]
+        filled.sort(key=key, reverse=descending)
+        for position, item in enumerate(filled + empty):
+            self.qa_tree.move(item, "", position)
+    
+    def jump_to_qa_row(self, event=None):
+        """双击报告中的一行：跳转到对应图像"""
+        selection = self.qa_tree.selection()
+        if not selection:
+            return
+        self.jump_entry.delete(0, tk.END)
+        self.jump_entry.insert(0, str(int(selection[0]) + 1))
+        self.jump_to_image()
+
+    def on_close(self):
+        """关闭窗口时写入所有待保存的mask，并停止后台线程
+        
+        还有未保存的修改时询问是否保存，选择取消则不关闭。
+        """
+        self.mask_writer.flush()
+        unsaved = len(self.mask_changes)
+        # 无论是否开启自动保存，都按内容判断当前mask是否已写入磁盘
+        # （自动保存开启之前的修改不会被自动保存）
+        if (self.session is not None and self.session.modified and self.current_mask_path
+                and self.mask_changes.is_changed(self.current_mask_path, mask_digest(self.mask_image))):
+            unsaved += 1
+        if unsaved:
+            answer = messagebox.askyesnocancel("未保存的修改", f"有 {unsaved} 个mask的修改尚未保存，是否保存？")
+            if answer is None:
+                return
+            if answer:
+                self.save_all_masks()
+        for scan in self.folder_scans.values():
+            scan.cancel()
+        if self.qa_run is not None:
+            self.qa_run.cancel()
+        self.mask_writer.close()
+        while self.mask_writer.errors:
+            path, error = self.mask_writer.errors.popleft()
+            print(f"自动保存失败: {self.slice_display_name(path)}, 错误: {error}")
+        for future, _ in self.prefetch_futures.values():
+            future.cancel()
+        self.prefetch_executor.shutdown(wait=False)
+        self.region_executor.shutdown(wait=False)
+        if PROFILER.enabled and PROFILE_SETTING.lower().endswith(".json"):
+            try:
+                PROFILER.dump(PROFILE_SETTING)
+            except OSError as e:
+                print(f"写入性能统计失败: {e}")
+        self.restore_stdout()
+        self.root.destroy()
+    
+    def restore_stdout(self):
+        """恢复标准输出并移除日志处理器"""
         if hasattr(self, 'original_stdout'):
             sys.stdout = self.original_stdout
+        for handler in getattr(self, 'log_handlers', []):
+            logger.removeHandler(handler)
+            handler.close()
+        self.log_handlers = []
+    
+    def __del__(self):
+        """恢复标准输出"""
+        self.restore_stdout()
+
+# ---------------------------------------------------------------------------
+# 命令行批处理（无需图形界面）
+# ---------------------------------------------------------------------------
+
+BATCH_OPERATIONS = ["binarize", "fill_holes", "remove_small", "open", "close"]
+
+
+def fill_mask_holes(mask):
+    """填充mask内部的孔洞（与图像边界不连通的背景区域），孔洞填为mask自身的前景值
+    
+    漫水填充在二值副本上进行，0/1 mask 填充后仍为 0/1；前景有多个取值时应逐个标签处理。
+    """
+    # 四周补一圈背景，保证从角点出发的漫水填充能到达所有外部背景
+    background = cv2.copyMakeBorder((mask > 0).astype(np.uint8) * 255, 1, 1, 1, 1,
+                                    cv2.BORDER_CONSTANT, value=0)
+    flood_mask = np.zeros((background.shape[0] + 2, background.shape[1] + 2), np.uint8)
+    cv2.floodFill(background, flood_mask, (0, 0), 255)
+    holes = background[1:-1, 1:-1] == 0
+    result = mask.copy()
+    if holes.any():
+        result[holes] = mask.max()
+    return result
+
+
+def remove_small_components(mask, min_area):
+    """去除面积小于 min_area 的连通域"""
+    _, labels, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8), connectivity=8)
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+    keep[0] = False  # 背景
+    return np.where(keep[labels], mask, 0).astype(mask.dtype)
+
+
+def mask_labels(mask):
+    """标签图中出现的非零标签"""
+    labels = np.unique(mask)
+    return labels[labels != 0]
+
+
+def is_label_map(mask):
+    """是否按标签图处理：16位mask，或有多个非零取值的8位mask"""
+    return mask.dtype != np.uint8 or len(mask_labels(mask)) > 1
+
+
+def apply_label_operation(mask, op, min_area, kernel):
+    """对标签图逐个标签执行操作，结果仍为原来的标签值
+    
+    填充孔洞和闭运算只会占用背景像素，不会覆盖其他标签；开运算和去除小连通域只会把像素置为背景。
+    """
+    result = mask.copy() if op in ("fill_holes", "close", "remove_small") else np.zeros_like(mask)
+    for label in mask_labels(mask):
+        binary = (mask == label).astype(np.uint8) * 255
+        if op == "fill_holes":
+            result[(fill_mask_holes(binary) > 0) & (result == 0)] = label
+        elif op == "remove_small":
+            result[(binary > 0) & (remove_small_components(binary, min_area) == 0)] = 0
+        elif op == "open":
+            result[cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel) > 0] = label
+        else:
+            result[(cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel) > 0) & (result == 0)] = label
+    return result
+
+
+def apply_mask_operations(mask, operations, threshold=127, min_area=64, kernel_size=5):
+    """按顺序对mask执行批处理操作，返回新的mask
+    
+    只有一个前景值的8位mask按原有方式处理；标签图（16位，或8位但有多个非零取值）逐个标签处理
+    并保留标签值，不支持二值化。
+    """
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
+    if is_label_map(mask):
+        if "binarize" in operations:
+            raise ValueError("标签图不支持 binarize，二值化会丢失标签")
+        for op in operations:
+            if op not in BATCH_OPERATIONS:
+                raise ValueError(f"未知的操作: {op}")
+            mask = apply_label_operation(mask, op, min_area, kernel)
+        return mask
+    for op in operations:
+        if op == "binarize":
+            mask = np.where(mask > threshold, 255, 0).astype(np.uint8)
+        elif op == "fill_holes":
+            mask = fill_mask_holes(mask)
+        elif op == "remove_small":
+            mask = remove_small_components(mask, min_area)
+        elif op == "open":
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+        elif op == "close":
+            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+        else:
+            raise ValueError(f"未知的操作: {op}")
+    return mask
+
+
+def run_batch_task(task):
+    """处理一组图像/mask，在子进程中运行
+    
+    返回 (状态, 文件路径, 错误信息)，状态为 changed/unchanged/created/missing/error。
+    """
+    image_path, mask_path, output_path, options = task
+    try:
+        if mask_path is None:
+            if output_path is None:
+                return ("missing", image_path, None)
+            # 为没有mask的图像创建空mask，只读取图像文件头获取尺寸
+            with Image.open(image_path) as im:
+                w, h = im.size
+            write_mask_atomic(output_path, np.zeros((h, w), dtype=np.uint8), options["codec"])
+            return ("created", output_path, None)
+        
+        # 保留16位标签图的原始取值，按8位读取会截断标签
+        mask = read_mask_file(mask_path)
+        if mask is None:
+            return ("error", mask_path, "无法解码mask")
+        result = apply_mask_operations(mask, options["operations"], options["threshold"],
+                                       options["min_area"], options["kernel_size"])
+        # 原地处理且内容未变化时不重写文件
+        if output_path == mask_path and np.array_equal(result, mask):
+            return ("unchanged", mask_path, None)
+        write_mask_atomic(output_path, result, options["codec"])
+        return ("changed", output_path, None)
+    except Exception as e:
+        return ("error", mask_path or image_path, str(e))
+
+
+def build_batch_tasks(image_files, mask_index, mask_folder, output_folder, create_empty, options):
+    """根据图像/mask配对结果生成批处理任务列表"""
+    tasks = []
+    for image_path, mask_path in pair_images_with_masks(image_files, mask_index):
+        if mask_path is not None:
+            output_path = os.path.join(output_folder, os.path.basename(mask_path)) if output_folder else mask_path
+        elif create_empty:
+            image_name = os.path.splitext(os.path.basename(image_path))[0]
+            output_path = os.path.join(output_folder or mask_folder, f"{image_name}{options['codec'].extension}")
+        else:
+            output_path = None
+        tasks.append((image_path, mask_path, output_path, options))
+    return tasks
+
+
+def batch_main(argv=None):
+    """命令行批处理入口：对整个数据集的mask执行批量清理"""
+    parser = argparse.ArgumentParser(
+        prog="correct_mask_gui.py batch",
+        description="批量处理mask：二值化、填充孔洞、去除小连通域、开/闭运算，以及为缺失mask的图像创建空mask")
+    parser.add_argument("--images", required=True, help="图像文件夹")
+    parser.add_argument("--masks", required=True, help="mask文件夹")
+    parser.add_argument("--output", default=None, help="输出文件夹（默认原地覆盖mask）")
+    parser.add_argument("--ops", default="",
+                        help="按顺序执行的操作，逗号分隔，可选: " + ", ".join(BATCH_OPERATIONS))
+    parser.add_argument("--threshold", type=int, default=127, help="二值化阈值")
+    parser.add_argument("--min-area", type=int, default=64, help="remove_small 保留的最小连通域面积（像素）")
+    parser.add_argument("--kernel", type=int, default=5, help="开/闭运算的结构元素大小")
+    parser.add_argument("--create-empty", action="store_true", help="为没有mask的图像创建空mask")
+    parser.add_argument("--mask-format", choices=list(MaskCodec.FORMATS), default=MASK_CODEC.format,
+                        help="新建mask的格式：png、png1（1位PNG）、npz")
+    parser.add_argument("--png-level", type=int, choices=range(10), default=MASK_CODEC.png_level,
+                        help="PNG压缩级别 0-9")
+    parser.add_argument("--png-rle", action="store_true", default=MASK_CODEC.png_rle,
+                        help="PNG使用RLE压缩策略（编码更快）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="进程数")
+    args = parser.parse_args(argv)
+    
+    operations = [op.strip() for op in args.ops.split(",") if op.strip()]
+    unknown = [op for op in operations if op not in BATCH_OPERATIONS]
+    if unknown:
+        parser.error(f"未知的操作: {', '.join(unknown)}")
+    if not operations and not args.create_empty:
+        parser.error("请通过 --ops 指定操作或使用 --create-empty")
+    
+    image_files = scan_image_folder(args.images)
+    mask_files = scan_image_folder(args.masks, extensions=MASK_EXTENSIONS)
+    print(f"图像文件夹: 找到 {len(image_files)} 个文件")
+    print(f"Mask文件夹: 找到 {len(mask_files)} 个文件")
+    
+    options = {"operations": operations, "threshold": args.threshold,
+               "min_area": args.min_area, "kernel_size": args.kernel,
+               "codec": MaskCodec(args.mask_format, args.png_level, args.png_rle)}
+    tasks = build_batch_tasks(image_files, MaskIndex(mask_files), args.masks,
+                              args.output, args.create_empty, options)
+    if not operations:
+        # 只创建空mask时跳过已有mask的图像
+        tasks = [task for task in tasks if task[1] is None]
+    
+    counts = {}
+    errors = []
+    start = time.perf_counter()
+    last_report = start
+    
+    def report(done):
+        elapsed = time.perf_counter() - start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        print(f"进度: {done}/{len(tasks)} ({rate:.1f} 张/秒)")
+    
+    if args.workers > 1 and len(tasks) > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers)
+        chunksize = max(1, min(256, len(tasks) // (args.workers * 8)))
+        results = executor.map(run_batch_task, tasks, chunksize=chunksize)
+    else:
+        executor = None
+        results = map(run_batch_task, tasks)
+    
+    try:
+        for done, (status, path, error) in enumerate(results, 1):
+            counts[status] = counts.get(status, 0) + 1
+            if error is not None:
+                errors.append((path, error))
+            now = time.perf_counter()
+            if now - last_report >= 1.0:
+                report(done)
+                last_report = now
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    
+    elapsed = time.perf_counter() - start
+    report(len(tasks))
+    print(f"完成: 共 {len(tasks)} 张，用时 {elapsed:.1f} 秒，"
+          f"吞吐量 {len(tasks) / elapsed if elapsed > 0 else 0.0:.1f} 张/秒")
+    print("  " + ", ".join(f"{status}: {count}" for status, count in sorted(counts.items())))
+    for path, error in errors[:20]:
+        print(f"  失败: {path}, 错误: {error}")
+    if len(errors) > 20:
+        print(f"  ... 另有 {len(errors) - 20} 个错误")
+    return 1 if errors else 0
+
+
+# 质量报告的列
+QA_FIELDS = ["index", "image", "mask", "state", "area", "components", "holes",
+             "x0", "y0", "x1", "y1", "touches_border", "dice"]
 
-def main():
+
+def mask_qa_metrics(mask):
+    """mask的统计量：面积、连通域数（8连通）、孔洞数、外接矩形、是否接触图像边界"""
+    foreground = (mask > 0).astype(np.uint8)
+    h, w = foreground.shape[:2]
+    area = int(cv2.countNonZero(foreground))
+    metrics = {"area": area, "components": 0, "holes": 0,
+               "x0": None, "y0": None, "x1": None, "y1": None, "touches_border": False}
+    if area == 0:
+        return metrics
+    metrics["components"] = cv2.connectedComponents(foreground, connectivity=8)[0] - 1
+    
+    # 孔洞：不与图像边界相连的背景连通域（背景按4连通，与前景的8连通互补）
+    _, _, stats, _ = cv2.connectedComponentsWithStats(1 - foreground, connectivity=4)
+    x, y, bw, bh = stats[1:, 0], stats[1:, 1], stats[1:, 2], stats[1:, 3]
+    metrics["holes"] = int(np.count_nonzero((x > 0) & (y > 0) & (x + bw < w) & (y + bh < h)))
+    
+    bx, by, bw, bh = cv2.boundingRect(foreground)
+    metrics.update(x0=bx, y0=by, x1=bx + bw, y1=by + bh,
+                   touches_border=bool(bx == 0 or by == 0 or bx + bw == w or by + bh == h))
+    return metrics
+
+
+def dice_score(mask, reference):
+    """两个mask前景的Dice系数，都为空时为1"""
+    a = mask > 0
+    b = reference > 0
+    total = int(np.count_nonzero(a)) + int(np.count_nonzero(b))
+    if total == 0:
+        return 1.0
+    return 2.0 * int(np.count_nonzero(a & b)) / total
+
+
+def run_qa_task(task):
+    """计算一组图像/mask的质量指标，在子进程中运行；返回报告中的一行"""
+    index, image_path, mask_path, reference_path = task
+    row = dict.fromkeys(QA_FIELDS)
+    row.update(index=index, image=image_path, mask=mask_path, state="missing")
+    if mask_path is None:
+        return row
+    try:
+        mask = read_mask_file(mask_path)
+    except Exception:
+        mask = None
+    if mask is None:
+        row["state"] = "corrupt"
+        return row
+    row.update(mask_qa_metrics(mask))
+    row["state"] = "ok" if row["area"] > 0 else "empty"
+    if reference_path is not None:
+        try:
+            reference = read_mask_file(reference_path)
+            if reference is not None and reference.shape[:2] == mask.shape[:2]:
+                row["dice"] = round(dice_score(mask, reference), 6)
+        except Exception:
+            pass
+    return row
+
+
+def build_qa_tasks(image_files, mask_index, reference_index=None):
+    """根据图像/mask配对结果生成质量报告任务；index 为图像在列表中的序号"""
+    tasks = []
+    for index, (image_path, mask_path) in enumerate(pair_images_with_masks(image_files, mask_index)):
+        reference_path = reference_index.find(image_path) if reference_index is not None else None
+        tasks.append((index, image_path, mask_path, reference_path))
+    return tasks
+
+
+def iter_qa_rows(tasks, workers):
+    """在进程池中计算质量指标，按任务顺序逐行产出结果
+    
+    界面中由后台线程调用，此时进程里还有Tk和其他线程在运行，fork 出的子进程可能继承
+    被占用的锁而卡死，因此子进程一律用 spawn 方式启动。
+    """
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            chunksize = max(1, min(256, len(tasks) // (workers * 8)))
+            for row in executor.map(run_qa_task, tasks, chunksize=chunksize):
+                yield row
+    else:
+        for task in tasks:
+            yield run_qa_task(task)
+
+
+class QAReportWriter:
+    """逐行写入质量报告：扩展名为 .parquet 时写Parquet（需要pyarrow，分批写入），否则写CSV"""
+    
+    def __init__(self, path, batch_size=1024):
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = []
+        self.parquet = path.lower().endswith(".parquet")
+        if self.parquet:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise RuntimeError("写入Parquet需要安装pyarrow（pip install pyarrow），或改用 .csv 输出")
+            self.pa = pyarrow
+            self.schema = pyarrow.schema([
+                ("index", pyarrow.int64()), ("image", pyarrow.string()), ("mask", pyarrow.string()),
+                ("state", pyarrow.string()), ("area", pyarrow.int64()), ("components", pyarrow.int64()),
+                ("holes", pyarrow.int64()), ("x0", pyarrow.int64()), ("y0", pyarrow.int64()),
+                ("x1", pyarrow.int64()), ("y1", pyarrow.int64()), ("touches_border", pyarrow.bool_()),
+                ("dice", pyarrow.float64())])
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.file = open(path, "w", newline="", encoding="utf-8")
+            self.writer = csv.DictWriter(self.file, fieldnames=QA_FIELDS)
+            self.writer.writeheader()
+    
+    def write(self, row):
+        if not self.parquet:
+            self.writer.writerow(row)
+            return
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush_rows()
+    
+    def flush_rows(self):
+        if self.rows:
+            self.writer.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+    
+    def close(self):
+        if self.parquet:
+            self.flush_rows()
+            self.writer.close()
+        else:
+            self.file.close()
+
+
+class QARun:
+    """在后台线程中生成质量报告（指标在进程池中计算），界面线程通过 drain 分批取回结果
+    
+    参考mask文件夹也在后台线程中扫描；线程中不打印日志，由界面线程汇报进度。
+    """
+    
+    def __init__(self, image_files, mask_index, output_path, workers, reference_folder=None):
+        self.image_files = image_files
+        self.mask_index = mask_index
+        self.reference_folder = reference_folder
+        self.output_path = output_path
+        self.workers = workers
+        self.total = len(image_files)
+        self.rows = []
+        self.error = None
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="QARun", daemon=True)
+        self.thread.start()
+    
+    def run(self):
+        try:
+            reference_index = None
+            if self.reference_folder:
+                reference_index = MaskIndex(scan_image_folder(self.reference_folder, extensions=MASK_EXTENSIONS))
+            tasks = build_qa_tasks(self.image_files, self.mask_index, reference_index)
+            writer = QAReportWriter(self.output_path)
+            try:
+                for row in iter_qa_rows(tasks, self.workers):
+                    writer.write(row)
+                    self.results.put(row)
+                    if self.cancelled.is_set():
+                        break
+            finally:
+                writer.close()
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.results.put(None)  # 结束标记
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    def drain(self):
+        """取回目前为止新完成的行，返回 (新行列表, 是否已结束)"""
+        new_rows = []
+        finished = False
+        while True:
+            try:
+                row = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if row is None:
+                finished = True
+                break
+            new_rows.append(row)
+        self.rows.extend(new_rows)
+        return new_rows, finished
+
+
+def qa_main(argv=None):
+    """命令行质量报告入口：统计整个数据集的mask，输出CSV/Parquet报告"""
+    parser = argparse.ArgumentParser(
+        prog="correct_mask_gui.py qa",
+        description="生成mask质量报告：面积、连通域数、孔洞数、外接矩形、是否接触边界、空/缺失mask，以及与参考mask的Dice")
+    parser.add_argument("--images", required=True, help="图像文件夹")
+    parser.add_argument("--masks", required=True, help="mask文件夹")
+    parser.add_argument("--reference", default=None, help="参考mask文件夹（可选，用于计算Dice）")
+    parser.add_argument("--output", required=True, help="报告文件（.csv 或 .parquet）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="进程数")
+    args = parser.parse_args(argv)
+    
+    image_files = scan_image_folder(args.images)
+    mask_files = scan_image_folder(args.masks, extensions=MASK_EXTENSIONS)
+    print(f"图像文件夹: 找到 {len(image_files)} 个文件")
+    print(f"Mask文件夹: 找到 {len(mask_files)} 个文件")
+    reference_index = MaskIndex(scan_image_folder(args.reference, extensions=MASK_EXTENSIONS)) if args.reference else None
+    tasks = build_qa_tasks(image_files, MaskIndex(mask_files), reference_index)
+    
+    try:
+        writer = QAReportWriter(args.output)
+    except (RuntimeError, OSError) as e:
+        print(f"错误: {e}")
+        return 2
+    counts = {}
+    start = time.perf_counter()
+    last_report = start
+    try:
+        for done, row in enumerate(iter_qa_rows(tasks, args.workers), 1):
+            writer.write(row)
+            counts[row["state"]] = counts.get(row["state"], 0) + 1
+            now = time.perf_counter()
+            if now - last_report >= 1.0:
+                print(f"进度: {done}/{len(tasks)}")
+                last_report = now
+    finally:
+        writer.close()
+    
+    elapsed = time.perf_counter() - start
+    print(f"完成: 共 {len(tasks)} 张，用时 {elapsed:.1f} 秒，报告已写入 {args.output}")
+    print("  " + ", ".join(f"{state}: {count}" for state, count in sorted(counts.items())))
+    return 0
+
+
+def generate_bench_dataset(folder, count, size, seed=0):
+    """生成基准测试用的大图（平滑随机纹理）和mask（若干实心圆），返回 (图像列表, mask列表)"""
+    rng = np.random.default_rng(seed)
+    image_dir = os.path.join(folder, "images")
+    mask_dir = os.path.join(folder, "masks")
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(mask_dir, exist_ok=True)
+    image_files, mask_files = [], []
+    for index in range(count):
+        image_path = os.path.join(image_dir, f"bench_{index:03d}.png")
+        mask_path = os.path.join(mask_dir, f"bench_{index:03d}.png")
+        if not (os.path.exists(image_path) and os.path.exists(mask_path)):
+            noise = rng.integers(0, 256, (max(1, size // 32), max(1, size // 32), 3), dtype=np.uint8)
+            image = cv2.resize(noise, (size, size), interpolation=cv2.INTER_CUBIC)
+            mask = np.zeros((size, size), dtype=np.uint8)
+            for _ in range(5):
+                center = tuple(int(v) for v in rng.integers(size // 8, size - size // 8, 2))
+                cv2.circle(mask, center, int(rng.integers(size // 32, size // 8)), 255, -1)
+            cv2.imwrite(image_path, image)
+            write_mask_atomic(mask_path, mask)
+        image_files.append(image_path)
+        mask_files.append(mask_path)
+    return image_files, mask_files
+
+
+def synthetic_stroke_trace(shape, events):
+    """合成的笔刷轨迹：横跨图像的正弦曲线，相邻点间距与快速拖动鼠标时相近"""
+    h, w = shape[:2]
+    t = np.linspace(0.0, 1.0, events)
+    xs = w * (0.1 + 0.8 * t)
+    ys = h * (0.5 + 0.3 * np.sin(t * 6 * np.pi))
+    return [(int(x), int(y)) for x, y in zip(xs, ys)]
+
+
+def fit_view(shape, canvas):
+    """适应窗口显示时的视口参数（与界面中 zoom=1 的 compute_view 相同）"""
+    h, w = shape[:2]
+    s = min(canvas[0] / w, canvas[1] / h)
+    return {"origin": (0.0, 0.0), "scale": (s, s), "size": (int(w * s), int(h * s))}
+
+
+def run_benchmark(image_files, mask_files, canvas=(550, 500), events=2000,
+                  points_per_frame=8, brush=10, repeat=3, save_folder=None):
+    """不依赖Tk回放界面的热点路径，各阶段耗时记录在 PROFILER 中
+    
+    每轮先按 前进→后退 的顺序浏览所有切片（解码、重采样、轮廓、叠加合成、PhotoImage数据编码），
+    再在最后一张上回放合成的笔刷轨迹（每帧 points_per_frame 个点，局部刷新），最后保存该mask。
+    编辑和渲染与界面一样经由 MaskSession，各阶段的计时也在其中记录。
+    """
+    compositor = OverlayCompositor()
+    order = list(range(len(image_files))) + list(range(len(image_files) - 2, -1, -1))
+    save_path = os.path.join(save_folder or tempfile.gettempdir(), "bench_saved_mask.png")
+    for _ in range(repeat):
+        for index in order:
+            with PROFILER.stage("navigate"):
+                entry = load_slice(image_files[index], mask_files[index])
+                session = MaskSession(entry, compositor=compositor)
+                view = fit_view(entry["image"].shape, canvas)
+                session.set_view(view, session.sample_image(view))
+                overlay = session.compose()
+                with PROFILER.stage("photo"):
+                    for array in (session.display_image, session.display_mask, overlay):
+                        ppm_data(array)
+            PROFILER.count("navigations")
+        
+        trace = synthetic_stroke_trace(session.mask.shape, events)
+        last_point = None
+        for start in range(0, len(trace), points_per_frame):
+            points = trace[start:start + points_per_frame]
+            PROFILER.count("draw_events", len(points))
+            if last_point is not None:
+                points = [last_point] + points
+            last_point = points[-1]
+            with PROFILER.stage("frame"):
+                regions = session.render(session.draw(points, brush, 255))
+                if regions is None:
+                    continue
+                (x0, y0, x1, y1), (ox0, oy0, ox1, oy1) = regions
+                with PROFILER.stage("photo_region"):
+                    ppm_data(session.display_mask[y0:y1, x0:x1])
+                    ppm_data(session.frame[oy0:oy1, ox0:ox1])
+        session.end_stroke()
+        write_mask(save_path, session.mask)
+    if os.path.exists(save_path):
+        os.remove(save_path)
+
+
+def compare_benchmark(snapshot, baseline, tolerance, min_ms=0.05):
+    """与基准结果比较各阶段平均耗时，返回变慢超过 tolerance 倍的阶段 [(阶段, 当前ms, 基准ms), ...]"""
+    regressions = []
+    for name, stage in baseline.get("stages", {}).items():
+        current = snapshot["stages"].get(name)
+        if current is None or stage["mean_ms"] < min_ms:
+            continue
+        if current["mean_ms"] > stage["mean_ms"] * tolerance:
+            regressions.append((name, current["mean_ms"], stage["mean_ms"]))
+    return regressions
+
+
+def bench_main(argv=None):
+    """命令行基准测试入口：在生成的大图上回放浏览和笔刷操作，输出各阶段耗时"""
+    parser = argparse.ArgumentParser(
+        prog="correct_mask_gui.py bench",
+        description="无界面基准测试：在生成的大图上回放切片浏览与笔刷轨迹，统计解码/重采样/叠加/保存等阶段耗时")
+    parser.add_argument("--count", type=int, default=6, help="生成的图像数量")
+    parser.add_argument("--size", type=int, default=4096, help="生成图像的边长（像素）")
+    parser.add_argument("--canvas", default="550x500", help="模拟的显示区域尺寸，宽x高")
+    parser.add_argument("--events", type=int, default=2000, help="笔刷轨迹的鼠标事件数")
+    parser.add_argument("--points-per-frame", type=int, default=8, help="每帧合并绘制的事件数")
+    parser.add_argument("--brush", type=int, default=10, help="笔刷半径（原图像素）")
+    parser.add_argument("--repeat", type=int, default=3, help="重复轮数")
+    parser.add_argument("--workdir", default=None, help="测试数据目录（保留并复用生成的图像），默认使用临时目录")
+    parser.add_argument("--json", default=None, help="把统计结果写入JSON文件")
+    parser.add_argument("--baseline", default=None, help="基准JSON文件，阶段平均耗时变慢超过 --tolerance 倍时返回非零")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="允许的变慢倍数")
+    args = parser.parse_args(argv)
+    
+    try:
+        canvas = tuple(int(v) for v in args.canvas.lower().split("x"))
+        if len(canvas) != 2:
+            raise ValueError
+    except ValueError:
+        parser.error("--canvas 格式应为 宽x高，例如 550x500")
+    
+    with tempfile.TemporaryDirectory(prefix="medmask_bench_") as tmp:
+        folder = args.workdir or tmp
+        print(f"生成测试数据: {args.count} 张 {args.size}x{args.size} 图像 -> {folder}")
+        image_files, mask_files = generate_bench_dataset(folder, args.count, args.size)
+        
+        PROFILER.reset()
+        PROFILER.enabled = True
+        run_benchmark(image_files, mask_files, canvas, args.events, args.points_per_frame,
+                      args.brush, args.repeat, folder)
+        PROFILER.enabled = False
+    
+    snapshot = PROFILER.snapshot()
+    snapshot["config"] = {key: value for key, value in vars(args).items()
+                          if key not in ("json", "baseline", "workdir")}
+    for line in PROFILER.report_lines():
+        print(line)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, indent=2)
+        print(f"统计结果已写入 {args.json}")
+    
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_benchmark(snapshot, baseline, args.tolerance)
+        for name, current, previous in regressions:
+            print(f"变慢: {name} 平均 {current:.2f} ms（基准 {previous:.2f} ms）")
+        if regressions:
+            return 1
+        print(f"与基准相比没有超过 {args.tolerance} 倍的变慢")
+    return 0
+
+
+# 格式比较工具中参与比较的编码方式：(名称, 扩展名, MaskCodec 或 None 表示原来的PIL默认设置)
+CODEC_CANDIDATES = [
+    ("png-pil", ".png", None),
+    ("png", ".png", MaskCodec("png", 6)),
+    ("png-l1", ".png", MaskCodec("png", 1)),
+    ("png-rle", ".png", MaskCodec("png", 6, png_rle=True)),
+    ("png1", ".png", MaskCodec("png1", 6)),
+    ("png1-rle", ".png", MaskCodec("png1", 6, png_rle=True)),
+    ("npz", ".npz", MaskCodec("npz")),
+]
+
+
+def encode_mask_pil(mask):
+    """原来的保存方式：PIL默认设置的PNG，用作比较的基准"""
+    buffer = BytesIO()
+    Image.fromarray(mask).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def compare_mask_codecs(mask_files, candidates=CODEC_CANDIDATES):
+    """对每种编码方式统计编码/解码耗时、文件大小以及是否无损，返回结果列表"""
+    results = {name: {"format": name, "files": 0, "bytes": 0, "encode_ms": 0.0, "decode_ms": 0.0,
+                      "lossless": 0} for name, _, _ in candidates}
+    read_ms = 0.0
+    source_bytes = 0
+    masks = 0
+    for path in mask_files:
+        start = time.perf_counter()
+        try:
+            mask = read_mask_file(path)
+        except Exception:
+            mask = None
+        read_ms += (time.perf_counter() - start) * 1000
+        if mask is None:
+            continue
+        masks += 1
+        source_bytes += os.path.getsize(path)
+        for name, ext, codec in candidates:
+            result = results[name]
+            start = time.perf_counter()
+            data = encode_mask_pil(mask) if codec is None else codec.encode(mask, ext)
+            middle = time.perf_counter()
+            decoded = decode_mask_bytes(data, ext)
+            end = time.perf_counter()
+            result["files"] += 1
+            result["bytes"] += len(data)
+            result["encode_ms"] += (middle - start) * 1000
+            result["decode_ms"] += (end - middle) * 1000
+            result["lossless"] += int(decoded is not None and decoded.dtype == mask.dtype and
+                                      np.array_equal(decoded, mask))
+    for result in results.values():
+        files = max(1, result["files"])
+        result["encode_ms"] = round(result["encode_ms"] / files, 3)
+        result["decode_ms"] = round(result["decode_ms"] / files, 3)
+    summary = {"masks": masks, "source_bytes": source_bytes,
+               "read_ms": round(read_ms / max(1, masks), 3)}
+    return summary, list(results.values())
+
+
+def codecs_main(argv=None):
+    """命令行格式比较入口：在样例mask上比较各种编码方式的耗时与文件大小"""
+    parser = argparse.ArgumentParser(
+        prog="correct_mask_gui.py codecs",
+        description="比较mask的保存格式：PNG压缩级别/RLE策略、1位PNG、npz，输出每种格式的编码/解码耗时与文件大小")
+    parser.add_argument("--masks", required=True, help="样例mask文件夹")
+    parser.add_argument("--limit", type=int, default=200, help="最多使用的mask数量")
+    parser.add_argument("--json", default=None, help="把结果写入JSON文件")
+    args = parser.parse_args(argv)
+    
+    mask_files = scan_image_folder(args.masks, extensions=MASK_EXTENSIONS)[:args.limit]
+    if not mask_files:
+        print("错误: 文件夹中没有mask文件")
+        return 2
+    summary, results = compare_mask_codecs(mask_files)
+    print(f"样例: {summary['masks']} 个mask，原文件共 {summary['source_bytes'] / 1024:.1f} KB，"
+          f"平均读取 {summary['read_ms']:.2f} ms")
+    baseline = max(1, results[0]["bytes"])
+    # 表头中的汉字在终端中占两列，按显示宽度对齐
+    print(f"{'格式':<8}{'大小KB':>8}{'相对':>6}{'编码ms':>8}{'解码ms':>8}{'无损':>8}")
+    for result in results:
+        print(f"{result['format']:<10}{result['bytes'] / 1024:>10.1f}{result['bytes'] / baseline:>8.2f}"
+              f"{result['encode_ms']:>10.2f}{result['decode_ms']:>10.2f}"
+              f"{result['lossless']:>6}/{result['files']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.json}")
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# 局域网编辑服务
+# ---------------------------------------------------------------------------
+
+# WebSocket（RFC 6455）握手使用的固定GUID与帧类型
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG = 0x1, 0x2, 0x8, 0x9, 0xA
+WEBSOCKET_MAX_MESSAGE = 16 * 1024 * 1024
+
+
+def websocket_accept(key):
+    """根据客户端的 Sec-WebSocket-Key 计算握手应答"""
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+
+
+def websocket_frame(opcode, payload):
+    """编码一个服务器发往客户端的WebSocket帧（服务器发出的帧不加掩码）"""
+    n = len(payload)
+    if n < 126:
+        head = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 65536:
+        head = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        head = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return head + payload
+
+
+async def read_websocket_frame(reader):
+    """读取一个WebSocket帧，返回 (是否为消息的最后一帧, 帧类型, 数据)"""
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if length > WEBSOCKET_MAX_MESSAGE:
+        raise ValueError("WebSocket消息过大")
+    key = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if key is not None and length:
+        mask = np.resize(np.frombuffer(key, dtype=np.uint8), length)
+        payload = np.bitwise_xor(np.frombuffer(payload, dtype=np.uint8), mask).tobytes()
+    return bool(first & 0x80), first & 0x0F, payload
+
+
+class RemoteClient:
+    """一个WebSocket连接：当前编辑的切片和笔画的衔接点"""
+    
+    def __init__(self, writer):
+        self.writer = writer
+        self.send_lock = asyncio.Lock()  # 保证帧不会交错写入
+        self.index = None
+        self.last_point = None
+
+
+class MaskServer:
+    """局域网编辑服务：asyncio 实现的 HTTP + WebSocket 前端，不依赖第三方库
+    
+    每张切片对应一个 MaskSession，多个客户端可以同时编辑不同的切片；编辑同一切片的客户端
+    共享会话，收到相同的增量图块。笔画和渲染在线程池中执行，不同切片可以并行处理，
+    同一切片的操作按到达顺序串行执行。离开的切片中未保存的修改保留在内存中（MaskChanges），
+    mask通过 MaskWriter 原子写入，内容未变化时不重写文件。
+    """
+    
+    def __init__(self, image_files, mask_index, mask_folder, view_size=(1024, 1024), workers=4):
+        self.image_files = image_files
+        self.mask_index = mask_index
+        self.mask_folder = mask_folder
+        self.view_size = view_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.mask_changes = MaskChanges()
+        self.mask_writer = MaskWriter(delay=0.5, workers=min(4, os.cpu_count() or 1),
+                                      changes=self.mask_changes)
+        self.slices = {}  # 切片序号 -> {"session", "clients", "lock"}
+    
+    def mask_path_for(self, index):
+        """切片对应的mask路径，没有mask时为mask文件夹中的新文件（与界面相同）"""
+        image_path = self.image_files[index]
+        mask_path = self.mask_index.find(image_path)
+        if mask_path is None and self.mask_folder:
+            mask_path = os.path.join(self.mask_folder, f"{file_stem(image_path)}{MASK_CODEC.extension}")
+        return mask_path
+    
+    def open_session(self, index):
+        """在线程池中调用：创建切片的编辑会话（与界面相同，优先使用内存中未保存的修改和尚未写完的版本）"""
+        entry = load_slice(self.image_files[index], self.mask_path_for(index), self.mask_writer)
+        if entry["image"] is None:
+            raise ValueError(entry["error"] or "无法读取图像")
+        session = MaskSession.from_entry(entry, self.mask_changes)
+        session.fit_display(self.view_size)
+        return session
+    
+    def step_history(self, session, kind):
+        """在线程池中调用：撤销或重做一步并渲染，没有可撤销/重做的操作时返回False"""
+        box = session.undo() if kind == "undo" else session.redo()
+        if box is None:
+            return False
+        session.render(box)
+        return True
+    
+    def save_session(self, session):
+        """在线程池中调用：保存会话的mask，返回 (是否实际写入, 错误信息)"""
+        if not session.mask_path:
+            return False, "未设置mask文件夹"
+        written = self.mask_writer.written
+        self.mask_writer.submit(session.mask_path, session.mask.copy(), delay=0)
+        error = self.mask_writer.flush(session.mask_path)
+        if error is None:
+            session.modified = False
+        return self.mask_writer.written != written, error
+    
+    async def run(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+    
+    async def handle_connection(self, reader, writer):
+        """处理一个HTTP连接：页面、切片列表，或升级为WebSocket"""
+        try:
+            request_line = await reader.readline()
+            parts = request_line.decode("latin-1").split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(parts) < 2 or parts[0] != "GET":
+                await self.send_http(writer, 405, "text/plain", b"method not allowed")
+                return
+            path = parts[1].split("?", 1)[0]
+            if path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                await self.serve_websocket(reader, writer, headers)
+            elif path == "/":
+                await self.send_http(writer, 200, "text/html; charset=utf-8", SERVE_PAGE.encode("utf-8"))
+            elif path == "/api/slices":
+                slices = [{"index": i, "name": os.path.basename(p)} for i, p in enumerate(self.image_files)]
+                await self.send_http(writer, 200, "application/json",
+                                     json.dumps(slices, ensure_ascii=False).encode("utf-8"))
+            else:
+                await self.send_http(writer, 404, "text/plain", b"not found")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    async def send_http(self, writer, status, content_type, body):
+        reason = {200: "OK", 404: "Not Found", 405: "Method Not Allowed"}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    
+    async def serve_websocket(self, reader, writer, headers):
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {websocket_accept(headers.get('sec-websocket-key', ''))}\r\n\r\n"
+                      ).encode("latin-1"))
+        await writer.drain()
+        client = RemoteClient(writer)
+        try:
+            fragments = []
+            while True:
+                fin, opcode, payload = await read_websocket_frame(reader)
+                if opcode == WS_CLOSE:
+                    await self.send(client, WS_CLOSE, payload[:2])
+                    break
+                if opcode == WS_PING:
+                    await self.send(client, WS_PONG, payload)
+                    continue
+                if opcode == WS_PONG:
+                    continue
+                fragments.append(payload)
+                if not fin:
+                    continue
+                message = b"".join(fragments)
+                fragments = []
+                await self.handle_command(client, json.loads(message.decode("utf-8")))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError, TypeError):
+            pass
+        finally:
+            await self.leave(client)
+    
+    async def send(self, client, opcode, payload):
+        async with client.send_lock:
+            client.writer.write(websocket_frame(opcode, payload))
+            await client.writer.drain()
+    
+    async def send_json(self, client, message):
+        await self.send(client, WS_TEXT, json.dumps(message, ensure_ascii=False).encode("utf-8"))
+    
+    async def broadcast(self, shared, message):
+        """把增量图块发给编辑同一切片的所有客户端"""
+        if message is None:
+            return
+        for other in list(shared["clients"]):
+            try:
+                await self.send(other, WS_BINARY, message)
+            except ConnectionError:
+                shared["clients"].discard(other)
+    
+    async def handle_command(self, client, command):
+        kind = command.get("type")
+        if kind == "open":
+            await self.join(client, int(command["index"]))
+            return
+        shared = self.slices.get(client.index)
+        if shared is None or shared["session"] is None:
+            return
+        session = shared["session"]
+        loop = asyncio.get_running_loop()
+        async with shared["lock"]:
+            if kind == "stroke":
+                value = 0
+                if command.get("mode", "add") == "add":
+                    # 与界面的 brush_value 相同，标签限制在16位标签图的取值范围内
+                    value = min(max(int(command.get("label", 1)), 1), 65535) if session.label_mode else 255
+                points = [(float(x), float(y)) for x, y in command.get("points", [])]
+                radius = max(1, min(int(command.get("radius", 10)), 512))
+                client.last_point = await loop.run_in_executor(
+                    self.executor, session.stroke, points, radius, value, client.last_point)
+            elif kind == "end":
+                client.last_point = None
+                await loop.run_in_executor(self.executor, session.end_stroke)
+            elif kind in ("undo", "redo"):
+                done = await loop.run_in_executor(self.executor, self.step_history, session, kind)
+                if not done:
+                    await self.send_json(client, {"type": "status", "text": "没有可撤销的操作" if kind == "undo"
+                                                  else "没有可重做的操作"})
+            elif kind == "save":
+                written, error = await loop.run_in_executor(self.executor, self.save_session, session)
+                name = os.path.basename(session.mask_path or "")
+                text = f"保存失败: {error}" if error else (f"保存成功: {name}" if written else f"未修改，无需保存: {name}")
+                await self.send_json(client, {"type": "status", "text": text})
+            message = await loop.run_in_executor(self.executor, session.delta_message)
+            await self.broadcast(shared, message)
+    
+    async def join(self, client, index):
+        """客户端切换到第 index 张切片：发送整个画面，之后只接收增量"""
+        if not 0 <= index < len(self.image_files):
+            await self.send_json(client, {"type": "status", "text": "切片序号超出范围"})
+            return
+        await self.leave(client)
+        loop = asyncio.get_running_loop()
+        while True:
+            shared = self.slices.setdefault(index, {"session": None, "clients": set(), "lock": asyncio.Lock()})
+            async with shared["lock"]:
+                # 等待锁期间最后一个客户端离开、该条目已被移除时，重新创建会话
+                if self.slices.get(index) is shared:
+                    await self.join_locked(client, index, shared, loop)
+                    return
+    
+    async def join_locked(self, client, index, shared, loop):
+        """持有切片锁时加入：需要时创建会话，然后发送整个画面"""
+        if shared["session"] is None:
+            try:
+                shared["session"] = await loop.run_in_executor(self.executor, self.open_session, index)
+            except Exception as e:
+                if not shared["clients"]:
+                    del self.slices[index]
+                await self.send_json(client, {"type": "status", "text": f"打开失败: {e}"})
+                return
+        session = shared["session"]
+        frame = await loop.run_in_executor(self.executor, session.delta_message, True)
+        shared["clients"].add(client)
+        client.index = index
+        client.last_point = None
+        width, height = session.view["size"]
+        await self.send_json(client, {"type": "opened", "index": index, "width": width, "height": height,
+                                      "name": os.path.basename(self.image_files[index]),
+                                      "label_mode": session.label_mode, "modified": session.modified})
+        await self.send(client, WS_BINARY, frame)
+    
+    async def leave(self, client):
+        """客户端离开当前切片；最后一个客户端离开时释放会话，未保存的修改保留在内存中"""
+        index = client.index
+        client.index = None
+        shared = self.slices.get(index)
+        if shared is None:
+            return
+        async with shared["lock"]:
+            shared["clients"].discard(client)
+            session = shared["session"]
+            if session is not None and session.stroke_open:
+                session.end_stroke()
+            if shared["clients"] or self.slices.get(index) is not shared:
+                return
+            # 先保留修改再移除条目，之后为该切片创建的会话才能读到这些修改
+            if session is not None and session.modified and session.mask_path:
+                self.mask_changes.keep(session.mask_path, session.mask)
+            del self.slices[index]
+    
+    def close(self):
+        """停止服务：写入所有未保存的修改，返回写入的数量"""
+        for shared in self.slices.values():
+            session = shared["session"]
+            if session is not None and session.modified and session.mask_path:
+                self.mask_changes.keep(session.mask_path, session.mask)
+        self.slices.clear()
+        paths = self.mask_changes.dirty_paths()
+        for path in paths:
+            mask = self.mask_changes.get(path)
+            if mask is not None:
+                self.mask_writer.submit(path, mask, delay=0)
+        self.mask_writer.close()
+        self.executor.shutdown(wait=False)
+        return len(paths)
+
+
+# 浏览器端页面：画布显示叠加画面，按增量图块更新；鼠标笔画按帧合并后发送
+SERVE_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Mask修正工具</title>
+<style>
+body { font-family: sans-serif; margin: 8px; }
+#bar > * { margin-right: 6px; }
+canvas { border: 1px solid #888; max-width: 100%; cursor: crosshair; touch-action: none; display: block; margin-top: 8px; }
+</style></head>
+<body>
+<div id="bar">
+<select id="slice"></select>
+<button id="prev">上一张</button><button id="next">下一张</button>
+笔刷大小 <input id="radius" type="number" min="1" max="512" value="10" style="width:4em">
+<label><input type="radio" name="mode" value="add" checked>添加</label>
+<label><input type="radio" name="mode" value="erase">擦除</label>
+标签 <input id="label" type="number" min="1" max="65535" value="1" style="width:5em">
+<button id="undo">撤销</button><button id="redo">重做</button><button id="save">保存修改</button>
+<span id="status"></span>
+</div>
+<canvas id="view" width="1" height="1"></canvas>
+<script>
+const $ = id => document.getElementById(id);
+const canvas = $("view"), ctx = canvas.getContext("2d"), slice = $("slice");
+let ws = null, fb = null, image = null, chain = Promise.resolve();
+let points = [], drawing = false, scheduled = false;
+
+function send(message) { if (ws && ws.readyState === 1) ws.send(JSON.stringify(message)); }
+function status(text) { $("status").textContent = text; }
+
+async function inflate(bytes) {
+  const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+  return new Uint8Array(await new Response(stream).arrayBuffer());
+}
+
+async function applyTiles(buffer) {
+  const view = new DataView(buffer);
+  const count = view.getUint32(4, true);
+  let offset = 8;
+  for (let i = 0; i < count; i++) {
+    const x = view.getUint16(offset, true), y = view.getUint16(offset + 2, true);
+    const w = view.getUint16(offset + 4, true), h = view.getUint16(offset + 6, true);
+    const n = view.getUint32(offset + 8, true);
+    const delta = await inflate(new Uint8Array(buffer, offset + 12, n));
+    offset += 12 + n;
+    for (let row = 0; row < h; row++) {
+      for (let col = 0; col < w; col++) {
+        const s = (row * w + col) * 3, p = (y + row) * canvas.width + x + col;
+        for (let c = 0; c < 3; c++) {
+          fb[p * 3 + c] ^= delta[s + c];
+          image.data[p * 4 + c] = fb[p * 3 + c];
+        }
+      }
+    }
+    ctx.putImageData(image, 0, 0, x, y, w, h);
+  }
+}
+
+function opened(message) {
+  canvas.width = message.width;
+  canvas.height = message.height;
+  fb = new Uint8Array(message.width * message.height * 3);
+  image = ctx.createImageData(message.width, message.height);
+  image.data.fill(255);
+  slice.value = message.index;
+  status(message.name + (message.modified ? "（未保存的修改）" : ""));
+}
+
+function connect() {
+  ws = new WebSocket(`ws://${location.host}/ws`);
+  ws.binaryType = "arraybuffer";
+  ws.onopen = () => send({type: "open", index: Number(slice.value || 0)});
+  ws.onclose = () => status("连接已断开");
+  ws.onmessage = event => {
+    if (typeof event.data !== "string") {
+      chain = chain.then(() => applyTiles(event.data));
+      return;
+    }
+    const message = JSON.parse(event.data);
+    if (message.type === "opened") chain = chain.then(() => opened(message));
+    else if (message.type === "status") status(message.text);
+  };
+}
+
+function canvasPoint(event) {
+  const rect = canvas.getBoundingClientRect();
+  return [(event.clientX - rect.left) * canvas.width / rect.width,
+          (event.clientY - rect.top) * canvas.height / rect.height];
+}
+
+function flushStroke() {
+  scheduled = false;
+  if (!points.length) return;
+  const mode = document.querySelector("input[name=mode]:checked").value;
+  send({type: "stroke", points: points, radius: Number($("radius").value),
+        mode: mode, label: Number($("label").value)});
+  points = [];
+}
+
+canvas.addEventListener("pointerdown", event => {
+  drawing = true;
+  canvas.setPointerCapture(event.pointerId);
+  points.push(canvasPoint(event));
+  flushStroke();
+});
+canvas.addEventListener("pointermove", event => {
+  if (!drawing) return;
+  points.push(canvasPoint(event));
+  if (!scheduled) { scheduled = true; requestAnimationFrame(flushStroke); }
+});
+canvas.addEventListener("pointerup", () => {
+  if (!drawing) return;
+  drawing = false;
+  flushStroke();
+  send({type: "end"});
+});
+
+function go(index) {
+  if (index < 0 || index >= slice.options.length) return;
+  slice.value = index;
+  send({type: "open", index: index});
+}
+slice.onchange = () => go(Number(slice.value));
+$("prev").onclick = () => go(Number(slice.value) - 1);
+$("next").onclick = () => go(Number(slice.value) + 1);
+$("undo").onclick = () => send({type: "undo"});
+$("redo").onclick = () => send({type: "redo"});
+$("save").onclick = () => send({type: "save"});
+document.addEventListener("keydown", event => {
+  if (!event.ctrlKey) return;
+  const key = event.key.toLowerCase();
+  if (key === "z" && !event.shiftKey) { send({type: "undo"}); event.preventDefault(); }
+  else if (key === "y" || (key === "z" && event.shiftKey)) { send({type: "redo"}); event.preventDefault(); }
+  else if (key === "s") { send({type: "save"}); event.preventDefault(); }
+});
+
+fetch("/api/slices").then(response => response.json()).then(slices => {
+  for (const item of slices) slice.add(new Option(`${item.index + 1}: ${item.name}`, item.index));
+  connect();
+});
+</script>
+</body></html>
+"""
+
+
+def serve_main(argv=None):
+    """命令行编辑服务入口：在浏览器中编辑mask，多个客户端可同时编辑不同的切片"""
+    parser = argparse.ArgumentParser(
+        prog="correct_mask_gui.py serve",
+        description="启动本地 HTTP/WebSocket 编辑服务，用浏览器编辑mask（画面以增量图块传输）")
+    parser.add_argument("--images", required=True, help="图像文件夹")
+    parser.add_argument("--masks", required=True, help="mask文件夹")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="监听地址，局域网访问使用 0.0.0.0（服务没有身份验证，只应在可信网络中使用）")
+    parser.add_argument("--port", type=int, default=8765, help="端口")
+    parser.add_argument("--view", default="1024x1024", help="浏览器中显示区域的最大尺寸，宽x高")
+    parser.add_argument("--workers", type=int, default=4, help="渲染线程数")
+    args = parser.parse_args(argv)
+    
+    try:
+        view_size = tuple(int(v) for v in args.view.lower().split("x"))
+        if len(view_size) != 2:
+            raise ValueError
+    except ValueError:
+        parser.error("--view 格式应为 宽x高，例如 1024x1024")
+    
+    image_files = scan_image_folder(args.images)
+    mask_files = scan_image_folder(args.masks, extensions=MASK_EXTENSIONS)
+    print(f"图像文件夹: 找到 {len(image_files)} 个文件")
+    print(f"Mask文件夹: 找到 {len(mask_files)} 个文件")
+    if not image_files:
+        print("错误: 没有找到图像文件")
+        return 2
+    
+    server = MaskServer(image_files, MaskIndex(mask_files), args.masks, view_size, args.workers)
+    print(f"编辑服务: http://{args.host}:{args.port}/ （Ctrl+C 停止）")
+    try:
+        asyncio.run(server.run(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        saved = server.close()
+        if saved:
+            print(f"已写入 {saved} 个未保存的mask")
+        while server.mask_writer.errors:
+            path, error = server.mask_writer.errors.popleft()
+            print(f"保存失败: {os.path.basename(path)}, 错误: {error}")
+    return 0
+
+
+# 命令行子命令，不带子命令时启动图形界面
+CLI_COMMANDS = {
+    "batch": batch_main,
+    "qa": qa_main,
+    "bench": bench_main,
+    "codecs": codecs_main,
+    "serve": serve_main,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in CLI_COMMANDS:
+        return CLI_COMMANDS[argv[0]](argv[1:])
+    
     root = tk.Tk()
     app = MaskCorrectionGUI(root)
     root.mainloop()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
 
 
 
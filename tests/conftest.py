@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+
+# 测试直接导入仓库根目录下的 correct_mask_gui.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 文件夹清单缓存写到临时目录，不影响用户自己的缓存
+os.environ["MEDMASK_CACHE_DIR"] = tempfile.mkdtemp(prefix="medmask-test-")
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
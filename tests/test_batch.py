@@ -0,0 +1,116 @@
+"""批处理命令行与mask批处理操作的测试"""
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import correct_mask_gui as gui
+
+
+def ring_mask(value=255):
+    """带一个孔洞的环形前景，外加一个小噪点"""
+    mask = np.zeros((64, 64), np.uint8)
+    cv2.circle(mask, (32, 32), 20, value, -1)
+    cv2.circle(mask, (32, 32), 6, 0, -1)
+    mask[2:4, 60:62] = value
+    return mask
+
+
+def test_fill_holes_and_remove_small():
+    mask = ring_mask()
+    filled = gui.fill_mask_holes(mask)
+    assert filled[32, 32] == 255
+    assert np.array_equal(filled[mask > 0], mask[mask > 0])
+    
+    cleaned = gui.remove_small_components(mask, min_area=10)
+    assert not cleaned[2:4, 60:62].any()
+    assert np.array_equal(cleaned[20:44, 20:44], mask[20:44, 20:44])
+
+
+def test_apply_mask_operations_in_order():
+    mask = ring_mask()
+    mask[mask > 0] = 200
+    result = gui.apply_mask_operations(mask, ["binarize", "fill_holes", "remove_small"],
+                                       threshold=127, min_area=10)
+    assert set(np.unique(result)) == {0, 255}
+    assert result[32, 32] == 255 and result[2, 60] == 0
+    with pytest.raises(ValueError):
+        gui.apply_mask_operations(mask, ["dilate"])
+
+
+def test_batch_cli_in_place(tmp_path):
+    images, masks = tmp_path / "images", tmp_path / "masks"
+    images.mkdir()
+    masks.mkdir()
+    for name in ("a", "b", "c"):
+        cv2.imwrite(str(images / f"{name}.png"), np.zeros((64, 48, 3), np.uint8))
+    cv2.imwrite(str(masks / "a.png"), ring_mask())
+    clean = gui.fill_mask_holes(gui.remove_small_components(ring_mask(), 10))
+    cv2.imwrite(str(masks / "b.png"), clean)
+    mtime = os.stat(masks / "b.png").st_mtime_ns
+    
+    args = ["batch", "--images", str(images), "--masks", str(masks),
+            "--ops", "fill_holes,remove_small", "--min-area", "10", "--create-empty", "--workers", "1"]
+    assert gui.main(args) == 0
+    assert np.array_equal(cv2.imread(str(masks / "a.png"), cv2.IMREAD_GRAYSCALE), clean)
+    # 内容未变化的mask不重写
+    assert os.stat(masks / "b.png").st_mtime_ns == mtime
+    created = cv2.imread(str(masks / "c.png"), cv2.IMREAD_UNCHANGED)
+    assert created.shape == (64, 48) and not created.any()
+
+
+def test_batch_cli_rejects_unknown_operation(tmp_path):
+    with pytest.raises(SystemExit):
+        gui.main(["batch", "--images", str(tmp_path), "--masks", str(tmp_path), "--ops", "dilate"])
+
+
+def label_map():
+    """16位标签图：标签3带孔洞，标签300带一个小噪点"""
+    mask = np.zeros((100, 100), np.uint16)
+    mask[10:40, 10:40] = 3
+    mask[20:25, 20:25] = 0
+    mask[50:90, 50:90] = 300
+    mask[0:2, 95:97] = 300
+    return mask
+
+
+def test_label_operations_keep_label_values():
+    result = gui.apply_mask_operations(label_map(), ["fill_holes", "remove_small"], min_area=10)
+    assert result.dtype == np.uint16
+    assert set(np.unique(result)) == {0, 3, 300}
+    assert result[22, 22] == 3 and result[0, 95] == 0
+    with pytest.raises(ValueError):
+        gui.apply_mask_operations(label_map(), ["binarize"])
+
+
+def test_batch_cli_keeps_16_bit_labels(tmp_path):
+    images, masks = tmp_path / "images", tmp_path / "masks"
+    images.mkdir()
+    masks.mkdir()
+    cv2.imwrite(str(images / "a.png"), np.zeros((100, 100, 3), np.uint8))
+    cv2.imwrite(str(masks / "a.png"), label_map())
+    
+    args = ["batch", "--images", str(images), "--masks", str(masks), "--ops", "fill_holes", "--workers", "1"]
+    assert gui.main(args) == 0
+    result = cv2.imread(str(masks / "a.png"), cv2.IMREAD_UNCHANGED)
+    assert result.dtype == np.uint16 and result[22, 22] == 3 and result[60, 60] == 300
+
+
+def test_fill_holes_keeps_mask_value_range():
+    mask = ring_mask(value=1)
+    filled = gui.fill_mask_holes(mask)
+    assert filled.dtype == np.uint8 and set(np.unique(filled)) == {0, 1}
+    assert filled[32, 32] == 1
+    result = gui.apply_mask_operations(mask, ["fill_holes", "remove_small"], min_area=10)
+    assert set(np.unique(result)) == {0, 1} and result[32, 32] == 1 and result[2, 60] == 0
+
+
+def test_8_bit_label_maps_keep_label_values():
+    mask = label_map().astype(np.uint8)
+    mask[mask > 0] = np.where(mask[mask > 0] == 3, 1, 2)
+    result = gui.apply_mask_operations(mask, ["fill_holes", "remove_small"], min_area=10)
+    assert result.dtype == np.uint8 and set(np.unique(result)) == {0, 1, 2}
+    assert result[22, 22] == 1 and result[60, 60] == 2 and result[0, 95] == 0
+    with pytest.raises(ValueError):
+        gui.apply_mask_operations(mask, ["binarize", "fill_holes"])
@@ -0,0 +1,41 @@
+"""性能统计与无界面基准测试的测试"""
+import json
+
+import correct_mask_gui as gui
+
+
+def test_profiler_records_stages_only_when_enabled():
+    profiler = gui.Profiler()
+    with profiler.stage("decode_image"):
+        pass
+    profiler.count("draw_events")
+    assert profiler.snapshot()["stages"] == {} and profiler.snapshot()["counters"] == {}
+    
+    profiler.enabled = True
+    for _ in range(3):
+        with profiler.stage("decode_image"):
+            pass
+    profiler.count("draw_events", 5)
+    snapshot = profiler.snapshot()
+    assert snapshot["stages"]["decode_image"]["count"] == 3
+    assert snapshot["counters"]["draw_events"]["count"] == 5
+    assert any("decode_image" in line for line in profiler.report_lines())
+
+
+def test_compare_benchmark_reports_slower_stages():
+    baseline = {"stages": {"save": {"mean_ms": 10.0}, "stroke": {"mean_ms": 1.0}, "tiny": {"mean_ms": 0.01}}}
+    snapshot = {"stages": {"save": {"mean_ms": 12.0}, "stroke": {"mean_ms": 2.0}, "tiny": {"mean_ms": 1.0}}}
+    assert gui.compare_benchmark(snapshot, baseline, tolerance=1.5) == [("stroke", 2.0, 1.0)]
+
+
+def test_bench_cli(tmp_path):
+    out = tmp_path / "bench.json"
+    args = ["bench", "--count", "2", "--size", "256", "--events", "64", "--repeat", "1",
+            "--workdir", str(tmp_path / "data"), "--json", str(out)]
+    assert gui.main(args) == 0
+    snapshot = json.loads(out.read_text(encoding="utf-8"))
+    for stage in ("navigate", "decode_image", "stroke", "overlay_region", "save"):
+        assert snapshot["stages"][stage]["count"] > 0
+    
+    # 与自身比较不应报告性能退化
+    assert gui.main(args[:-2] + ["--baseline", str(out), "--tolerance", "1000"]) == 0
@@ -0,0 +1,79 @@
+"""mask编码格式的测试"""
+import json
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import correct_mask_gui as gui
+
+
+def blob_mask(value=255, dtype=np.uint8):
+    rng = np.random.default_rng(1)
+    mask = np.zeros((90, 110), dtype=dtype)
+    for _ in range(12):
+        center = (int(rng.integers(0, 110)), int(rng.integers(0, 90)))
+        cv2.circle(mask, center, int(rng.integers(3, 20)), int(value), -1)
+    return mask
+
+
+MASKS = {
+    "binary": blob_mask(),
+    "binary-1": blob_mask(value=1),
+    "empty": np.zeros((40, 30), np.uint8),
+    "labels8": np.random.default_rng(5).integers(0, 6, (45, 55)).astype(np.uint8),
+    "labels16": blob_mask(value=300, dtype=np.uint16),
+}
+
+
+@pytest.mark.parametrize("name", MASKS)
+@pytest.mark.parametrize("format", ["png", "png1", "npz"])
+@pytest.mark.parametrize("png_rle", [False, True])
+def test_mask_codec_round_trip(name, format, png_rle):
+    mask = MASKS[name]
+    codec = gui.MaskCodec(format, png_level=3, png_rle=png_rle)
+    data = codec.encode(mask, codec.extension)
+    restored = gui.decode_mask_bytes(data, codec.extension)
+    assert restored.dtype == mask.dtype
+    assert np.array_equal(restored, mask)
+
+
+def test_mask_codec_png1_writes_bilevel_png():
+    mask = MASKS["binary"]
+    one_bit = gui.MaskCodec("png1").encode(mask, ".png")
+    eight_bit = gui.MaskCodec("png").encode(mask, ".png")
+    assert len(one_bit) < len(eight_bit)
+
+
+def test_mask_codec_rejects_invalid_settings():
+    with pytest.raises(ValueError):
+        gui.MaskCodec("jpeg")
+    with pytest.raises(ValueError):
+        gui.MaskCodec("png", png_level=10)
+
+
+def test_write_mask_atomic_keeps_target_format(tmp_path):
+    mask = MASKS["labels16"]
+    codec = gui.MaskCodec("npz")
+    for ext in (".png", ".npz", ".bmp"):
+        path = str(tmp_path / f"mask{ext}")
+        expected = mask if ext != ".bmp" else MASKS["binary"]
+        gui.write_mask_atomic(path, expected, codec)
+        assert np.array_equal(gui.read_mask_file(path), expected)
+    # 不留下临时文件
+    assert sorted(os.listdir(tmp_path)) == ["mask.bmp", "mask.npz", "mask.png"]
+
+
+def test_codecs_cli(tmp_path):
+    masks = tmp_path / "masks"
+    masks.mkdir()
+    cv2.imwrite(str(masks / "a.png"), MASKS["binary"])
+    cv2.imwrite(str(masks / "b.png"), MASKS["labels16"])
+    out = tmp_path / "codecs.json"
+    assert gui.main(["codecs", "--masks", str(masks), "--json", str(out)]) == 0
+    report = json.loads(out.read_text(encoding="utf-8"))
+    assert report
+    # 没有mask文件时报错
+    (tmp_path / "empty").mkdir()
+    assert gui.main(["codecs", "--masks", str(tmp_path / "empty")]) == 2
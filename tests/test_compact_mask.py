@@ -0,0 +1,61 @@
+"""紧凑mask存储的测试"""
+import cv2
+import numpy as np
+import pytest
+
+import correct_mask_gui as gui
+
+
+def blob_mask(shape=(300, 400), value=255, dtype=np.uint8, seed=0):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=dtype)
+    for _ in range(25):
+        center = (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0])))
+        cv2.circle(mask, center, int(rng.integers(5, 40)), int(value), -1)
+    return mask
+
+
+MASKS = {
+    "empty": np.zeros((0, 0), np.uint8),
+    "zeros": np.zeros((64, 80), np.uint8),
+    "full": np.full((33, 17), 255, np.uint8),
+    "binary": blob_mask(),
+    "binary-1": blob_mask(value=1),
+    "noise": np.random.default_rng(2).integers(0, 256, (50, 70)).astype(np.uint8),
+    "uint16": blob_mask(value=1000, dtype=np.uint16),
+}
+
+
+@pytest.mark.parametrize("name", MASKS)
+@pytest.mark.parametrize("method", ["auto", "rle", "raw"])
+def test_compact_mask_round_trip(name, method):
+    mask = MASKS[name]
+    restored = gui.CompactMask.from_array(mask, method).to_array()
+    assert restored.dtype == mask.dtype
+    assert np.array_equal(restored, mask)
+
+
+@pytest.mark.parametrize("name", ["zeros", "full", "binary", "binary-1", "uint16"])
+def test_compact_mask_packbits_round_trip(name):
+    mask = MASKS[name]
+    compact = gui.CompactMask.from_array(mask, "packbits")
+    assert np.array_equal(compact.to_array(), mask)
+    assert compact.to_array().dtype == mask.dtype
+
+
+def test_compact_mask_packbits_rejects_multiple_values():
+    with pytest.raises(ValueError):
+        gui.CompactMask.from_array(MASKS["noise"], "packbits")
+
+
+def test_compact_mask_picks_smallest_form():
+    mask = blob_mask((512, 512))
+    assert gui.CompactMask.from_array(mask).nbytes <= mask.nbytes // 8
+    noise = MASKS["noise"]
+    assert gui.CompactMask.from_array(noise).method == "raw"
+    
+    # 解压结果是新数组，修改不影响压缩数据
+    compact = gui.CompactMask.from_array(noise)
+    out = compact.to_array()
+    out[:] = 0
+    assert np.array_equal(compact.to_array(), noise)
@@ -0,0 +1,61 @@
+"""视口重采样与图像金字塔的测试"""
+import cv2
+import numpy as np
+import pytest
+
+import correct_mask_gui as gui
+
+
+@pytest.mark.parametrize("dst_size", [(200, 150), (550, 400), (417, 301)])
+def test_sample_view_matches_full_resize(rng, dst_size):
+    src = rng.integers(0, 256, (301, 417, 3)).astype(np.uint8)
+    full = cv2.resize(src, dst_size, interpolation=cv2.INTER_LINEAR)
+    w, h = dst_size
+    scale = (w / 417, h / 301)
+    for box in [(0, 0, w, h), (10, 20, 50, 70), (w - 7, h - 9, w, h)]:
+        x0, y0, x1, y1 = box
+        part = gui.sample_view(src, (0, 0), scale, box)
+        assert part.shape == (y1 - y0, x1 - x0, 3)
+        # 与整图缩放只有定点插值的舍入差异
+        assert np.abs(part.astype(int) - full[y0:y1, x0:x1].astype(int)).max() <= 1
+
+
+def test_sample_view_zoomed_matches_crop(rng):
+    src = rng.integers(0, 256, (300, 400)).astype(np.uint8)
+    # 放大2倍显示原图 (100, 60) 开始的 150x100 区域
+    full = cv2.resize(src[60:160, 100:250], (300, 200), interpolation=cv2.INTER_LINEAR)
+    part = gui.sample_view(src, (100, 60), (2.0, 2.0), (20, 30, 280, 170))
+    assert np.abs(part.astype(int) - full[30:170, 20:280].astype(int)).max() <= 1
+
+
+@pytest.mark.parametrize("scale", [0.5, 1.7])
+def test_image_box_to_view_covers_changed_pixels(rng, scale):
+    src = rng.integers(0, 256, (301, 417)).astype(np.uint8)
+    view = {"origin": (40, 30), "scale": (scale, scale), "size": (300, 200)}
+    box = (100, 50, 140, 97)
+    before = gui.sample_view(src, view["origin"], view["scale"], (0, 0, 300, 200))
+    src[50:97, 100:140] = 255 - src[50:97, 100:140]
+    after = gui.sample_view(src, view["origin"], view["scale"], (0, 0, 300, 200))
+    
+    x0, y0, x1, y1 = gui.image_box_to_view(box, view)
+    changed = before != after
+    assert changed.any()
+    changed[y0:y1, x0:x1] = False
+    assert not changed.any()
+
+
+def test_image_pyramid_levels(rng):
+    image = rng.integers(0, 256, (301, 417, 3)).astype(np.uint8)
+    pyramid = gui.ImagePyramid(image)
+    level, factor = pyramid.level_for_scale(1.5)
+    assert level is image and factor == 1
+    level, factor = pyramid.level_for_scale(0.3)
+    assert factor == 2 and level.shape == (151, 209, 3)
+    level, factor = pyramid.level_for_scale(0.1)
+    assert factor == 8 and level.shape == (38, 53, 3)
+    
+    # 每级像素是上一级 2x2 区域的平均值
+    even = image[:300, :416]
+    half = gui.ImagePyramid(even).level_for_scale(0.5)[0]
+    expected = even.reshape(150, 2, 208, 2, 3).mean(axis=(1, 3))
+    assert np.abs(half.astype(float) - expected).max() <= 0.5 + 1e-9
@@ -0,0 +1,77 @@
+"""后台文件夹扫描与清单缓存的测试"""
+import os
+import time
+
+import numpy as np
+
+import correct_mask_gui as gui
+
+
+def make_folder(folder, count):
+    folder.mkdir()
+    names = []
+    for i in range(count):
+        name = f"{i:05d}.{('png', 'JPG', 'bmp')[i % 3]}"
+        (folder / name).touch()
+        names.append(name)
+    (folder / "notes.txt").touch()
+    (folder / "sub.png").mkdir()  # 目录即使扩展名匹配也不算图像
+    return sorted(str(folder / name) for name in names)
+
+
+def test_folder_scan_returns_all_images_in_batches(tmp_path):
+    expected = make_folder(tmp_path / "images", 1300)
+    scan = gui.FolderScan(str(tmp_path / "images"))
+    files, finished = [], False
+    deadline = time.monotonic() + 10
+    while not finished and time.monotonic() < deadline:
+        new_files, finished = scan.drain()
+        files.extend(new_files)
+        time.sleep(0.01)
+    assert finished and scan.error is None
+    assert sorted(files) == expected and sorted(scan.files) == expected
+
+
+def test_folder_scan_reports_errors(tmp_path):
+    scan = gui.FolderScan(str(tmp_path / "missing"))
+    scan.thread.join(5)
+    assert scan.drain() == ([], True)
+    assert scan.error
+
+
+def test_manifest_cache_skips_rescan_until_folder_changes(tmp_path, monkeypatch):
+    folder = tmp_path / "images"
+    expected = make_folder(folder, 20)
+    assert gui.scan_image_folder(str(folder)) == expected
+    assert gui.load_folder_manifest(str(folder)) is not None
+    
+    def no_scandir(path):
+        raise AssertionError("清单缓存有效时不应遍历文件夹")
+    
+    with monkeypatch.context() as m:
+        m.setattr(gui.os, "scandir", no_scandir)
+        assert gui.scan_image_folder(str(folder)) == expected
+    
+    # 新增文件会更新文件夹的修改时间，缓存失效
+    (folder / "new.png").touch()
+    stat = os.stat(folder)
+    os.utime(folder, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert gui.load_folder_manifest(str(folder)) is None
+    assert gui.scan_image_folder(str(folder)) == sorted(expected + [str(folder / "new.png")])
+    assert gui.scan_image_folder(str(folder), use_manifest=False) == sorted(expected + [str(folder / "new.png")])
+
+
+def test_editing_waits_for_mask_scan(tmp_path):
+    # 扫描完成前显示的是空白mask，保存路径是新建mask的默认路径
+    default_path = str(tmp_path / "a.png")
+    app = gui.MaskCorrectionGUI.__new__(gui.MaskCorrectionGUI)
+    app.session = gui.MaskSession({"image": np.zeros((20, 30, 3), np.uint8), "mask_state": "missing",
+                                   "mask_path": default_path})
+    app.folder_scans = {"mask": gui.FolderScan(str(tmp_path), gui.MASK_EXTENSIONS)}
+    
+    app.start_draw(None)
+    app.reset_mask()
+    assert not app.save_mask()
+    assert not app.session.modified and app.session.undo() is None
+    assert not os.path.exists(default_path)
+    app.folder_scans["mask"].cancel()
@@ -0,0 +1,73 @@
+"""16位灰度图的窗宽/窗位映射测试"""
+import cv2
+import numpy as np
+import pytest
+
+import correct_mask_gui as gui
+
+
+def reference_window(values, center, width):
+    low = center - width / 2
+    return np.clip(np.rint((values - low) * (255.0 / width)), 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("intensity", [(1.0, 0.0), (0.5, -1024.0)])
+def test_intensity_window_lut_matches_direct_mapping(rng, intensity):
+    raw = rng.integers(0, 65536, (64, 80)).astype(np.uint16)
+    window = gui.IntensityWindow()
+    assert not window.is_set()
+    window.set(center=200, width=1500)
+    rgb = window.apply(raw, intensity)
+    scale, offset = intensity
+    expected = reference_window(raw * scale + offset, 200.0, 1500.0)
+    assert rgb.shape == (64, 80, 3)
+    assert np.array_equal(rgb[..., 0], expected) and np.array_equal(rgb[..., 2], expected)
+
+
+def test_intensity_window_rebuilds_lut_only_when_changed(rng):
+    raw = rng.integers(0, 65536, (16, 16)).astype(np.uint16)
+    window = gui.IntensityWindow()
+    window.set(1000, 400)
+    for _ in range(3):
+        window.apply(raw, (1.0, 0.0))
+    assert window.lut_builds == 1
+    window.set(1000, 800)
+    window.apply(raw, (1.0, 0.0))
+    window.apply(raw, (2.0, 0.0))
+    assert window.lut_builds == 3
+
+
+def test_intensity_window_auto_uses_percentiles():
+    raw = np.tile(np.arange(1000, 2000, dtype=np.uint16), (20, 1))
+    window = gui.IntensityWindow()
+    window.auto(raw, (1.0, 0.0))
+    assert 1000 <= window.center - window.width / 2 <= 1010
+    assert 1990 <= window.center + window.width / 2 <= 2000
+
+
+def test_to_intensity_image_keeps_values():
+    data = np.array([[0, 1, 65535]], np.uint16)
+    index, intensity = gui.to_intensity_image(data)
+    assert np.array_equal(index, data) and intensity == (1.0, 0.0)
+    
+    signed = np.array([[-1024, 0, 3071]], np.int16)
+    index, (scale, offset) = gui.to_intensity_image(signed)
+    assert np.array_equal(index * scale + offset, signed)
+    
+    floats = np.array([[-1.5, 0.0, 2.5]], np.float32)
+    index, (scale, offset) = gui.to_intensity_image(floats)
+    assert index.tolist() == [[0, 24576, 65535]]
+    assert np.allclose(index * scale + offset, floats, atol=scale)
+
+
+def test_read_slice_image_keeps_16bit_data(tmp_path, rng):
+    raw = rng.integers(0, 65536, (30, 40)).astype(np.uint16)
+    path = str(tmp_path / "ct.png")
+    cv2.imwrite(path, raw)
+    image, intensity = gui.read_slice_image(path)
+    assert image.dtype == np.uint16 and np.array_equal(image, raw)
+    assert intensity == (1.0, 0.0)
+    
+    cv2.imwrite(path, (raw >> 8).astype(np.uint8))
+    image, intensity = gui.read_slice_image(path)
+    assert image.shape == (30, 40, 3) and intensity is None
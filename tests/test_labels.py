@@ -0,0 +1,98 @@
+"""多标签mask的测试"""
+import cv2
+import numpy as np
+
+import correct_mask_gui as gui
+
+
+def label_map(dtype=np.uint16, seed=0):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((120, 160), dtype=dtype)
+    for label in (1, 2, 255, 256, 1000, 65535):
+        if label > np.iinfo(dtype).max:
+            continue
+        x, y = (int(v) for v in rng.integers(10, 110, 2))
+        cv2.circle(mask, (x, y), int(rng.integers(5, 20)), label, -1)
+    return mask
+
+
+def test_label_display_index_cycles_through_palette():
+    labels = np.array([[0, 1, 255, 256, 510, 511, 65535]], dtype=np.uint16)
+    index = gui.label_display_index(labels)
+    assert index.dtype == np.uint8
+    assert index.tolist() == [[0, 1, 255, 1, 255, 1, 0 + (65535 - 1) % 255 + 1]]
+    small = labels[:, :3].astype(np.uint8)
+    assert gui.label_display_index(small) is small
+
+
+def test_label_palette():
+    palette = gui.label_palette()
+    assert palette.shape == (256, 3) and not palette[0].any()
+    # 相邻标签颜色不同
+    assert np.all(np.abs(palette[1:-1].astype(int) - palette[2:].astype(int)).max(axis=1) > 0)
+
+
+def test_label_areas_matches_unique_counts():
+    mask = label_map()
+    values, counts = np.unique(mask, return_counts=True)
+    expected = {int(v): int(c) for v, c in zip(values, counts) if v}
+    assert gui.label_areas(mask) == expected
+    assert gui.label_areas(mask, chunk_pixels=1000) == expected
+    assert gui.label_areas(np.zeros((4, 4), np.uint8)) == {}
+
+
+def test_sample_view_nearest_keeps_label_values():
+    mask = label_map()
+    view = gui.sample_view(mask, (3.3, 7.1), (2.7, 2.7), (0, 0, 200, 150), cv2.INTER_NEAREST)
+    assert set(np.unique(view)) <= set(np.unique(mask))
+
+
+def test_label_map_file_round_trip(tmp_path):
+    for dtype in (np.uint8, np.uint16):
+        mask = label_map(dtype)
+        path = str(tmp_path / f"labels_{np.dtype(dtype).name}.png")
+        gui.write_mask_atomic(path, mask)
+        restored = gui.read_mask_file(path)
+        assert restored.dtype == mask.dtype
+        assert np.array_equal(restored, mask)
+
+
+class Var:
+    """代替 tk.BooleanVar"""
+    
+    def __init__(self, value):
+        self.value = value
+    
+    def get(self):
+        return self.value
+    
+    def set(self, value):
+        self.value = value
+
+
+def app_with_mask(mask, label_mode, auto=False):
+    app = gui.MaskCorrectionGUI.__new__(gui.MaskCorrectionGUI)
+    app.session = gui.MaskSession({"image": np.zeros(mask.shape + (3,), np.uint8), "mask_state": "ok"},
+                                  mask=mask)
+    app.label_mode_var = Var(label_mode)
+    app.label_mode_auto = auto
+    return app
+
+
+def test_label_mode_is_restored_after_16_bit_slice():
+    app = app_with_mask(label_map(), label_mode=False)
+    app.select_label_mode()
+    assert app.label_mode_var.get() and app.label_mode_auto
+    
+    # 下一张切片为8位mask，恢复自动切换之前的二值模式
+    app.session = app_with_mask(np.zeros((120, 160), np.uint8), True).session
+    app.select_label_mode()
+    assert not app.label_mode_var.get() and not app.label_mode_auto
+    
+    # 用户自己开启的多标签模式不受影响
+    app = app_with_mask(label_map(), label_mode=True)
+    app.select_label_mode()
+    assert not app.label_mode_auto
+    app.session = app_with_mask(label_map(np.uint8), True).session
+    app.select_label_mode()
+    assert app.label_mode_var.get()
@@ -0,0 +1,66 @@
+"""队列日志处理器与 print 转发的测试"""
+import logging
+import threading
+
+import pytest
+
+import correct_mask_gui as gui
+
+
+@pytest.fixture
+def test_logger():
+    log = logging.getLogger("medmaskeditor.test")
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    sink = gui.QueueLogSink()
+    log.addHandler(sink)
+    yield log, sink
+    log.removeHandler(sink)
+
+
+def test_queue_log_sink_collects_messages_from_threads(test_logger):
+    log, sink = test_logger
+    
+    def worker(n):
+        for i in range(100):
+            log.info("线程%d 消息%d", n, i)
+    
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    lines, dropped = sink.drain(1000)
+    assert dropped == 0 and len(lines) == 400
+    assert sorted(lines) == sorted(f"线程{n} 消息{i}" for n in range(4) for i in range(100))
+    assert sink.drain(1000) == ([], 0)
+
+
+def test_queue_log_sink_drain_keeps_last_lines(test_logger):
+    log, sink = test_logger
+    for i in range(10):
+        log.info("消息%d", i)
+    log.debug("不记录")
+    assert sink.drain(3) == (["消息7", "消息8", "消息9"], 7)
+
+
+def test_logger_writer_forwards_print_lines_with_levels(test_logger):
+    log, sink = test_logger
+    records = []
+    
+    class Recorder(logging.Handler):
+        def emit(self, record):
+            records.append((record.levelno, record.getMessage()))
+    
+    recorder = Recorder()
+    log.addHandler(recorder)
+    try:
+        writer = gui.LoggerWriter(log)
+        print("加载mask: a.png", file=writer)
+        print("警告: mask文件损坏", file=writer)
+        writer.write("保存失败: b.png")
+        writer.write("\n\n")
+    finally:
+        log.removeHandler(recorder)
+    assert records == [(logging.INFO, "加载mask: a.png"), (logging.WARNING, "警告: mask文件损坏"),
+                       (logging.ERROR, "保存失败: b.png")]
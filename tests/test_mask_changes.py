@@ -0,0 +1,144 @@
+"""mask变更跟踪的测试：只保存真正修改过的mask"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pytest
+
+import correct_mask_gui as gui
+
+
+def test_mask_digest_depends_on_content_shape_and_dtype():
+    mask = np.zeros((4, 6), np.uint8)
+    assert gui.mask_digest(mask) == gui.mask_digest(mask.copy())
+    assert gui.mask_digest(mask) != gui.mask_digest(mask.reshape(6, 4))
+    assert gui.mask_digest(mask) != gui.mask_digest(mask.astype(np.uint16))
+    changed = mask.copy()
+    changed[0, 0] = 1
+    assert gui.mask_digest(mask) != gui.mask_digest(changed)
+
+
+def test_mask_changes_tracks_edits_against_disk():
+    changes = gui.MaskChanges()
+    original = np.zeros((8, 8), np.uint8)
+    changes.remember("a.png", gui.mask_digest(original))
+    assert not changes.is_changed("a.png", gui.mask_digest(original))
+    assert changes.is_changed("unknown.png", gui.mask_digest(original))
+    
+    edited = original.copy()
+    edited[2:4, 2:4] = 255
+    assert changes.keep("a.png", edited)
+    assert np.array_equal(changes.get("a.png"), edited)
+    assert changes.dirty_paths() == ["a.png"] and len(changes) == 1
+    
+    # 改回与磁盘上相同的内容（例如全部撤销）时不再算修改
+    assert not changes.keep("a.png", original)
+    assert changes.get("a.png") is None and len(changes) == 0
+    
+    # 写入磁盘后，内存中相同内容的修改版本不再需要保存
+    changes.keep("a.png", edited)
+    changes.set_saved("a.png", gui.mask_digest(edited))
+    assert len(changes) == 0
+    # 读到的旧哈希不覆盖最近一次写入的记录
+    changes.remember("a.png", gui.mask_digest(original))
+    assert not changes.is_changed("a.png", gui.mask_digest(edited))
+
+
+def test_mask_writer_skips_unchanged_masks(tmp_path, monkeypatch):
+    writes = []
+    lock = threading.Lock()
+    write = gui.write_mask_atomic
+    
+    def recording_write(path, mask, *args, **kwargs):
+        with lock:
+            writes.append(path)
+        return write(path, mask, *args, **kwargs)
+    
+    monkeypatch.setattr(gui, "write_mask_atomic", recording_write)
+    path = str(tmp_path / "a.png")
+    mask = np.zeros((8, 8), np.uint8)
+    changes = gui.MaskChanges()
+    changes.remember(path, gui.mask_digest(mask))
+    writer = gui.MaskWriter(delay=60, changes=changes)
+    try:
+        writer.submit(path, mask.copy())
+        writer.flush()
+        assert writes == [] and writer.skipped == 1
+        
+        mask[1, 1] = 255
+        writer.submit(path, mask.copy())
+        writer.flush()
+        assert writes == [path] and writer.written == 1
+        assert not changes.is_changed(path, gui.mask_digest(mask))
+    finally:
+        writer.close()
+
+
+def test_load_slice_returns_mask_digest(tmp_path):
+    image_path, mask_path = str(tmp_path / "a.png"), str(tmp_path / "m.png")
+    cv2.imwrite(image_path, np.zeros((20, 30, 3), np.uint8))
+    mask = np.zeros((20, 30), np.uint8)
+    mask[5:9, 5:9] = 255
+    cv2.imwrite(mask_path, mask)
+    entry = gui.load_slice(image_path, mask_path)
+    assert entry["mask_state"] == "ok"
+    assert entry["mask_digest"] == gui.mask_digest(mask)
+    assert gui.load_slice(image_path, str(tmp_path / "none.png"))["mask_digest"] is None
+
+
+class FakeRoot:
+    def __init__(self):
+        self.destroyed = False
+    
+    def destroy(self):
+        self.destroyed = True
+
+
+def closing_app(tmp_path, edit):
+    """只包含关闭窗口所需状态的界面对象，当前切片为 a.png，开启了自动保存"""
+    image_path, mask_path = str(tmp_path / "a.png"), str(tmp_path / "a_mask.png")
+    cv2.imwrite(image_path, np.zeros((32, 32, 3), np.uint8))
+    cv2.imwrite(mask_path, np.zeros((32, 32), np.uint8))
+    app = gui.MaskCorrectionGUI.__new__(gui.MaskCorrectionGUI)
+    app.root = FakeRoot()
+    app.mask_changes = gui.MaskChanges()
+    app.mask_writer = gui.MaskWriter(changes=app.mask_changes)
+    app.session = gui.MaskSession.from_entry(gui.load_slice(image_path, mask_path), app.mask_changes)
+    app.auto_save = True
+    app.drawing = False
+    app.folder_scans = {}
+    app.qa_run = None
+    app.prefetch_futures = {}
+    app.prefetch_executor = ThreadPoolExecutor(max_workers=1)
+    app.region_executor = ThreadPoolExecutor(max_workers=1)
+    if edit:
+        # 开启自动保存之前的修改不会排入写入队列
+        app.session.mask[4:10, 4:10] = 255
+        app.session.modified = True
+    return app, mask_path
+
+
+def test_close_asks_about_edits_that_were_never_auto_saved(tmp_path, monkeypatch):
+    app, mask_path = closing_app(tmp_path, edit=True)
+    questions = []
+    answers = iter([None, True])
+    
+    def ask(title, message):
+        questions.append(message)
+        return next(answers)
+    
+    monkeypatch.setattr(gui.messagebox, "askyesnocancel", ask)
+    app.on_close()
+    assert "1 个" in questions[0] and not app.root.destroyed
+    
+    app.on_close()
+    assert app.root.destroyed
+    assert cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)[4:10, 4:10].all()
+
+
+def test_close_without_edits_does_not_ask(tmp_path, monkeypatch):
+    app, _ = closing_app(tmp_path, edit=False)
+    monkeypatch.setattr(gui.messagebox, "askyesnocancel", lambda *args: pytest.fail("不应询问"))
+    app.on_close()
+    assert app.root.destroyed
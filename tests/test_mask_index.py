@@ -0,0 +1,42 @@
+"""图像与mask配对索引的测试"""
+import os
+
+import correct_mask_gui as gui
+
+
+def linear_find(image_path, mask_files):
+    """逐个比较的配对方式：文件名完全一致的mask优先，否则取排序后第一个子串匹配的mask"""
+    image_name = gui.file_stem(image_path)
+    paths = sorted(mask_files)
+    for mask_path in paths:
+        if gui.file_stem(mask_path) == image_name:
+            return mask_path
+    for mask_path in paths:
+        mask_name = gui.file_stem(mask_path)
+        if image_name in mask_name or mask_name in image_name:
+            return mask_path
+    return None
+
+
+def test_mask_index_matches_linear_scan(rng):
+    alphabet = list("ab_1")
+    names = ["".join(rng.choice(alphabet, int(rng.integers(1, 6)))) for _ in range(200)]
+    mask_files = [os.path.join("masks", f"{name}_{i % 3}.png") for i, name in enumerate(names[:80])]
+    mask_files += [os.path.join("masks", f"{name}.png") for name in names[80:120]]
+    index = gui.MaskIndex(mask_files)
+    for name in names + ["zzz", "a", "case_0_extra"]:
+        image_path = os.path.join("images", f"{name}.jpg")
+        assert index.find(image_path) == linear_find(image_path, mask_files), name
+
+
+def test_mask_index_prefers_exact_name():
+    index = gui.MaskIndex(["m/case1_label.png", "m/case1.png", "m/case10.png"])
+    assert index.find("i/case1.jpg") == "m/case1.png"
+    assert index.find("i/case10.jpg") == "m/case10.png"
+    assert index.find("i/case1_label_v2.jpg") == "m/case1.png"
+
+
+def test_mask_index_empty():
+    assert gui.MaskIndex([]).find("images/a.png") is None
+    pairs = gui.pair_images_with_masks(["i/a.png", "i/b.png"], gui.MaskIndex(["m/b.png"]))
+    assert pairs == [("i/a.png", None), ("i/b.png", "m/b.png")]
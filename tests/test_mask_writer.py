@@ -0,0 +1,80 @@
+"""后台合并写入mask的测试"""
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+import correct_mask_gui as gui
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    """记录实际写入的 (路径, mask)"""
+    calls = []
+    lock = threading.Lock()
+    write = gui.write_mask_atomic
+    
+    def recording_write(path, mask, *args, **kwargs):
+        with lock:
+            calls.append((path, mask))
+        return write(path, mask, *args, **kwargs)
+    
+    monkeypatch.setattr(gui, "write_mask_atomic", recording_write)
+    return calls
+
+
+def test_mask_writer_coalesces_repeated_saves(tmp_path, writes):
+    path = str(tmp_path / "a.png")
+    writer = gui.MaskWriter(delay=60)
+    try:
+        masks = [np.full((8, 8), i, np.uint8) for i in range(5)]
+        for mask in masks:
+            writer.submit(path, mask)
+        assert writer.latest(path) is masks[-1]
+        assert writer.version(path) == 5
+        assert writer.flush(path) is None
+    finally:
+        writer.close()
+    assert [p for p, _ in writes] == [path]
+    assert np.array_equal(cv2.imread(path, cv2.IMREAD_GRAYSCALE), masks[-1])
+    assert writer.latest(path) is None
+
+
+def test_mask_writer_writes_after_delay(tmp_path, writes):
+    paths = [str(tmp_path / f"{i}.png") for i in range(3)]
+    writer = gui.MaskWriter(delay=0.05)
+    try:
+        for path in paths:
+            writer.submit(path, np.zeros((4, 4), np.uint8))
+        deadline = time.monotonic() + 5
+        while writer.is_busy() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not writer.is_busy()
+    finally:
+        writer.close()
+    assert sorted(p for p, _ in writes) == sorted(paths)
+
+
+def test_mask_writer_close_writes_pending(tmp_path, writes):
+    path = str(tmp_path / "a.png")
+    writer = gui.MaskWriter(delay=60)
+    writer.submit(path, np.ones((4, 4), np.uint8))
+    writer.close()
+    assert [p for p, _ in writes] == [path]
+
+
+def test_mask_writer_reports_errors(tmp_path, monkeypatch):
+    def failing_write(path, mask, *args, **kwargs):
+        raise OSError("磁盘已满")
+    
+    monkeypatch.setattr(gui, "write_mask_atomic", failing_write)
+    path = str(tmp_path / "a.png")
+    writer = gui.MaskWriter(delay=60)
+    try:
+        writer.submit(path, np.zeros((4, 4), np.uint8))
+        assert writer.flush(path) == "磁盘已满"
+        assert list(writer.errors) == [(path, "磁盘已满")]
+    finally:
+        writer.close()
@@ -0,0 +1,71 @@
+"""叠加画面轮廓缓存的测试"""
+import cv2
+import numpy as np
+
+import correct_mask_gui as gui
+
+
+def blob_mask(shape=(300, 400), seed=0):
+    """随机圆形组成的mask，带有孔洞和相互接触的连通域"""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=np.uint8)
+    for _ in range(25):
+        center = (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0])))
+        cv2.circle(mask, center, int(rng.integers(5, 40)), 255, -1)
+    for _ in range(10):
+        center = (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0])))
+        cv2.circle(mask, center, int(rng.integers(2, 10)), 0, -1)
+    return mask
+
+
+def test_contour_cache_update_matches_full_extraction(rng):
+    mask = blob_mask()
+    cache = gui.ContourCache(mask)
+    for step in range(60):
+        x, y = int(rng.integers(0, mask.shape[1])), int(rng.integers(0, mask.shape[0]))
+        radius = int(rng.integers(3, 30))
+        before = cache.layer.copy()
+        cv2.circle(mask, (x, y), radius, 255 if step % 3 else 0, -1)
+        changed = cache.update((x - radius - 1, y - radius - 1, x + radius + 2, y + radius + 2))
+        assert np.array_equal(cache.layer, gui.ContourCache(mask.copy()).layer)
+        
+        # 图层只在返回的区域内发生变化
+        diff = before != cache.layer
+        if changed is None:
+            assert not diff.any()
+        else:
+            x0, y0, x1, y1 = changed
+            diff[y0:y1, x0:x1] = False
+            assert not diff.any()
+
+
+def test_contour_cache_update_outside_mask():
+    mask = blob_mask()
+    cache = gui.ContourCache(mask)
+    assert cache.update((-50, -50, -10, -10)) is None
+
+
+def reference_overlay(image, mask, layer, alpha, palette):
+    """逐像素按定义合成的叠加画面"""
+    colored = palette[mask]
+    blended = cv2.addWeighted(image, 1 - alpha, colored, alpha, 0)
+    out = np.where(mask[..., None] > 0, blended, image)
+    out[layer > 0] = gui.OverlayCompositor.CONTOUR_COLOR
+    return out
+
+
+def test_overlay_compositor_matches_reference(rng):
+    mask = blob_mask()
+    image = rng.integers(0, 256, mask.shape + (3,)).astype(np.uint8)
+    layer = gui.ContourCache(mask).layer
+    compositor = gui.OverlayCompositor()
+    palette = gui.default_overlay_palette()
+    
+    full = compositor.compose(image, mask, layer, 0.4).copy()
+    assert np.array_equal(full, reference_overlay(image, mask, layer, 0.4, palette))
+    
+    # 局部合成与整图合成的对应区域一致，缓冲区不重新分配
+    allocations = compositor.stats()["allocations"]
+    part = compositor.compose(image, mask, layer, 0.4, box=(30, 40, 170, 90))
+    assert np.array_equal(part, full[40:90, 30:170])
+    assert compositor.stats() == {"frames": 2, "allocations": allocations}
@@ -0,0 +1,107 @@
+"""mask质量报告的测试"""
+import csv
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+import correct_mask_gui as gui
+
+
+def sample_mask():
+    """一个带孔洞的环形连通域，加一个接触右边界的方块"""
+    mask = np.zeros((100, 120), np.uint8)
+    cv2.circle(mask, (40, 50), 25, 255, -1)
+    cv2.circle(mask, (40, 50), 8, 0, -1)
+    mask[10:30, 100:120] = 255
+    return mask
+
+
+def test_mask_qa_metrics():
+    mask = sample_mask()
+    metrics = gui.mask_qa_metrics(mask)
+    assert metrics["area"] == np.count_nonzero(mask)
+    assert metrics["components"] == 2 and metrics["holes"] == 1
+    assert (metrics["x0"], metrics["y0"], metrics["x1"], metrics["y1"]) == (15, 10, 120, 76)
+    assert metrics["touches_border"]
+    
+    empty = gui.mask_qa_metrics(np.zeros((10, 10), np.uint8))
+    assert empty["area"] == 0 and empty["components"] == 0 and empty["x0"] is None
+
+
+def test_dice_score():
+    a = np.zeros((10, 10), np.uint8)
+    b = np.zeros((10, 10), np.uint8)
+    assert gui.dice_score(a, b) == 1.0
+    a[:, :5] = 255
+    b[:, 3:8] = 1
+    assert gui.dice_score(a, b) == pytest.approx(2 * 20 / 100)
+
+
+def make_dataset(tmp_path):
+    images, masks, reference = tmp_path / "images", tmp_path / "masks", tmp_path / "reference"
+    for folder in (images, masks, reference):
+        folder.mkdir()
+    for name in ("a", "b", "c", "d"):
+        cv2.imwrite(str(images / f"{name}.png"), np.zeros((100, 120, 3), np.uint8))
+    cv2.imwrite(str(masks / "a.png"), sample_mask())
+    cv2.imwrite(str(reference / "a.png"), sample_mask())
+    cv2.imwrite(str(masks / "b.png"), np.zeros((100, 120), np.uint8))
+    (masks / "d.png").write_bytes(b"not a png")
+    return images, masks, reference
+
+
+def check_rows(rows):
+    assert [row["index"] for row in rows] == [0, 1, 2, 3]
+    assert [row["state"] for row in rows] == ["ok", "empty", "missing", "corrupt"]
+    assert rows[0]["components"] == 2 and rows[0]["dice"] == 1.0
+    assert rows[1]["dice"] is None
+
+
+def test_qa_run_in_process_pool(tmp_path):
+    images, masks, reference = make_dataset(tmp_path)
+    image_files = gui.scan_image_folder(str(images))
+    mask_index = gui.MaskIndex(gui.scan_image_folder(str(masks)))
+    output = str(tmp_path / "report.csv")
+    run = gui.QARun(image_files, mask_index, output, workers=2, reference_folder=str(reference))
+    
+    finished = False
+    deadline = time.monotonic() + 60
+    while not finished and time.monotonic() < deadline:
+        _, finished = run.drain()
+        time.sleep(0.01)
+    assert finished and run.error is None
+    check_rows(run.rows)
+    with open(output, newline="", encoding="utf-8") as f:
+        report = list(csv.DictReader(f))
+    assert [row["state"] for row in report] == ["ok", "empty", "missing", "corrupt"]
+    assert list(report[0]) == gui.QA_FIELDS
+
+
+def test_qa_pool_uses_spawn(tmp_path, monkeypatch):
+    # 界面中运行时进程里有Tk线程，子进程不能用 fork 启动
+    contexts = []
+    
+    class RecordingPool(gui.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            contexts.append(kwargs.get("mp_context"))
+            super().__init__(*args, **kwargs)
+    
+    monkeypatch.setattr(gui, "ProcessPoolExecutor", RecordingPool)
+    images, masks, reference = make_dataset(tmp_path)
+    tasks = [(i, path, None, None) for i, path in enumerate(gui.scan_image_folder(str(images)))]
+    rows = list(gui.iter_qa_rows(tasks, workers=2))
+    assert len(rows) == 4
+    assert [context.get_start_method() for context in contexts] == ["spawn"]
+
+
+def test_qa_cli(tmp_path):
+    images, masks, reference = make_dataset(tmp_path)
+    output = tmp_path / "report.csv"
+    assert gui.main(["qa", "--images", str(images), "--masks", str(masks), "--reference", str(reference),
+                     "--output", str(output), "--workers", "1"]) == 0
+    with open(output, newline="", encoding="utf-8") as f:
+        report = list(csv.DictReader(f))
+    assert [row["state"] for row in report] == ["ok", "empty", "missing", "corrupt"]
+    assert float(report[0]["dice"]) == 1.0
@@ -0,0 +1,75 @@
+"""魔棒、阈值笔刷和GrabCut区域工具的测试"""
+import cv2
+import numpy as np
+
+import correct_mask_gui as gui
+
+
+class Value:
+    """代替 Tk 变量/滑块的 get()"""
+    
+    def __init__(self, value):
+        self.value = value
+    
+    def get(self):
+        return self.value
+
+
+def two_squares(rng):
+    """两个互不相连、灰度相近的方块，背景为噪声"""
+    image = rng.integers(0, 40, (120, 160)).astype(np.uint8)
+    image[20:60, 20:70] = 150 + rng.integers(0, 10, (40, 50)).astype(np.uint8)
+    image[70:100, 100:140] = 155
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+
+
+def test_region_tool_roi_is_clipped():
+    assert gui.region_tool_roi((5, 100), (120, 160), 10) == (0, 90, 16, 111)
+    assert gui.region_tool_roi((155, 3), (120, 160), 10) == (145, 0, 160, 14)
+
+
+def test_magic_wand_selects_connected_similar_pixels(rng):
+    image = two_squares(rng)
+    selected = gui.magic_wand(image, (40, 30), tolerance=20)
+    expected = np.zeros(image.shape[:2], bool)
+    expected[20:60, 20:70] = True
+    assert np.array_equal(selected, expected)
+    assert not gui.magic_wand(image, (40, 30), tolerance=0)[20:60, 20:70].all()
+
+
+def test_grabcut_refine_moves_boundary_to_edges():
+    truth = np.zeros((100, 100), np.uint8)
+    cv2.circle(truth, (50, 50), 25, 255, -1)
+    image = np.full((100, 100, 3), 30, np.uint8)
+    image[truth > 0] = (200, 180, 160)
+    rough = np.zeros_like(truth)
+    cv2.circle(rough, (53, 48), 22, 255, -1)
+    
+    refined = gui.grabcut_refine(image, rough, band=8)
+    
+    def iou(a, b):
+        return np.count_nonzero(a & b) / np.count_nonzero(a | b)
+    
+    assert iou(refined, truth > 0) > max(iou(rough > 0, truth > 0), 0.95)
+    assert gui.grabcut_refine(image, np.zeros_like(truth)) is None
+    assert gui.grabcut_refine(image, np.full_like(truth, 255)) is None
+
+
+def test_threshold_brush_only_paints_matching_pixels(rng):
+    image = two_squares(rng)
+    app = gui.MaskCorrectionGUI.__new__(gui.MaskCorrectionGUI)
+    app.session = gui.MaskSession({"image": image, "mask_state": "missing"})
+    app.tolerance_scale = Value(15)
+    app.threshold_reference = 155
+    
+    points = [(10, 40), (90, 40)]
+    box = app.session.draw(points, 12, 255, select=app.threshold_selection)
+    
+    stamp = np.zeros(image.shape[:2], np.uint8)
+    gui.draw_stroke(stamp, points, 12, 255)
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    expected = (stamp > 0) & (np.abs(gray.astype(int) - 155) <= 15)
+    assert expected.any() and np.array_equal(app.mask_image > 0, expected)
+    x0, y0, x1, y1 = box
+    assert x0 <= 0 and y0 <= 28 and x1 >= 103 and y1 >= 53
+    assert app.session.end_stroke() and app.session.modified
@@ -0,0 +1,55 @@
+"""按帧合并重绘请求的测试"""
+import correct_mask_gui as gui
+
+
+class FakeRoot:
+    """代替 Tk 的 after：回调排队，由测试手动执行"""
+    
+    def __init__(self):
+        self.queue = []
+    
+    def after(self, ms, callback):
+        self.queue.append(callback)
+    
+    def run(self):
+        while self.queue:
+            self.queue.pop(0)()
+
+
+def make_scheduler():
+    root = FakeRoot()
+    calls = []
+    scheduler = gui.RenderScheduler(root.after, lambda parts, box: calls.append((parts, box)))
+    return scheduler, root, calls
+
+
+def test_requests_in_one_frame_are_merged():
+    scheduler, root, calls = make_scheduler()
+    scheduler.request("mask", box=(10, 10, 20, 20))
+    scheduler.request("overlay")
+    scheduler.request("mask", box=(5, 15, 12, 40))
+    assert len(root.queue) == 1
+    root.run()
+    assert calls == [({"mask", "overlay"}, (5, 10, 20, 40))]
+    assert scheduler.stats()["frames"] == 1 and scheduler.stats()["coalesced"] == 2
+
+
+def test_full_mask_redraw_is_not_narrowed():
+    scheduler, root, calls = make_scheduler()
+    scheduler.request("mask", box=(1, 1, 5, 5))
+    scheduler.request("mask")
+    scheduler.request("mask", box=(2, 2, 3, 3))
+    root.run()
+    # 下一帧的局部请求不受上一帧整图重绘的影响
+    scheduler.request("mask", box=(1, 1, 5, 5))
+    root.run()
+    assert calls == [({"mask"}, None), ({"mask"}, (1, 1, 5, 5))]
+
+
+def test_flush_renders_pending_requests_immediately():
+    scheduler, root, calls = make_scheduler()
+    scheduler.request("image")
+    scheduler.flush()
+    assert calls == [({"image"}, None)]
+    root.run()  # 已排队的回调没有待处理的请求
+    assert len(calls) == 1
@@ -0,0 +1,272 @@
+"""编辑引擎 MaskSession 和网页编辑服务的测试"""
+import asyncio
+import json
+import os
+import struct
+import time
+import zlib
+
+import cv2
+import numpy as np
+
+import correct_mask_gui as gui
+
+
+def blob_mask(shape=(300, 400)):
+    mask = np.zeros(shape, dtype=np.uint8)
+    cv2.circle(mask, (120, 100), 60, 255, -1)
+    cv2.circle(mask, (120, 100), 15, 0, -1)
+    cv2.rectangle(mask, (250, 180), (360, 260), 255, -1)
+    return mask
+
+
+def write_slice(folder, name, seed=6, mask=True):
+    image = np.random.default_rng(seed).integers(0, 256, (300, 400, 3)).astype(np.uint8)
+    image_path = str(folder / f"{name}.png")
+    cv2.imwrite(image_path, image)
+    mask_path = str(folder / f"{name}_mask.png")
+    if mask:
+        cv2.imwrite(mask_path, blob_mask())
+    return image_path, mask_path
+
+
+def test_partial_render_matches_full_render(tmp_path):
+    image_path, mask_path = write_slice(tmp_path, "a")
+    session = gui.MaskSession.from_entry(gui.load_slice(image_path, mask_path))
+    session.fit_display((200, 200))
+    for points, value in [([(10, 10), (150, 90)], 255), ([(100, 20), (120, 140)], 0)]:
+        session.render(session.draw(points, 6, value))
+    session.end_stroke()
+    session.render(session.undo())
+    
+    partial = session.frame.copy()
+    session.set_view(session.view, session.display_image)
+    assert np.array_equal(partial, session.compose())
+
+
+def test_strokes_undo_and_redo(tmp_path):
+    image_path, mask_path = write_slice(tmp_path, "a")
+    session = gui.MaskSession.from_entry(gui.load_slice(image_path, mask_path))
+    original = session.mask.copy()
+    assert not session.modified and session.source == "ok"
+    
+    # 一笔画内的多段合为一步撤销
+    session.draw([(0, 0), (50, 50)], 4, 255)
+    session.draw([(50, 50), (50, 200)], 4, 255)
+    assert session.end_stroke() and session.modified
+    edited = session.mask.copy()
+    assert not session.end_stroke()
+    
+    assert session.undo() is not None
+    assert np.array_equal(session.mask, original)
+    assert session.undo() is None
+    assert session.redo() is not None
+    assert np.array_equal(session.mask, edited)
+
+
+def test_from_entry_takes_unsaved_edits(tmp_path):
+    image_path, mask_path = write_slice(tmp_path, "a")
+    changes = gui.MaskChanges()
+    edited = blob_mask()
+    edited[:10] = 255
+    changes.keep(mask_path, edited)
+    
+    session = gui.MaskSession.from_entry(gui.load_slice(image_path, mask_path), changes)
+    assert session.source == "edited" and session.modified
+    assert np.array_equal(session.mask, edited)
+    assert changes.get(mask_path) is None
+    
+    # 新mask：磁盘上没有文件，会话从空白mask开始
+    new_path = str(tmp_path / "new_mask.png")
+    session = gui.MaskSession.from_entry(gui.load_slice(image_path, new_path), changes)
+    assert session.source == "missing" and not session.mask.any()
+
+
+def test_widen_for_label_switches_to_16_bit():
+    session = gui.MaskSession({"image": np.zeros((20, 30, 3), np.uint8), "mask_state": "missing"})
+    assert not session.widen_for_label(255)
+    assert session.widen_for_label(300)
+    assert session.mask.dtype == np.uint16
+
+
+def apply_delta(framebuffer, message):
+    """按网页客户端的方式把增量图块异或到 framebuffer 上"""
+    assert message[:4] == b"MMT1"
+    count, = struct.unpack_from("<I", message, 4)
+    offset = 8
+    for _ in range(count):
+        x, y, w, h, n = struct.unpack_from("<HHHHI", message, offset)
+        delta = np.frombuffer(zlib.decompress(message[offset + 12:offset + 12 + n]), np.uint8)
+        framebuffer[y:y + h, x:x + w] ^= delta.reshape(h, w, 3)
+        offset += 12 + n
+
+
+def test_delta_messages_rebuild_the_frame(tmp_path):
+    image_path, mask_path = write_slice(tmp_path, "a")
+    session = gui.MaskSession.from_entry(gui.load_slice(image_path, mask_path))
+    session.fit_display((200, 200))
+    w, h = session.view["size"]
+    client = np.zeros((h, w, 3), np.uint8)
+    apply_delta(client, session.delta_message(full=True))
+    assert np.array_equal(client, session.frame)
+    assert session.delta_message() is None
+    
+    last = session.stroke([(20, 20), (90, 60)], 5, 255)
+    session.stroke([(90, 60), (150, 20)], 5, 255, last)
+    message = session.delta_message()
+    assert len(message) < session.frame.nbytes // 10
+    apply_delta(client, message)
+    assert np.array_equal(client, session.frame)
+
+
+class FakeWriter:
+    """代替 asyncio.StreamWriter，解析服务器发出的WebSocket帧"""
+    
+    def __init__(self):
+        self.data = b""
+    
+    def write(self, data):
+        self.data += data
+    
+    async def drain(self):
+        pass
+    
+    def messages(self):
+        """取出已发送的帧，返回 [(帧类型, 数据)]"""
+        result, data, offset = [], self.data, 0
+        while offset < len(data):
+            opcode, length = data[offset] & 0x0F, data[offset + 1] & 0x7F
+            offset += 2
+            if length == 126:
+                length, = struct.unpack_from("!H", data, offset)
+                offset += 2
+            elif length == 127:
+                length, = struct.unpack_from("!Q", data, offset)
+                offset += 8
+            result.append((opcode, data[offset:offset + length]))
+            offset += length
+        self.data = b""
+        return result
+
+
+class Viewer:
+    """一个网页客户端：按收到的消息维护自己的画面"""
+    
+    def __init__(self):
+        self.client = gui.RemoteClient(FakeWriter())
+        self.frame = None
+        self.status = []
+    
+    def receive(self):
+        for opcode, payload in self.client.writer.messages():
+            if opcode == gui.WS_TEXT:
+                message = json.loads(payload.decode("utf-8"))
+                if message["type"] == "opened":
+                    self.opened = message
+                    self.frame = np.zeros((message["height"], message["width"], 3), np.uint8)
+                else:
+                    self.status.append(message["text"])
+            else:
+                apply_delta(self.frame, payload)
+
+
+def make_server(tmp_path):
+    images, masks = tmp_path / "images", tmp_path / "masks"
+    images.mkdir()
+    masks.mkdir()
+    a, _ = write_slice(images, "a", mask=False)
+    b, _ = write_slice(images, "b", seed=7, mask=False)
+    cv2.imwrite(str(masks / "a.png"), blob_mask())
+    index = gui.MaskIndex([str(masks / "a.png")])
+    return gui.MaskServer([a, b], index, str(masks), view_size=(200, 200), workers=2), masks
+
+
+def test_server_shares_strokes_between_clients(tmp_path):
+    server, masks = make_server(tmp_path)
+    first, second = Viewer(), Viewer()
+    
+    async def scenario():
+        for viewer in (first, second):
+            await server.handle_command(viewer.client, {"type": "open", "index": 0})
+        await server.handle_command(first.client, {"type": "stroke", "points": [[20, 20], [150, 120]],
+                                                   "radius": 5})
+        await server.handle_command(first.client, {"type": "end"})
+        await server.handle_command(second.client, {"type": "save"})
+    
+    asyncio.run(scenario())
+    first.receive()
+    second.receive()
+    session = server.slices[0]["session"]
+    assert first.opened["width"] == 200 and not first.opened["modified"]
+    assert np.array_equal(first.frame, session.frame)
+    assert np.array_equal(second.frame, session.frame)
+    assert second.status == ["保存成功: a.png"]
+    saved = cv2.imread(str(masks / "a.png"), cv2.IMREAD_GRAYSCALE)
+    assert np.array_equal(saved, session.mask) and not np.array_equal(saved, blob_mask())
+    server.close()
+
+
+def test_server_keeps_edits_of_left_slices(tmp_path):
+    server, masks = make_server(tmp_path)
+    viewer = Viewer()
+    
+    async def scenario():
+        await server.handle_command(viewer.client, {"type": "open", "index": 1})
+        await server.handle_command(viewer.client, {"type": "stroke", "points": [[50, 50]], "radius": 8})
+        await server.handle_command(viewer.client, {"type": "open", "index": 0})
+        assert 1 not in server.slices
+        await server.handle_command(viewer.client, {"type": "open", "index": 1})
+    
+    asyncio.run(scenario())
+    viewer.receive()
+    assert viewer.opened["index"] == 1 and viewer.opened["modified"]
+    assert not os.path.exists(masks / "b.png")
+    
+    # 停止服务时写入未保存的修改
+    assert server.close() == 1
+    assert cv2.imread(str(masks / "b.png"), cv2.IMREAD_GRAYSCALE).any()
+
+
+def test_join_while_last_client_leaves_keeps_edits(tmp_path):
+    server, _ = make_server(tmp_path)
+    editor, viewer = Viewer(), Viewer()
+    keep = server.mask_changes.keep
+    
+    def slow_keep(path, mask):
+        time.sleep(0.2)
+        return keep(path, mask)
+    
+    server.mask_changes.keep = slow_keep
+    
+    async def scenario():
+        await server.handle_command(editor.client, {"type": "open", "index": 1})
+        await server.handle_command(editor.client, {"type": "stroke", "points": [[50, 50]], "radius": 8})
+        # 最后一个客户端离开的同时，另一个客户端打开同一切片
+        await asyncio.gather(server.leave(editor.client),
+                             server.handle_command(viewer.client, {"type": "open", "index": 1}))
+    
+    asyncio.run(scenario())
+    viewer.receive()
+    assert viewer.opened["modified"]
+    assert server.slices[1]["session"].mask.any()
+    server.close()
+
+
+def test_server_clamps_labels_to_16_bit_range(tmp_path):
+    server, masks = make_server(tmp_path)
+    cv2.imwrite(str(masks / "b.png"), np.zeros((300, 400), np.uint16))
+    server.mask_index = gui.MaskIndex([str(masks / "a.png"), str(masks / "b.png")])
+    viewer = Viewer()
+    
+    async def scenario():
+        await server.handle_command(viewer.client, {"type": "open", "index": 1})
+        for x, label in [(40, 70000), (120, 0), (160, -5)]:
+            await server.handle_command(viewer.client, {"type": "stroke", "points": [[x, 40]], "radius": 3,
+                                                        "label": label})
+            await server.handle_command(viewer.client, {"type": "end"})
+    
+    asyncio.run(scenario())
+    session = server.slices[1]["session"]
+    assert session.label_mode and session.mask.dtype == np.uint16
+    assert set(np.unique(session.mask)) == {0, 1, 65535}
+    server.close()
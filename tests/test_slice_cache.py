@@ -0,0 +1,29 @@
+"""切片预读缓存的测试"""
+import correct_mask_gui as gui
+
+
+def test_byte_lru_cache_evicts_least_recently_used():
+    cache = gui.ByteLRUCache(100)
+    cache.put("a", 1, 40)
+    cache.put("b", 2, 40)
+    assert cache.get("a") == 1  # a 变为最近使用
+    cache.put("c", 3, 40)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.total_bytes == 80 and len(cache) == 2
+
+
+def test_byte_lru_cache_replace_and_oversized():
+    cache = gui.ByteLRUCache(100)
+    cache.put("a", 1, 40)
+    cache.put("a", 2, 60)
+    assert cache.get("a") == 2 and cache.total_bytes == 60
+    
+    # 超过容量的条目不缓存，同一键的旧值也被移除
+    cache.put("a", 3, 200)
+    assert cache.get("a") is None and cache.total_bytes == 0
+    
+    cache.put("b", 1, 10)
+    cache.discard("b")
+    cache.discard("missing")
+    assert len(cache) == 0 and cache.total_bytes == 0
@@ -0,0 +1,32 @@
+"""笔画栅格化的测试"""
+import cv2
+import numpy as np
+import pytest
+
+import correct_mask_gui as gui
+
+
+@pytest.mark.parametrize("radius", [1, 2, 3, 5, 10, 20])
+def test_draw_stroke_covers_brush_circles(rng, radius):
+    points = [tuple(int(v) for v in rng.integers(30, 270, 2)) for _ in range(6)]
+    mask = np.zeros((300, 300), np.uint8)
+    gui.draw_stroke(mask, points, radius, 255)
+    
+    # 折线经过的每个点都被完整的圆形笔刷覆盖
+    circles = np.zeros_like(mask)
+    for point in points:
+        cv2.circle(circles, point, radius, 255, -1)
+    assert not np.any((circles > 0) & (mask == 0))
+    
+    # 所有修改都在 stroke_bounds 之内
+    x0, y0, x1, y1 = gui.stroke_bounds(points, radius)
+    mask[y0:y1, x0:x1] = 0
+    assert not mask.any()
+
+
+def test_draw_stroke_single_point_is_circle():
+    mask = np.zeros((50, 50), np.uint8)
+    gui.draw_stroke(mask, [(20, 25)], 7, 3)
+    expected = np.zeros_like(mask)
+    cv2.circle(expected, (20, 25), 7, 3, -1)
+    assert np.array_equal(mask, expected)
@@ -0,0 +1,64 @@
+"""按图块记录的撤销/重做的测试"""
+import numpy as np
+
+import correct_mask_gui as gui
+
+
+def paint(history, mask, box, value):
+    history.begin()
+    history.record(mask, box)
+    x0, y0, x1, y1 = box
+    mask[y0:y1, x0:x1] = value
+    return history.commit(mask)
+
+
+def test_undo_history_undo_redo():
+    mask = np.zeros((600, 700), np.uint8)
+    history = gui.UndoHistory(tile_size=128)
+    states = [mask.copy()]
+    for i, box in enumerate([(10, 10, 200, 90), (150, 50, 650, 580), (0, 0, 40, 40)]):
+        assert paint(history, mask, box, 50 * (i + 1))
+        states.append(mask.copy())
+    
+    # 未修改内容的笔画不产生记录
+    assert not paint(history, mask, (0, 0, 40, 40), 150)
+    
+    for state in reversed(states[:-1]):
+        assert history.undo(mask) is not None
+        assert np.array_equal(mask, state)
+    assert history.undo(mask) is None
+    for state in states[1:]:
+        assert history.redo(mask) is not None
+        assert np.array_equal(mask, state)
+    assert history.redo(mask) is None
+    
+    # 新的修改使重做记录失效
+    history.undo(mask)
+    assert paint(history, mask, (300, 300, 310, 310), 9)
+    assert history.redo(mask) is None
+
+
+def test_undo_history_returns_changed_box():
+    mask = np.zeros((600, 700), np.uint8)
+    history = gui.UndoHistory(tile_size=128)
+    paint(history, mask, (130, 10, 140, 20), 255)
+    x0, y0, x1, y1 = history.undo(mask)
+    assert x0 <= 130 and y0 <= 10 and x1 >= 140 and y1 >= 20
+    assert (x1 - x0) * (y1 - y0) <= 128 * 128
+
+
+def test_undo_history_evicts_oldest_steps(rng):
+    mask = np.zeros((256, 256), np.uint8)
+    history = gui.UndoHistory(max_bytes=40 * 1024, tile_size=64)
+    for _ in range(30):
+        x, y = (int(v) for v in rng.integers(0, 200, 2))
+        history.begin()
+        history.record(mask, (x, y, x + 56, y + 56))
+        mask[y:y + 56, x:x + 56] = rng.integers(0, 256, (56, 56))
+        history.commit(mask)
+    assert 1 <= len(history.undo_steps) < 30
+    assert history.total_bytes <= history.max_bytes or len(history.undo_steps) == 1
+    assert history.total_bytes == sum(nbytes for _, nbytes in history.undo_steps)
+    
+    history.clear()
+    assert history.total_bytes == 0 and history.undo(mask) is None
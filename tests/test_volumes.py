@@ -0,0 +1,183 @@
+"""体数据（多页TIFF / NIfTI / .npy）内存映射读取与mask体数据写回的测试"""
+import struct
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import correct_mask_gui as gui
+
+
+def write_nifti(path, data, slope=1.0, inter=0.0, unused_dim=1):
+    """写入未压缩的 NIfTI-1 文件（单文件 .nii，数据按 Fortran 顺序存储）
+    
+    unused_dim 为超出维数的 dim 项的值，规范中这些项没有意义。
+    """
+    codes = {np.dtype(v): k for k, v in gui.NIFTI_DTYPES.items()}
+    header = bytearray(352)
+    struct.pack_into("<i", header, 0, 348)
+    struct.pack_into("<8h", header, 40, data.ndim, *data.shape, *(unused_dim,) * (7 - data.ndim))
+    struct.pack_into("<hh", header, 70, codes[data.dtype], data.dtype.itemsize * 8)
+    struct.pack_into("<fff", header, 108, 352.0, slope, inter)
+    header[344:348] = b"n+1\0"
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(np.asarray(data).tobytes(order="F"))
+
+
+@pytest.fixture
+def volume(rng):
+    return rng.integers(0, 4000, (5, 40, 60)).astype(np.uint16)  # (层, 高, 宽)
+
+
+def test_volume_slice_refs():
+    ref = gui.volume_slice_ref("/data/ct.nii", 12)
+    assert gui.parse_volume_slice(ref) == ("/data/ct.nii", 12)
+    assert gui.parse_volume_slice("/data/a#1.png") is None
+    assert gui.parse_volume_slice("/data/ct.npy") is None
+    assert gui.parse_volume_slice(None) is None
+
+
+def test_npy_volume_reads_slices_from_memmap(tmp_path, volume):
+    path = str(tmp_path / "ct.npy")
+    np.save(path, volume)
+    source = gui.VolumeSource.open(path)
+    assert gui.VolumeSource.open(path) is source
+    assert source.depth == 5 and tuple(source.shape) == (40, 60)
+    assert isinstance(source.data, np.memmap)
+    for i in range(5):
+        assert np.array_equal(source.read_slice(i), volume[i])
+
+
+def test_nifti_volume_reads_slices_from_memmap(tmp_path, volume):
+    path = str(tmp_path / "ct.nii")
+    data = volume.astype(np.int16).transpose(2, 1, 0)  # (X, Y, Z)
+    write_nifti(path, data, slope=2.0, inter=-1024.0)
+    source = gui.VolumeSource.open(path)
+    assert source.depth == 5 and tuple(source.shape) == (40, 60)
+    assert (source.slope, source.inter) == (2.0, -1024.0)
+    for i in range(5):
+        assert np.array_equal(source.read_slice(i), volume[i])
+
+
+def test_nifti_rejects_invalid_files(tmp_path):
+    path = tmp_path / "bad.nii"
+    path.write_bytes(b"\0" * 400)
+    with pytest.raises(ValueError):
+        gui.open_nifti_memmap(str(path))
+    path.write_bytes(b"\0" * 100)
+    with pytest.raises(ValueError):
+        gui.open_nifti_memmap(str(path))
+
+
+@pytest.mark.parametrize("shape", [(20, 30), (20, 30, 4), (20, 30, 4, 1)])
+def test_nifti_round_trip(tmp_path, rng, shape):
+    path = str(tmp_path / "labels.nii")
+    labels = rng.integers(0, 1000, shape).astype(np.uint16)
+    write_nifti(path, labels, unused_dim=0)
+    data, slope, inter = gui.open_nifti_memmap(path)
+    assert (slope, inter) == (1.0, 0.0)
+    expected = labels.reshape(shape[:2] + (-1,))
+    assert data.shape == expected.shape and np.array_equal(data, expected)
+    
+    # 写回mask体数据后重新打开，读到写入的层
+    depth = expected.shape[2]
+    mask = rng.integers(0, 1000, (30, 20)).astype(np.uint16)
+    gui.MaskVolume(path, depth, (30, 20)).write_slice(depth - 1, mask)
+    assert np.array_equal(gui.MaskVolume(path, depth, (30, 20)).read_slice(depth - 1), mask)
+    source = gui.VolumeSource.open(path)
+    assert source.depth == depth and tuple(source.shape) == (30, 20)
+
+
+def test_nifti_rejects_time_series(tmp_path):
+    path = str(tmp_path / "series.nii")
+    write_nifti(path, np.zeros((20, 30, 4, 3), np.uint8))
+    with pytest.raises(ValueError):
+        gui.open_nifti_memmap(path)
+
+
+@pytest.mark.parametrize("compression", [None, "tiff_deflate"])
+def test_tiff_pages(tmp_path, volume, compression):
+    path = str(tmp_path / f"stack_{compression}.tif")
+    frames = [Image.fromarray(page) for page in volume]
+    options = {} if compression is None else {"compression": compression}
+    frames[0].save(path, save_all=True, append_images=frames[1:], **options)
+    
+    pages = gui.TiffPages(path)
+    assert len(pages) == 5 and tuple(pages.shape) == (40, 60)
+    # 未压缩的页直接内存映射，压缩的页按需解码
+    assert all((layout is not None) == (compression is None) for layout in pages.pages)
+    for i in range(5):
+        assert np.array_equal(pages[i], volume[i])
+    assert np.array_equal(gui.VolumeSource.open(path).read_slice(3), volume[3])
+
+
+def test_mask_volume_write_and_read(tmp_path):
+    path = str(tmp_path / "ct_mask.npy")
+    volume = gui.MaskVolume(path, 4, (30, 20))
+    assert not volume.exists() and volume.read_slice(0) is None
+    
+    mask = np.zeros((30, 20), np.uint8)
+    mask[5:10, 3:8] = 255
+    volume.write_slice(2, mask)
+    assert volume.exists()
+    assert np.array_equal(volume.read_slice(2), mask)
+    assert not volume.read_slice(1).any()
+    
+    # 重新打开时读到写回的数据
+    reopened = gui.MaskVolume(path, 4, (30, 20))
+    assert np.array_equal(reopened.read_slice(2), mask)
+    with pytest.raises(ValueError):
+        gui.MaskVolume(path, 5, (30, 20))
+
+
+def test_mask_volume_writes_back_into_nifti(tmp_path):
+    path = str(tmp_path / "labels.nii")
+    write_nifti(path, np.zeros((20, 30, 4), np.uint8))
+    volume = gui.MaskVolume(path, 4, (30, 20))
+    mask = np.zeros((30, 20), np.uint8)
+    mask[1:4, 2:9] = 1
+    volume.write_slice(3, mask)
+    data, _, _ = gui.open_nifti_memmap(path)
+    assert np.array_equal(np.asarray(data[:, :, 3]).T, mask)
+
+
+@pytest.mark.parametrize("name", ["ct_mask.npy", "labels.nii"])
+def test_mask_volume_widens_for_large_labels(tmp_path, name):
+    path = str(tmp_path / name)
+    if name.endswith(".nii"):
+        write_nifti(path, np.zeros((20, 30, 3), np.uint8))
+    volume = gui.MaskVolume(path, 3, (30, 20))
+    first = np.zeros((30, 20), np.uint8)
+    first[2:6, 2:6] = 7
+    volume.write_slice(0, first)
+    
+    # 标签超出8位范围时整个体数据转换为16位，已写入的层不变
+    labels = np.zeros((30, 20), np.uint16)
+    labels[10:20, 5:15] = 300
+    volume.write_slice(1, labels)
+    assert volume.data.dtype.itemsize == 2
+    assert np.array_equal(volume.read_slice(0), first)
+    assert np.array_equal(volume.read_slice(1), labels)
+    reopened = gui.MaskVolume(path, 3, (30, 20))
+    assert np.array_equal(reopened.read_slice(1), labels)
+    assert [p.name for p in tmp_path.iterdir()] == [name]
+
+
+def test_mask_volume_path(tmp_path):
+    volume_path = str(tmp_path / "ct.nii")
+    masks = tmp_path / "masks"
+    masks.mkdir()
+    assert gui.mask_volume_path(volume_path, None) == str(tmp_path / "ct_mask.npy")
+    assert gui.mask_volume_path(volume_path, str(masks)) == str(masks / "ct_mask.npy")
+    (masks / "ct.nii").touch()
+    assert gui.mask_volume_path(volume_path, str(masks)) == str(masks / "ct.nii")
+
+
+def test_load_slice_reports_unopened_mask_volume(tmp_path, volume):
+    path = str(tmp_path / "ct.npy")
+    np.save(path, volume)
+    mask_ref = gui.volume_slice_ref(str(tmp_path / "missing_mask.npy"), 1)
+    entry = gui.load_slice(gui.volume_slice_ref(path, 1), mask_ref)
+    assert entry["image"] is not None
+    assert entry["mask_state"] == "corrupt" and entry["error"]